@@ -1,11 +1,29 @@
-import torch
 from torch.utils import data
 from data.image_corruptor import ImageCorruptor
-from data.chunk_with_reference import ChunkWithReference
+from data.chunk_with_reference import ChunkWithReference, ReferenceCache
+from data.chunk_shard import is_shard_dataset, load_sharded_chunks
+from data.lmdb_image_store import LmdbImageStore, is_lmdb_dataset
+from data.path_index import PATH_INDEX_DIR, RepeatedConcat, load_path_index
+from data import util
 import os
 import cv2
 import numpy as np
 
+
+# Written into the dataset root by scripts/extract_subimages_with_ref.py to make extraction resumable; not a chunk.
+EXTRACTION_PROGRESS_DIR = 'extraction_progress'
+
+
+def list_chunk_dirs(root):
+    return [(d.name, d.stat().st_mtime_ns) for d in sorted(os.scandir(root), key=lambda e: e.name)
+            if d.is_dir() and not d.name.startswith(PATH_INDEX_DIR) and d.name != EXTRACTION_PROGRESS_DIR]
+
+
+def scan_chunk_dir(root, name):
+    tiles, _ = util.get_image_paths('img', os.path.join(root, name))
+    return [os.path.relpath(t, root) for t in tiles]
+
+
 # Class whose purpose is to hold as much logic as can possibly be shared between datasets that operate on raw image
 # data and nothing else (which also have a very specific directory structure being used, as dictated by
 # ChunkWithReference).
@@ -26,34 +44,50 @@ class BaseUnsupervisedImageDataset(data.Dataset):
         else:
             self.weights = opt['weights']
 
-        # See if there is a cached directory listing and use that rather than re-scanning everything. This will greatly
-        # reduce startup costs.
-        self.chunks = []
+        # Every tile in a chunk shares the same reference image and centers table, so keep recently decoded ones around.
+        self.reference_cache = ReferenceCache(opt['reference_cache_entries'] if 'reference_cache_entries' in opt.keys() else 32,
+                                              opt['reference_cache_bytes'] if 'reference_cache_bytes' in opt.keys() else 256*1024*1024)
+
+        # Directory listings are kept in a memory-mapped path index (see data/path_index.py) which is refreshed
+        # incrementally, so startup only rescans chunks that changed since the last run.
+        refresh = opt['refresh_path_index'] if 'refresh_path_index' in opt.keys() else True
+        per_path_chunks, chunk_lengths = [], []
         for path, weight in zip(self.paths, self.weights):
-            cache_path = os.path.join(path, 'cache.pth')
-            if os.path.exists(cache_path):
-                chunks = torch.load(cache_path)
+            if is_shard_dataset(path):
+                # Sharded datasets (see scripts/convert_chunks_to_shards.py) carry their own index.
+                chunks = load_sharded_chunks(opt, path)
+            elif is_lmdb_dataset(path):
+                # LMDB datasets (see scripts/create_lmdb.py) are immutable and come with a prebuilt path index.
+                store = LmdbImageStore(path)
+                index = store.path_index()
+                chunks = [ChunkWithReference(opt, os.path.join(store.root, index.group_name(g)), index.group(g), store)
+                          for g in range(index.num_groups())]
+                chunks = [c for c in chunks if len(c) != 0]
             else:
-                print("Building chunk cache, this can take some time for large datasets..")
-                chunks = [ChunkWithReference(opt, d) for d in sorted(os.scandir(path), key=lambda e: e.name) if d.is_dir()]
+                index = load_path_index(path, list_chunk_dirs, scan_chunk_dir, refresh)
+                chunks = [ChunkWithReference(opt, os.path.join(path, index.group_name(g)), index.group(g))
+                          for g in range(index.num_groups())]
                 # Prune out chunks that have no images
-                res = []
-                for c in chunks:
-                    if len(c) != 0:
-                        res.append(c)
-                chunks = res
-                # Save to a cache.
-                torch.save(chunks, cache_path)
-            for w in range(weight):
-                self.chunks.extend(chunks)
+                chunks = [c for c in chunks if len(c) != 0]
+            for c in chunks:
+                c.cache = self.reference_cache
+            per_path_chunks.append(chunks)
+            chunk_lengths.append(np.tile(np.asarray([len(c) for c in chunks], dtype=np.int64), weight))
+        # Weights repeat the chunks of a path virtually rather than physically duplicating the lists.
+        self.chunks = RepeatedConcat(per_path_chunks, self.weights)
 
         # Indexing this dataset is tricky. Aid it by having a list of starting indices for each chunk.
-        start = 0
-        self.starting_indices = []
-        for c in self.chunks:
-            self.starting_indices.append(start)
-            start += len(c)
-        self.len = start
+        chunk_lengths = np.concatenate(chunk_lengths) if chunk_lengths else np.zeros(0, dtype=np.int64)
+        self.starting_indices = np.concatenate([[0], np.cumsum(chunk_lengths)[:-1]]).astype(np.int64)
+        self.len = int(chunk_lengths.sum())
+
+    # Hit/miss counters of the reference cache of the calling process only. Every DataLoader worker has its own cache,
+    # so these are not dataset-wide numbers: called from the main process while workers do the loading, they stay at
+    # zero. Call it from inside a worker (e.g. in a worker_init_fn or collate_fn) to inspect that worker's cache.
+    def get_reference_cache_stats(self):
+        stats = self.reference_cache.stats()
+        stats['pid'] = os.getpid()
+        return stats
 
     def get_paths(self):
         paths = []
@@ -266,31 +266,46 @@ class RandomSharedRegionCrop(nn.Module):
         return p1_resized, p2_resized, recompute_package, masked1, masked2, masked_dbg, i1_shared, i2_shared
 
 
+# Indices that F.interpolate(mode="nearest") reads for the given output indices when resizing from in_size to out_size.
+# Computed in float32 the same way torch does, so the results are identical.
+def nearest_source_indices(dst, in_size, out_size):
+    scale = in_size / out_size.float()
+    return torch.clamp(torch.floor(dst.float() * scale).long(), max=in_size - 1)
+
+
+# Gathers, for every batch element, the s_h x s_w window starting at (t, l) of fea resized to (h, w), zero padded to
+# pad_dim. All of the arguments besides fea and pad_dim are (b,) tensors. Optionally flips fea horizontally first.
+def _gather_resized_windows(fea, h, w, t, l, s_h, s_w, pad_dim, flip=None):
+    b, c, in_h, in_w = fea.shape
+    offsets = torch.arange(pad_dim, device=fea.device).unsqueeze(0)
+    rows, cols = t.unsqueeze(1) + offsets, l.unsqueeze(1) + offsets
+    # Slicing past the end of the resized map yields a smaller window, the rest of which is padding.
+    valid_rows = (offsets < s_h.unsqueeze(1)) & (rows < h.unsqueeze(1))
+    valid_cols = (offsets < s_w.unsqueeze(1)) & (cols < w.unsqueeze(1))
+    src_rows = nearest_source_indices(rows, in_h, h.unsqueeze(1))
+    src_cols = nearest_source_indices(cols, in_w, w.unsqueeze(1))
+    if flip is not None:
+        src_cols = torch.where(flip.unsqueeze(1) == 1, in_w - 1 - src_cols, src_cols)
+    index = (src_rows.unsqueeze(2) * in_w + src_cols.unsqueeze(1)).view(b, 1, pad_dim * pad_dim)
+    regions = torch.gather(fea.reshape(b, c, in_h * in_w), 2, index.expand(b, c, -1)).view(b, c, pad_dim, pad_dim)
+    mask = (valid_rows.unsqueeze(2) & valid_cols.unsqueeze(1)).unsqueeze(1)
+    # pad_to() pads into a float32 tensor.
+    return regions.float().masked_fill(~mask, 0)
+
+
 # Uses the recompute package returned from the above dataset to extract matched-size "similar regions" from two feature
-# maps.
+# maps. The whole batch is gathered at once on the device of the feature maps; the only host sync is for the padded
+# size of the output.
 def reconstructed_shared_regions(fea1, fea2, recompute_package: torch.Tensor):
-    package = recompute_package.cpu()
-    res1 = []
-    res2 = []
-    pad_dim = torch.max(package[:, -2:]).item()
-    # It'd be real nice if we could do this at the batch level, but I don't see a really good way to do that outside
-    # of conforming the recompute_package across the entire batch.
-    for b in range(package.shape[0]):
-        expected_dim, f1_h, f1_w, f1s_t, f1s_l, f2_h, f2_w, f2s_t, f2s_l, should_flip, s_h, s_w = tuple(package[b].tolist())
-        # If you are hitting this assert, you specified `latent_multiple` in your dataset config wrong.
-        assert expected_dim == fea1.shape[2] and expected_dim == fea2.shape[2]
-
-        # Unflip 2 if needed.
-        f2 = fea2[b]
-        if should_flip == 1:
-            f2 = kornia.geometry.transform.hflip(f2)
-        # Resize the input features to match
-        f1s = F.interpolate(fea1[b].unsqueeze(0), (f1_h, f1_w), mode="nearest")
-        f2s = F.interpolate(f2.unsqueeze(0), (f2_h, f2_w), mode="nearest")
-        # Outputs must be padded so they can "get along" with each other.
-        res1.append(pad_to(f1s[:, :, f1s_t:f1s_t+s_h, f1s_l:f1s_l+s_w], pad_dim))
-        res2.append(pad_to(f2s[:, :, f2s_t:f2s_t+s_h, f2s_l:f2s_l+s_w], pad_dim))
-    return torch.cat(res1, dim=0), torch.cat(res2, dim=0)
+    package = recompute_package.to(fea1.device)
+    expected_dim, f1_h, f1_w, f1s_t, f1s_l, f2_h, f2_w, f2s_t, f2s_l, should_flip, s_h, s_w = package.unbind(dim=1)
+    pad_dim, dim_mismatch = torch.stack([torch.max(package[:, -2:]),
+                                         ((expected_dim != fea1.shape[2]) | (expected_dim != fea2.shape[2])).any()]).tolist()
+    # If you are hitting this assert, you specified `latent_multiple` in your dataset config wrong.
+    assert not dim_mismatch
+    res1 = _gather_resized_windows(fea1, f1_h, f1_w, f1s_t, f1s_l, s_h, s_w, pad_dim)
+    res2 = _gather_resized_windows(fea2, f2_h, f2_w, f2s_t, f2s_l, s_h, s_w, pad_dim, flip=should_flip)
+    return res1, res2
 
 
 # Follows the general template of BYOL dataset, with the following changes:
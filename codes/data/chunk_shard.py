@@ -0,0 +1,264 @@
+import os
+import os.path as osp
+import shutil
+import numpy as np
+import torch
+from data import util
+from data.chunk_with_reference import build_center_mask
+
+# On-disk layout of a sharded chunk dataset:
+#   <root>/shards.npz        - The index (see ChunkShardWriter.close() for the arrays it holds).
+#   <root>/shard_00000.bin   - Append-only blob files. The encoded bytes of a chunk (ref.jpg followed by every tile) are
+#   <root>/shard_00001.bin     always laid out contiguously in a single shard file.
+# Masks are not stored; like ChunkWithReference, they are derived from the tile center and tile width on read.
+SHARD_INDEX_NAME = 'shards.npz'
+
+
+def is_shard_dataset(path):
+    return osp.exists(osp.join(path, SHARD_INDEX_NAME))
+
+
+def shard_file_name(shard_id):
+    return 'shard_%05i.bin' % (shard_id,)
+
+
+# Writes the index through a temporary file, so that an interrupted write never leaves a truncated index behind.
+def write_shard_index(folder, **arrays):
+    tmp = osp.join(folder, 'shards.%d.tmp.npz' % (os.getpid(),))
+    np.savez(tmp, **arrays)
+    os.replace(tmp, osp.join(folder, SHARD_INDEX_NAME))
+
+
+# Appends chunks into large shard files and records their positions in a compact numpy index. If folder already holds a
+# sharded dataset, its index is loaded and extended: new chunks are appended after the bytes of its last shard and the
+# index written by close() covers both the existing and the new chunks. Without an index, any shard files in folder are
+# considered leftovers and are overwritten.
+class ChunkShardWriter:
+    def __init__(self, folder, max_shard_size=4*1024*1024*1024):
+        self.folder = folder
+        self.max_shard_size = max_shard_size
+        os.makedirs(folder, exist_ok=True)
+        self.shard_id = -1
+        self.shard = None
+        self.shard_pos = 0
+
+        self.chunk_names, self.chunk_shards, self.chunk_ref_offsets, self.chunk_ref_lens = [], [], [], []
+        self.chunk_tile_starts, self.chunk_tile_counts = [], []
+        self.tile_names, self.tile_offsets, self.tile_lens = [], [], []
+        self.tile_centers, self.tile_widths, self.tile_has_center = [], [], []
+        append = is_shard_dataset(folder)
+        if append:
+            index = np.load(osp.join(folder, SHARD_INDEX_NAME))
+            for k in ['chunk_names', 'chunk_shards', 'chunk_ref_offsets', 'chunk_ref_lens', 'chunk_tile_starts',
+                      'chunk_tile_counts', 'tile_names', 'tile_offsets', 'tile_lens', 'tile_widths', 'tile_has_center']:
+                setattr(self, k, index[k].tolist())
+            self.tile_centers = [tuple(c) for c in index['tile_centers'].tolist()]
+            if self.chunk_shards:
+                self.shard_id = max(self.chunk_shards) - 1
+        self._next_shard(append)
+
+    def _next_shard(self, append=False):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_id += 1
+        self.shard = open(osp.join(self.folder, shard_file_name(self.shard_id)), "ab" if append else "wb")
+        self.shard_pos = self.shard.tell()
+
+    def _append(self, data):
+        offset = self.shard_pos
+        self.shard.write(data)
+        self.shard_pos += len(data)
+        return offset
+
+    # Writes a full chunk. ref is the encoded reference image (or None), tiles is a list of (name, encoded bytes) and
+    # centers is the dict stored in centers.pt, mapping tile ids to (center, tile_width).
+    def write_chunk(self, name, ref, tiles, centers):
+        if self.shard_pos > 0 and self.shard_pos >= self.max_shard_size:
+            self._next_shard()
+        self.chunk_names.append(name)
+        self.chunk_shards.append(self.shard_id)
+        if ref is not None:
+            self.chunk_ref_offsets.append(self._append(ref))
+            self.chunk_ref_lens.append(len(ref))
+        else:
+            self.chunk_ref_offsets.append(0)
+            self.chunk_ref_lens.append(0)
+        self.chunk_tile_starts.append(len(self.tile_names))
+        self.chunk_tile_counts.append(len(tiles))
+        for tile_name, tile in tiles:
+            self.tile_names.append(tile_name)
+            self.tile_offsets.append(self._append(tile))
+            self.tile_lens.append(len(tile))
+            tile_id = int(osp.splitext(osp.basename(tile_name))[0]) if centers is not None else None
+            if centers is not None and tile_id in centers.keys():
+                center, tile_width = centers[tile_id]
+                self.tile_centers.append((int(center[0]), int(center[1])))
+                self.tile_widths.append(int(tile_width))
+                self.tile_has_center.append(True)
+            else:
+                self.tile_centers.append((0, 0))
+                self.tile_widths.append(0)
+                self.tile_has_center.append(False)
+
+    def close(self):
+        self.shard.close()
+        write_shard_index(self.folder,
+                          chunk_names=np.asarray(self.chunk_names, dtype=np.str_),
+                          chunk_shards=np.asarray(self.chunk_shards, dtype=np.int32),
+                          chunk_ref_offsets=np.asarray(self.chunk_ref_offsets, dtype=np.int64),
+                          chunk_ref_lens=np.asarray(self.chunk_ref_lens, dtype=np.int64),
+                          chunk_tile_starts=np.asarray(self.chunk_tile_starts, dtype=np.int64),
+                          chunk_tile_counts=np.asarray(self.chunk_tile_counts, dtype=np.int64),
+                          tile_names=np.asarray(self.tile_names, dtype=np.str_),
+                          tile_offsets=np.asarray(self.tile_offsets, dtype=np.int64),
+                          tile_lens=np.asarray(self.tile_lens, dtype=np.int64),
+                          tile_centers=np.asarray(self.tile_centers, dtype=np.int64).reshape(-1, 2),
+                          tile_widths=np.asarray(self.tile_widths, dtype=np.int64),
+                          tile_has_center=np.asarray(self.tile_has_center, dtype=np.bool_))
+
+
+# Reads the index produced by ChunkShardWriter and serves raw bytes out of the shard files. File handles are opened
+# lazily and are keyed by process id, so handles are never shared across DataLoader workers after a fork.
+class ChunkShardReader:
+    def __init__(self, folder):
+        self.folder = folder
+        index = np.load(osp.join(folder, SHARD_INDEX_NAME))
+        self.index = {k: index[k] for k in index.files}
+        self.handles = {}
+        self.handles_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['handles'] = {}
+        state['handles_pid'] = None
+        return state
+
+    def num_chunks(self):
+        return len(self.index['chunk_names'])
+
+    def _handle(self, shard_id):
+        if self.handles_pid != os.getpid():
+            self.handles = {}
+            self.handles_pid = os.getpid()
+        if shard_id not in self.handles.keys():
+            self.handles[shard_id] = open(osp.join(self.folder, shard_file_name(shard_id)), "rb")
+        return self.handles[shard_id]
+
+    def read(self, shard_id, offset, length):
+        f = self._handle(shard_id)
+        f.seek(offset)
+        return f.read(length)
+
+
+# Drop-in replacement for ChunkWithReference that reads a single chunk out of a ChunkShardReader. Each item costs two
+# reads (reference and tile) from an already-open shard file rather than three file opens.
+class ShardedChunk:
+    cache = None  # Optional ReferenceCache, set by the owning dataset.
+
+    def __init__(self, opt, reader, chunk_index):
+        self.reader = reader
+        self.chunk_index = chunk_index
+        self.path = osp.join(reader.folder, str(reader.index['chunk_names'][chunk_index]))
+        self.strict = opt['strict'] if 'strict' in opt.keys() else True
+        self.tile_start = int(reader.index['chunk_tile_starts'][chunk_index])
+        self.tile_count = int(reader.index['chunk_tile_counts'][chunk_index])
+        if 'ignore_first' in opt.keys():
+            skip = min(opt['ignore_first'], self.tile_count)
+            self.tile_start += skip
+            self.tile_count -= skip
+
+    @property
+    def tiles(self):
+        names = self.reader.index['tile_names'][self.tile_start:self.tile_start+self.tile_count]
+        return [osp.join(self.path, str(n)) for n in names]
+
+    def decode_or_get_zero(self, buffer):
+        img = util.read_img('buffer', np.frombuffer(buffer, dtype=np.uint8), rgb=True)
+        if img is None:
+            return np.zeros((128, 128, 3))
+        return img
+
+    def __getitem__(self, item):
+        index = self.reader.index
+        shard_id = int(index['chunk_shards'][self.chunk_index])
+        t = self.tile_start + item
+        tile_name = str(index['tile_names'][t])
+        tile_path = osp.join(self.path, tile_name)
+        tile = self.decode_or_get_zero(self.reader.read(shard_id, int(index['tile_offsets'][t]), int(index['tile_lens'][t])))
+        ref_len = int(index['chunk_ref_lens'][self.chunk_index])
+        if ref_len > 0:
+            ref = self.cache.get(self.path) if self.cache is not None else None
+            if ref is None:
+                ref = self.decode_or_get_zero(self.reader.read(shard_id, int(index['chunk_ref_offsets'][self.chunk_index]), ref_len))
+                ref.setflags(write=False)
+                if self.cache is not None:
+                    self.cache.put(self.path, ref, ref.nbytes)
+            ref = ref.copy()  # The cached image is shared by every tile of the chunk; hand out a writable copy.
+            if index['tile_has_center'][t]:
+                center = tuple(int(c) for c in index['tile_centers'][t])
+                tile_width = int(index['tile_widths'][t])
+            elif self.strict:
+                print("Could not find the given tile id in the centers table of a sharded chunk. If you don't care "
+                      "about tile centers, consider passing strict=false to the dataset options.")
+                raise FileNotFoundError(tile_name, tile_path)
+            else:
+                center = torch.tensor([128, 128], dtype=torch.long)
+                tile_width = 256
+            mask = build_center_mask(tile, center, tile_width)
+        else:
+            ref = np.zeros_like(tile)
+            mask = np.zeros(tile.shape[:2] + (1,))
+            center = (0,0)
+
+        return tile, ref, center, mask, tile_path
+
+    def __len__(self):
+        return self.tile_count
+
+
+# Returns a ShardedChunk for every non-empty chunk in the sharded dataset at the given path.
+def load_sharded_chunks(opt, path):
+    reader = ChunkShardReader(path)
+    chunks = [ShardedChunk(opt, reader, i) for i in range(reader.num_chunks())]
+    return [c for c in chunks if len(c) != 0]
+
+
+# Merges the given sharded datasets into the sharded dataset at dest, which is created if it does not exist yet (and
+# otherwise extended). Shard files are hard-linked into dest under their new numbers rather than copied, so this is
+# cheap. The merged index is swapped in atomically and records the names of the folders it absorbed; only then are the
+# folders removed. An interrupted merge can therefore simply be run again: folders that made it into the index are just
+# cleaned up, and links left behind for the others are unindexed and get overwritten.
+def merge_shard_datasets(dest, folders):
+    os.makedirs(dest, exist_ok=True)
+    merged, merged_parts = {}, []
+    next_shard, next_tile = 0, 0
+    if is_shard_dataset(dest):
+        index = np.load(osp.join(dest, SHARD_INDEX_NAME))
+        index = {k: index[k] for k in index.files}
+        merged_parts = list(index.pop('merged_parts', []))
+        for k, v in index.items():
+            merged[k] = [v]
+        next_shard = int(index['chunk_shards'].max()) + 1 if len(index['chunk_shards']) > 0 else 0
+        next_tile = len(index['tile_names'])
+    pending = [f for f in folders if osp.basename(osp.normpath(f)) not in merged_parts]
+    for folder in pending:
+        index = np.load(osp.join(folder, SHARD_INDEX_NAME))
+        index = {k: index[k] for k in index.files}
+        num_shards = int(index['chunk_shards'].max()) + 1 if len(index['chunk_shards']) > 0 else 0
+        for s in range(num_shards):
+            target = osp.join(dest, shard_file_name(next_shard + s))
+            if osp.exists(target):
+                os.remove(target)
+            os.link(osp.join(folder, shard_file_name(s)), target)
+        index['chunk_shards'] = index['chunk_shards'] + next_shard
+        index['chunk_tile_starts'] = index['chunk_tile_starts'] + next_tile
+        for k, v in index.items():
+            merged.setdefault(k, []).append(v)
+        merged_parts.append(osp.basename(osp.normpath(folder)))
+        next_shard += num_shards
+        next_tile += len(index['tile_names'])
+    if pending:
+        merged = {k: np.concatenate(v) for k, v in merged.items()}
+        write_shard_index(dest, merged_parts=np.asarray(merged_parts, dtype=np.str_), **merged)
+    for folder in folders:
+        shutil.rmtree(folder)
@@ -1,30 +1,115 @@
 import os.path as osp
+from collections import OrderedDict
 from data import util
 import torch
 import numpy as np
 
+
+# Builds a mask over a tile which is 1 inside of the square of width tile_width around center and .1 elsewhere.
+def build_center_mask(tile, center, tile_width):
+    mask = np.full(tile.shape[:2] + (1,), fill_value=.1, dtype=tile.dtype)
+    mask[center[0] - tile_width // 2:center[0] + tile_width // 2, center[1] - tile_width // 2:center[1] + tile_width // 2] = 1
+    return mask
+
+
+# Bounded LRU cache for the decoded reference image and centers table of a chunk, since every tile in a chunk shares
+# them. Each DataLoader worker gets its own copy of the cache when the dataset is handed off to it. Entries are evicted
+# when either max_entries or max_bytes is exceeded. hits/misses can be used to size the cache.
+class ReferenceCache:
+    def __init__(self, max_entries=32, max_bytes=256*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Don't ship decoded images across process boundaries.
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['bytes'] = 0
+        return state
+
+    def get(self, key):
+        if key in self.entries.keys():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+        self.entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.bytes -= evicted_bytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.bytes}
+
+
 # Iterable that reads all the images in a directory that contains a reference image, tile images and center coordinates.
 class ChunkWithReference:
-    def __init__(self, opt, path):
-        self.path = path.path
-        self.tiles, _ = util.get_image_paths('img', self.path)
+    cache = None  # Set by the owning dataset. A class attribute so chunks unpickled from old caches pick it up.
+    store = None  # An LmdbImageStore to read the files from rather than the file system, if the dataset is an LMDB.
+
+    # path is a directory (str or os.DirEntry). tiles may be given if the directory has already been scanned.
+    def __init__(self, opt, path, tiles=None, store=None):
+        self.path = path if isinstance(path, str) else path.path
+        self.store = store
+        if tiles is None:
+            tiles, _ = util.get_image_paths('img', self.path)
+        self.tiles = tiles
         self.strict = opt['strict'] if 'strict' in opt.keys() else True
         if 'ignore_first' in opt.keys():
             self.tiles = self.tiles[opt['ignore_first']:]
 
     # Odd failures occur at times. Rather than crashing, report the error and just return zeros.
     def read_image_or_get_zero(self, img_path):
-        img = util.read_img(None, img_path, rgb=True)
+        if self.store is not None:
+            img = self.store.read_img(img_path, rgb=True)
+        else:
+            img = util.read_img(None, img_path, rgb=True)
         if img is None:
             return np.zeros(128, 128, 3)
         return img
 
+    # Returns the decoded reference image and centers table for this chunk (both None if the chunk has no reference),
+    # going through the reference cache if one is set. The returned image is always a writable copy, since the datasets
+    # may hand it to torch as-is or modify it in place.
+    def read_reference(self):
+        if self.cache is not None:
+            cached = self.cache.get(self.path)
+            if cached is not None:
+                ref, centers = cached
+                return (None if ref is None else ref.copy()), centers
+        if self.store is not None:
+            has_ref = self.store.exists(osp.join(self.path, "ref.jpg"))
+            load_centers = self.store.load_torch
+        else:
+            has_ref = osp.exists(osp.join(self.path, "ref.jpg"))
+            load_centers = torch.load
+        if has_ref:
+            centers = load_centers(osp.join(self.path, "centers.pt"))
+            ref = self.read_image_or_get_zero(osp.join(self.path, "ref.jpg"))
+            ref.setflags(write=False)  # Shared by every tile in the chunk through the cache; only copies leave it.
+            nbytes = ref.nbytes + 64 * len(centers)
+        else:
+            ref, centers = None, None
+            nbytes = 0
+        if self.cache is not None:
+            self.cache.put(self.path, (ref, centers), nbytes)
+        return (None if ref is None else ref.copy()), centers
+
     def __getitem__(self, item):
         tile = self.read_image_or_get_zero(self.tiles[item])
-        if osp.exists(osp.join(self.path, "ref.jpg")):
+        ref, centers = self.read_reference()
+        if ref is not None:
             tile_id = int(osp.splitext(osp.basename(self.tiles[item]))[0])
-            centers = torch.load(osp.join(self.path, "centers.pt"))
-            ref = self.read_image_or_get_zero(osp.join(self.path, "ref.jpg"))
             if tile_id in centers.keys():
                 center, tile_width = centers[tile_id]
             elif self.strict:
@@ -36,8 +121,7 @@ class ChunkWithReference:
             else:
                 center = torch.tensor([128, 128], dtype=torch.long)
                 tile_width = 256
-            mask = np.full(tile.shape[:2] + (1,), fill_value=.1, dtype=tile.dtype)
-            mask[center[0] - tile_width // 2:center[0] + tile_width // 2, center[1] - tile_width // 2:center[1] + tile_width // 2] = 1
+            mask = build_center_mask(tile, center, tile_width)
         else:
             ref = np.zeros_like(tile)
             mask = np.zeros(tile.shape[:2] + (1,))
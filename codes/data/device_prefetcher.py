@@ -0,0 +1,58 @@
+import torch
+
+
+# Wraps a DataLoader and copies the tensors of the *next* batch to the GPU on a side stream while the current training
+# step is still running, so the trainer does not have to wait on a synchronous host->device copy. The DataLoader should
+# use pin_memory=True (create_dataloader does) so the copies are truly asynchronous.
+#
+# Batches come out with their tensors already on the device. ExtensibleTrainer.feed_data() chunks them into mega-batch
+# pieces with torch.chunk, which produces views of the staged tensor, so no further copies are made there.
+# On machines without CUDA, this is a pass-through.
+class DevicePrefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.enabled = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.enabled else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    # Passthrough for anything that expects a DataLoader, e.g. `loader.dataset`.
+    def __getattr__(self, item):
+        return getattr(self.__dict__['loader'], item)
+
+    def _stage(self, batch):
+        staged = {}
+        with torch.cuda.stream(self.stream):
+            for k, v in batch.items():
+                if isinstance(v, torch.Tensor):
+                    staged[k] = v.to(self.device, non_blocking=True)
+                else:
+                    staged[k] = v
+        return staged
+
+    def _release(self, batch):
+        # Make the consuming stream wait for the copies, and make sure the caching allocator doesn't reuse the staged
+        # memory until the consuming stream is done with it.
+        current = torch.cuda.current_stream(self.device)
+        current.wait_stream(self.stream)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(current)
+        return batch
+
+    def __iter__(self):
+        if not self.enabled:
+            yield from self.loader
+            return
+        it = iter(self.loader)
+        try:
+            pending = self._stage(next(it))
+        except StopIteration:
+            return
+        for batch in it:
+            nxt = self._stage(batch)
+            yield self._release(pending)
+            pending = nxt
+        yield self._release(pending)
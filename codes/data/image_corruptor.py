@@ -1,6 +1,10 @@
+import functools
+import math
 import random
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 from data.util import read_img
 from PIL import Image
 from io import BytesIO
@@ -135,3 +139,276 @@ class ImageCorruptor:
             raise NotImplementedError("Augmentation doesn't exist")
 
         return img
+
+# The (lo, span) that the JPEG quality factor is drawn from for every JPEG corruption: qf = rand_int % span + lo.
+# The (lo, range) that the JPEG quality factor is drawn from for every JPEG corruption: qf = rand_int % range + lo.
+JPEG_QUALITY_RANGES = {'jpeg': (10, 20), 'jpeg-low': (15, 10), 'jpeg-medium': (23, 25), 'jpeg-broad': (15, 60),
+                       'jpeg-normal': (47, 35)}
+
+# Standard JPEG quantization tables (ITU T.81, Annex K).
+JPEG_LUMA_TABLE = [[16, 11, 10, 16, 24, 40, 51, 61],
+                   [12, 12, 14, 19, 26, 58, 60, 55],
+                   [14, 13, 16, 24, 40, 57, 69, 56],
+                   [14, 17, 22, 29, 51, 87, 80, 62],
+                   [18, 22, 37, 56, 68, 109, 103, 77],
+                   [24, 35, 55, 64, 81, 104, 113, 92],
+                   [49, 64, 78, 87, 103, 121, 120, 101],
+                   [72, 92, 95, 98, 112, 100, 103, 99]]
+JPEG_CHROMA_TABLE = [[17, 18, 24, 47, 99, 99, 99, 99],
+                     [18, 21, 26, 66, 99, 99, 99, 99],
+                     [24, 26, 56, 99, 99, 99, 99, 99],
+                     [47, 66, 99, 99, 99, 99, 99, 99]] + [[99] * 8] * 4
+
+
+@functools.lru_cache(maxsize=None)
+def _motion_blur_kernel(intensity, angle):
+    k = np.zeros((intensity, intensity), dtype=np.float32)
+    k[(intensity - 1) // 2, :] = np.ones(intensity, dtype=np.float32)
+    k = cv2.warpAffine(k, cv2.getRotationMatrix2D((intensity / 2 - 0.5, intensity / 2 - 0.5), angle, 1.0),
+                       (intensity, intensity))
+    return k * (1.0 / np.sum(k))
+
+
+# Correlates every image in x (b,c,h,w) with its own kernel in kernels (b,kh,kw), using the same anchor and the same
+# reflect-101 border handling as cv2.filter2D().
+def _filter2d(x, kernels):
+    b, c, h, w = x.shape
+    kh, kw = kernels.shape[-2:]
+    x = F.pad(x, (kw // 2, kw - 1 - kw // 2, kh // 2, kh - 1 - kh // 2), mode='reflect')
+    weight = kernels.to(x.dtype).repeat_interleave(c, dim=0).unsqueeze(1)
+    return F.conv2d(x.reshape(1, b * c, x.shape[2], x.shape[3]), weight, groups=b * c).reshape(b, c, h, w)
+
+
+# Builds the (dst, src) matrix that cv2.resize() implicitly applies along one axis for float images.
+def _resize_matrix(src, dst, mode, device):
+    return _cpu_resize_matrix(src, dst, mode).to(device)
+
+
+@functools.lru_cache(maxsize=64)
+def _cpu_resize_matrix(src, dst, mode):
+    scale = src / dst
+    m = torch.zeros(dst, src, dtype=torch.float64)
+    for d in range(dst):
+        if mode == cv2.INTER_NEAREST:
+            m[d, min(int(math.floor(d * scale)), src - 1)] = 1
+            continue
+        if mode == cv2.INTER_AREA:
+            # Only enlarging is supported, where cv2 blends neighbours only across source pixel boundaries.
+            assert dst >= src
+            s = int(math.floor(d * scale))
+            t = (d + 1) - (s + 1) / scale
+            t = 0 if t <= 0 else t - math.floor(t)
+            m[d, min(s, src - 1)] += 1 - t
+            m[d, min(s + 1, src - 1)] += t
+            continue
+        f = (d + 0.5) * scale - 0.5
+        s = int(math.floor(f))
+        t = f - s
+        if mode == cv2.INTER_LINEAR:
+            taps = {s: 1 - t, s + 1: t}
+        elif mode == cv2.INTER_CUBIC:
+            A = -0.75
+            def cubic(x):
+                x = abs(x)
+                if x <= 1:
+                    return ((A + 2) * x - (A + 3)) * x * x + 1
+                return ((A * x - 5 * A) * x + 8 * A) * x - 4 * A
+            taps = {s + i: cubic(t - i) for i in range(-1, 3)}
+        else:
+            raise NotImplementedError(mode)
+        for i, v in taps.items():
+            m[d, min(max(i, 0), src - 1)] += v
+    return m.float()
+
+
+def _resize(x, h, w, mode):
+    mh = _resize_matrix(x.shape[2], h, mode, x.device)
+    mw = _resize_matrix(x.shape[3], w, mode, x.device)
+    return torch.einsum('oh,bchw,pw->bcop', mh, x, mw)
+
+
+def _jpeg_tables(qualities, device):
+    tables = []
+    for base in [JPEG_LUMA_TABLE, JPEG_CHROMA_TABLE]:
+        base = torch.tensor(base, dtype=torch.float32, device=device)
+        q = qualities.clamp(1, 100).float().to(device)
+        scale = torch.where(q < 50, 5000 / q, 200 - 2 * q).view(-1, 1, 1, 1, 1, 1)
+        tables.append(torch.floor((base * scale + 50) / 100).clamp(1, 255))
+    return tables
+
+
+def _dct_matrix(device):
+    i = torch.arange(8, dtype=torch.float32, device=device)
+    d = torch.cos((2 * i[None, :] + 1) * i[:, None] * math.pi / 16) * math.sqrt(2 / 8)
+    d[0] = d[0] / math.sqrt(2)
+    return d
+
+
+def _quantize_blocks(x, table, dct):
+    b, c, h, w = x.shape
+    blocks = x.reshape(b, c, h // 8, 8, w // 8, 8).permute(0, 1, 2, 4, 3, 5)
+    coef = dct @ (blocks - 128) @ dct.t()
+    coef = torch.round(coef / table) * table
+    blocks = (dct.t() @ coef @ dct + 128).round().clamp(0, 255)
+    return blocks.permute(0, 1, 2, 4, 3, 5).reshape(b, c, h, w)
+
+
+# Simulates a baseline JPEG encode/decode of RGB images in [0,1] at the given per-image quality factors: JFIF YCbCr
+# conversion, 4:2:0 chroma subsampling, 8x8 DCT quantization with the standard tables and "fancy" (triangular) chroma
+# upsampling, which is what PIL does by default. Entropy coding is lossless, so it is skipped.
+def _jpeg(x, qualities):
+    b, c, h, w = x.shape
+    x = torch.floor(x.clamp(0, 1) * 255)
+    ph, pw = (16 - h % 16) % 16, (16 - w % 16) % 16
+    x = F.pad(x, (0, pw, 0, ph), mode='replicate')
+    r, g, bl = x[:, 0:1], x[:, 1:2], x[:, 2:3]
+    y = (0.299 * r + 0.587 * g + 0.114 * bl).round()
+    cb = (-0.168736 * r - 0.331264 * g + 0.5 * bl + 128).round()
+    cr = (0.5 * r - 0.418688 * g - 0.081312 * bl + 128).round()
+    luma_table, chroma_table = _jpeg_tables(qualities, x.device)
+    dct = _dct_matrix(x.device)
+    y = _quantize_blocks(y, luma_table, dct)
+    chroma = _quantize_blocks(F.avg_pool2d(torch.cat([cb, cr], dim=1), 2).round(), chroma_table, dct)
+    chroma = F.interpolate(chroma, scale_factor=2, mode='bilinear', align_corners=False)
+    cb, cr = chroma[:, 0:1] - 128, chroma[:, 1:2] - 128
+    rgb = torch.cat([y + 1.402 * cr, y - 0.344136 * cb - 0.714136 * cr, y + 1.772 * cb], dim=1)
+    return (rgb.round().clamp(0, 255) / 255)[:, :, :h, :w]
+
+
+# Batched, on-device counterpart of ImageCorruptor. Accepts the same options and corruption vocabulary, but operates on
+# (b,c,h,w) RGB tensors in [0,1] and draws the corruptions and their random parameters independently for every image
+# in the batch (ImageCorruptor draws them per dataset item, which is the same thing).
+#
+# Randomness comes from an optional torch.Generator, so results are reproducible for a given seed. Corruptions are
+# applied by grouping the images that share the same corruption (and, where the kernel shape depends on it, the same
+# parameters) and processing each group as one batch.
+#
+# Where exact parity with the CPU path is possible (blurs, resampling, quantization, saturation), results match
+# ImageCorruptor up to float error. Noise is drawn from torch's RNG rather than numpy's, and JPEG is simulated with
+# an 8x8 DCT quantization pipeline instead of a PIL round-trip, so those only match statistically. As with the CPU
+# path, 'lq_resampling' trims images to a multiple of the resampling scale; all images in a batch must be the same
+# size so the output is still a single tensor.
+class BatchImageCorruptor:
+    def __init__(self, opt):
+        self.blur_scale = opt['corruption_blur_scale'] if 'corruption_blur_scale' in opt.keys() else 1
+        self.fixed_corruptions = opt['fixed_corruptions'] if 'fixed_corruptions' in opt.keys() else []
+        self.num_corrupts = opt['num_corrupts_per_image'] if 'num_corrupts_per_image' in opt.keys() else 0
+        self.random_corruptions = opt['random_corruptions'] if 'random_corruptions' in opt.keys() and self.num_corrupts > 0 else []
+
+    def corrupt_batch(self, imgs, generator=None):
+        if self.num_corrupts == 0 and not self.fixed_corruptions:
+            return imgs
+        b = imgs.shape[0]
+        if self.num_corrupts > 0:
+            choices = torch.randint(len(self.random_corruptions), (b, self.num_corrupts), generator=generator).tolist()
+        else:
+            choices = [[] for _ in range(b)]
+        rand_int_f = torch.randint(1, 1000000, (b,), generator=generator)
+        rand_int_a = torch.randint(1, 1000000, (b,), generator=generator)
+        noise_seed = int(torch.randint(0, 2**62, (1,), generator=generator)) if generator is not None else None
+        noise_generator = None
+        if noise_seed is not None:
+            noise_generator = torch.Generator(device=imgs.device)
+            noise_generator.manual_seed(noise_seed)
+
+        augs = [[self.random_corruptions[c] for c in choices[i]] + self.fixed_corruptions for i in range(b)]
+        rand_ints = torch.stack([rand_int_a] * self.num_corrupts + [rand_int_f] * len(self.fixed_corruptions), dim=1)
+        for p in range(self.num_corrupts + len(self.fixed_corruptions)):
+            groups = {}
+            for i in range(b):
+                groups.setdefault(augs[i][p], []).append(i)
+            corrupted = None
+            for aug, idx in groups.items():
+                out = self.apply_corruption(imgs[idx], aug, rand_ints[idx, p], [augs[i] for i in idx], noise_generator)
+                if corrupted is None:
+                    corrupted = imgs.new_empty((b,) + out.shape[1:])
+                assert out.shape[1:] == corrupted.shape[1:], "All images in a batch must remain the same size."
+                corrupted[idx] = out
+            imgs = corrupted
+        return imgs
+
+    # Applies one corruption to a batch of images. rand_ints holds the source of entropy for every image and
+    # applied_augmentations the full list of corruptions applied to every image, as in ImageCorruptor.apply_corruption().
+    def apply_corruption(self, img, aug, rand_ints, applied_augmentations, noise_generator=None):
+        b = img.shape[0]
+        rand_ints = rand_ints.to(torch.long)
+        if 'color_quantization' in aug:
+            quant_div = (2 ** ((rand_ints % 3) + 2)).to(img.device, img.dtype).view(b, 1, 1, 1)
+            img = torch.floor(img * 255 / quant_div) * quant_div / 255
+        elif 'gaussian_blur' in aug:
+            if aug == 'gaussian_blur_3':
+                kernels = torch.full((b,), 3, dtype=torch.long)
+            elif aug == 'gaussian_blur_5':
+                kernels = torch.full((b,), 5, dtype=torch.long)
+            else:
+                kernels = 2 * self.blur_scale * (rand_ints % 3) + 1
+            img = self._per_kernel_size(img, kernels, self._gaussian_kernel)
+        elif 'motion_blur' in aug:
+            intensities = self.blur_scale * (rand_ints % 3) + 1
+            angles = (rand_ints // 3) % 360
+            img = img.clone()
+            for intensity in intensities.unique().tolist():
+                sel = (intensities == intensity).nonzero().squeeze(1)
+                k = torch.stack([torch.from_numpy(_motion_blur_kernel(intensity, int(angles[s]))) for s in sel])
+                img[sel] = _filter2d(img[sel], k.to(img.device))
+        elif 'smooth_blur' in aug:
+            kernels = 2 * self.blur_scale * (rand_ints % 3) + 1
+            img = self._per_kernel_size(img, kernels, lambda k: torch.full((k, k), 1 / (k * k)))
+        elif 'block_noise' in aug:
+            pass
+        elif 'lq_resampling' in aug:
+            scale = 4 if 'lq_resampling4x' == aug else 2
+            # Note that ImageCorruptor hands the *index* into its list of four interpolation modes to cv2 as the
+            # interpolation flag, so the modes it actually uses are cv2 flags 0-3. Mirror that here.
+            interpolation_modes = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA]
+            modes = rand_ints % len(interpolation_modes)
+            h, w = img.shape[2] // scale, img.shape[3] // scale
+            lr = _resize(img, h, w, cv2.INTER_NEAREST)
+            out = img.new_empty((b, img.shape[1], h * scale, w * scale))
+            for mode in modes.unique().tolist():
+                sel = (modes == mode).nonzero().squeeze(1)
+                out[sel] = _resize(lr[sel], h * scale, w * scale, interpolation_modes[mode])
+            img = out
+        elif 'color_shift' in aug:
+            pass
+        elif 'interlacing' in aug:
+            pass
+        elif 'chromatic_aberration' in aug:
+            pass
+        elif 'noise' in aug:
+            if 'noise-5' == aug:
+                intensity = torch.full((b,), 5 / 255.0)
+            else:
+                intensity = (rand_ints % 4 + 2) / 255.0
+            noise = torch.randn(img.shape, device=img.device, generator=noise_generator)
+            img = img + noise * intensity.to(img.device, img.dtype).view(b, 1, 1, 1)
+        elif 'jpeg' in aug:
+            if aug not in JPEG_QUALITY_RANGES.keys():
+                raise NotImplementedError("specified jpeg corruption doesn't exist")
+            lo, span = JPEG_QUALITY_RANGES[aug]
+            apply = torch.tensor(['noise' not in a and 'noise-5' not in a for a in applied_augmentations])
+            if apply.any():
+                img = img.clone()
+                sel = apply.nonzero().squeeze(1)
+                img[sel] = _jpeg(img[sel], rand_ints[sel] % span + lo).to(img.dtype)
+        elif 'saturation' in aug:
+            saturation = ((rand_ints % 10).float() * .03).to(img.device, img.dtype).view(b, 1, 1, 1)
+            img = torch.clamp(img + saturation, 0, 1)
+        elif 'none' not in aug:
+            raise NotImplementedError("Augmentation doesn't exist")
+        return img
+
+    @staticmethod
+    def _gaussian_kernel(k):
+        g = torch.exp(-(torch.arange(k, dtype=torch.float64) - (k - 1) / 2) ** 2 / (2 * 3 ** 2))
+        g = g / g.sum()
+        return (g[:, None] * g[None, :]).float()
+
+    @staticmethod
+    def _per_kernel_size(img, sizes, kernel_fn):
+        img = img.clone()
+        for k in sizes.unique().tolist():
+            sel = (sizes == k).nonzero().squeeze(1)
+            kernel = kernel_fn(k).to(img.device)
+            img[sel] = _filter2d(img[sel], kernel.unsqueeze(0).expand(len(sel), k, k))
+        return img
@@ -11,6 +11,20 @@ from data import util
 # Builds a dataset created from a simple folder containing a list of training/test/validation images.
 from data.image_corruptor import ImageCorruptor
 from data.image_label_parser import VsNetImageLabeler
+from data.lmdb_image_store import LmdbImageStore, is_lmdb_dataset
+from data.path_index import RepeatedConcat, load_path_index
+
+
+def list_image_folder(root):
+    return [('', os.stat(root).st_mtime_ns)]
+
+
+def scan_image_folder(root, _):
+    supported_types = ['jpg', 'jpeg', 'png', 'gif']
+    imgs = []
+    for ext in supported_types:
+        imgs.extend(glob.glob(os.path.join(root, "*." + ext)))
+    return [os.path.relpath(i, root) for i in imgs]
 
 
 class ImageFolderDataset:
@@ -31,6 +45,8 @@ class ImageFolderDataset:
             self.weights = [1]
         else:
             self.weights = opt['weights']
+        # Paths can also point at LMDB datasets built by scripts/create_lmdb.py, which are read through these.
+        self.stores = [LmdbImageStore(path) for path in self.paths if is_lmdb_dataset(path)]
 
         if 'labeler' in opt.keys():
             if opt['labeler']['type'] == 'patch_labels':
@@ -40,26 +56,29 @@ class ImageFolderDataset:
         else:
             self.labeler = None
 
-            # Just scan the given directory for images of standard types.
-            supported_types = ['jpg', 'jpeg', 'png', 'gif']
-            self.image_paths = []
-            for path, weight in zip(self.paths, self.weights):
-                cache_path = os.path.join(path, 'cache.pth')
-                if os.path.exists(cache_path):
-                    imgs = torch.load(cache_path)
+            # Just scan the given directory for images of standard types. The listing is kept in a memory-mapped path
+            # index which is rebuilt whenever the directory is modified.
+            refresh = opt['refresh_path_index'] if 'refresh_path_index' in opt.keys() else True
+            indices = []
+            for path in self.paths:
+                if is_lmdb_dataset(path):
+                    # LMDB datasets are immutable and come with a prebuilt path index.
+                    indices.append(LmdbImageStore(path).path_index().all_paths())
                 else:
-                    print("Building image folder cache, this can take some time for large datasets..")
-                    imgs = []
-                    for ext in supported_types:
-                        imgs.extend(glob.glob(os.path.join(path, "*." + ext)))
-                    torch.save(imgs, cache_path)
-                for w in range(weight):
-                    self.image_paths.extend(imgs)
+                    indices.append(load_path_index(path, list_image_folder, scan_image_folder, refresh).all_paths())
+            # Weights repeat the paths virtually rather than physically duplicating the lists.
+            self.image_paths = RepeatedConcat(indices, self.weights)
         self.len = len(self.image_paths)
 
     def get_paths(self):
         return self.image_paths
 
+    def read_image(self, path):
+        for store in self.stores:
+            if store.contains(path):
+                return store.read_img(path, rgb=True)
+        return util.read_img(None, path, rgb=True)
+
     # Given an HQ square of arbitrary size, resizes it to specifications from opt.
     def resize_hq(self, imgs_hq):
         # Enforce size constraints
@@ -107,7 +126,7 @@ class ImageFolderDataset:
         return self.len
 
     def __getitem__(self, item):
-        hq = util.read_img(None, self.image_paths[item], rgb=True)
+        hq = self.read_image(self.image_paths[item])
         if self.labeler:
             assert hq.shape[0] == hq.shape[1]  # This just has not been accomodated yet.
             dim = hq.shape[0]
@@ -145,7 +164,7 @@ class ImageFolderDataset:
                     # When we're dealing with images in the 1M range, it's straight up faster to attempt to just open
                     # the file rather than searching the path list. Let the exception handler below do its work.
                     next_img = self.image_paths[item].replace(str(imnumber), str(imnumber+1))
-                    alt_hq = util.read_img(None, next_img, rgb=True)
+                    alt_hq = self.read_image(next_img)
                     alt_hq = self.resize_hq([alt_hq])
                     alt_hq = torch.from_numpy(np.ascontiguousarray(np.transpose(alt_hq[0], (2, 0, 1)))).float()
                     if not self.skip_lq:
@@ -0,0 +1,81 @@
+import io
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+from data import util
+from data.path_index import PathIndex
+
+# On-disk layout of an LMDB image dataset (built by scripts/create_lmdb.py):
+#   <root>/data.mdb, lock.mdb - An LMDB environment. Keys are the paths of the source files relative to the source root
+#                               (utf-8), values are the encoded file bytes exactly as they were on disk (or re-encoded by
+#                               the builder). Chunked datasets also store each chunk's ref.jpg and centers.pt this way.
+#   <root>/path_index          - A regular path index (see data/path_index.py) listing the images, grouped by directory.
+# Since the file bytes are stored as-is, a dataset reads the same pixels from the LMDB as from the source folder.
+LMDB_DATA_NAME = 'data.mdb'
+
+
+def is_lmdb_dataset(path):
+    return osp.exists(osp.join(path, LMDB_DATA_NAME))
+
+
+# Read-only environments, opened lazily, one per LMDB per process (LMDB refuses to open the same one twice in a process).
+_environments = {}
+_environments_pid = None
+
+
+def _environment(root):
+    global _environments_pid
+    if _environments_pid != os.getpid():
+        # Environments inherited through a fork must not be used by the child. Closing them only unmaps them from this
+        # process, after which every DataLoader worker opens its own.
+        for env in _environments.values():
+            env.close()
+        _environments.clear()
+        _environments_pid = os.getpid()
+    if root not in _environments.keys():
+        import lmdb
+        _environments[root] = lmdb.open(root, readonly=True, lock=False, readahead=False, meminit=False)
+    return _environments[root]
+
+
+# Read-only access to an LMDB image dataset. Cheap to create and to pickle; see _environment() for how the underlying
+# environment is shared.
+class LmdbImageStore:
+    def __init__(self, root):
+        self.root = osp.normpath(root)
+
+    def _env(self):
+        return _environment(self.root)
+
+    # Paths under root map onto keys, so datasets can keep handling full paths.
+    def key(self, path):
+        return osp.relpath(path, self.root).encode('utf-8')
+
+    def contains(self, path):
+        return path.startswith(self.root + os.sep)
+
+    # Returns the stored bytes for path, or None if there are none.
+    def read_bytes(self, path):
+        with self._env().begin(write=False, buffers=True) as txn:
+            buf = txn.get(self.key(path))
+            return None if buf is None else bytes(buf)
+
+    def exists(self, path):
+        with self._env().begin(write=False) as txn:
+            return txn.get(self.key(path)) is not None
+
+    # Equivalent of util.read_img(None, path, rgb=rgb).
+    def read_img(self, path, rgb=False):
+        buf = self.read_bytes(path)
+        if buf is None:
+            raise FileNotFoundError(path)
+        return util.read_img('buffer', np.frombuffer(buf, dtype=np.uint8), rgb=rgb)
+
+    def load_torch(self, path):
+        return torch.load(io.BytesIO(self.read_bytes(path)))
+
+    def path_index(self):
+        return PathIndex(self.root)
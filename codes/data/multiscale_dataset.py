@@ -1,4 +1,9 @@
+import json
+import os
+import os.path as osp
 import random
+from multiprocessing import Pool
+
 import numpy as np
 import cv2
 import torch
@@ -14,12 +19,13 @@ from data.image_corruptor import ImageCorruptor
 
 
 # Selects the smallest dimension from the image and crops it randomly so the other dimension matches. The cropping
-# offset from center is chosen on a normal probability curve.
-def get_square_image(image):
+# offset from center is chosen on a normal probability curve unless given.
+def get_square_image(image, offset=None):
     h, w, _ = image.shape
     if h == w:
         return image
-    offset = max(min(np.random.normal(scale=.3), 1.0), -1.0)
+    if offset is None:
+        offset = max(min(np.random.normal(scale=.3), 1.0), -1.0)
     if h > w:
         diff = h - w
         center = diff // 2
@@ -31,6 +37,112 @@ def get_square_image(image):
         left = max(int(center + offset * (center - 2)), 0)
         return image[:, left:left + h, :]
 
+def recursively_extract_patches(input_img, result_list, depth, tile_size, num_scales):
+    if depth >= num_scales:
+        return
+    patch_size = tile_size * 2 ** num_scales // (2 ** depth)
+    # First pull the four sub-patches. Important: if this is changed, be sure to edit build_multiscale_patch_index_map()
+    # and quadtree_paths() below.
+    patches = [input_img[:patch_size, :patch_size],
+               input_img[:patch_size, patch_size:],
+               input_img[patch_size:, :patch_size],
+               input_img[patch_size:, patch_size:]]
+    result_list.extend([cv2.resize(p, (tile_size, tile_size), interpolation=cv2.INTER_AREA) for p in patches])
+    for p in patches:
+        recursively_extract_patches(p, result_list, depth+1, tile_size, num_scales)
+
+
+# Returns the whole quadtree of tiles of a square image of size tile_size * 2 ** num_scales.
+def extract_pyramid(img_full, tile_size, num_scales):
+    patches = [cv2.resize(img_full, (tile_size, tile_size), interpolation=cv2.INTER_AREA)]
+    recursively_extract_patches(img_full, patches, 1, tile_size, num_scales)
+    return patches
+
+
+# The position of every tile returned by extract_pyramid(), as the sequence of quadrants (0=top left, 1=top right,
+# 2=bottom left, 3=bottom right) leading to it from the whole image.
+def quadtree_paths(num_scales):
+    paths = [()]
+
+    def visit(prefix, depth):
+        if depth >= num_scales:
+            return
+        children = [prefix + (q,) for q in range(4)]
+        paths.extend(children)
+        for c in children:
+            visit(c, depth+1)
+    visit((), 1)
+    return paths
+
+
+# Which quadrant each quadrant ends up in when the image is flipped horizontally, vertically or transposed, as in
+# util.augment(). These are their own inverses.
+HFLIP_QUADRANTS = [1, 0, 3, 2]
+VFLIP_QUADRANTS = [2, 3, 0, 1]
+TRANSPOSE_QUADRANTS = [0, 2, 1, 3]
+
+
+# Tile indices that reorder a pyramid into the pyramid of the flipped/transposed image.
+def quadtree_permutation(paths, quadrant_map):
+    index = {p: i for i, p in enumerate(paths)}
+    return np.array([index[tuple(quadrant_map[q] for q in p)] for p in paths])
+
+
+# Offline pyramid cache, built by scripts/create_multiscale_pyramids.py. For every image, the deterministic part of
+# MultiScaleDataset.__getitem__() is run once: the image is center-cropped to a square, resized to hq_size_cap and its
+# clean quadtree of tiles is extracted. Both are stored as uint8 in memory-mapped arrays:
+#   <cache>/full.npy  - (images, hq_size_cap, hq_size_cap, 3), needed to compute the corrupted pyramid.
+#   <cache>/tiles.npy - (images, tiles, hq_tile_size, hq_tile_size, 3)
+#   <cache>/meta.json - hq_tile_size, num_scales and the source paths.
+PYRAMID_FULL_NAME = 'full.npy'
+PYRAMID_TILES_NAME = 'tiles.npy'
+PYRAMID_META_NAME = 'meta.json'
+
+
+def to_uint8(img):
+    return np.clip(np.round(img * 255), 0, 255).astype(np.uint8)
+
+
+def load_square_image(path, size, offset=None):
+    loaded_img = util.read_img(None, path, None)
+    img = util.channel_convert(loaded_img.shape[2], 'RGB', [loaded_img])[0]
+    return cv2.resize(get_square_image(img, offset), (size, size), interpolation=cv2.INTER_AREA)
+
+
+def _build_pyramid_worker(args):
+    path, tile_size, num_scales = args
+    img_full = load_square_image(path, tile_size * 2 ** num_scales, offset=0)
+    return to_uint8(img_full), to_uint8(np.stack(extract_pyramid(img_full, tile_size, num_scales)))
+
+
+def build_pyramid_cache(paths, cache_path, tile_size, num_scales, n_workers=4):
+    os.makedirs(cache_path, exist_ok=True)
+    cap = tile_size * 2 ** num_scales
+    full = np.lib.format.open_memmap(osp.join(cache_path, PYRAMID_FULL_NAME), mode='w+', dtype=np.uint8,
+                                     shape=(len(paths), cap, cap, 3))
+    tiles = np.lib.format.open_memmap(osp.join(cache_path, PYRAMID_TILES_NAME), mode='w+', dtype=np.uint8,
+                                      shape=(len(paths), len(quadtree_paths(num_scales)), tile_size, tile_size, 3))
+    with Pool(n_workers) as pool:
+        for i, (f, t) in enumerate(pool.imap(_build_pyramid_worker, [(p, tile_size, num_scales) for p in paths],
+                                              chunksize=4)):
+            full[i] = f
+            tiles[i] = t
+            if i % 100 == 0:
+                print("Built pyramids for %i/%i images." % (i, len(paths)))
+    full.flush()
+    tiles.flush()
+    del full, tiles
+    # Written last, so that an interrupted build is not mistaken for a complete one.
+    with open(osp.join(cache_path, PYRAMID_META_NAME), 'w') as f:
+        json.dump({'hq_tile_size': tile_size, 'num_scales': num_scales, 'paths': list(paths)}, f)
+
+
+# Options:
+#   paths: Folders of full-quality images.
+#   hq_tile_size, num_scales, scale: See the README.
+#   pyramid_cache: Optional folder built by scripts/create_multiscale_pyramids.py. When given, the images and their clean
+#                  pyramids are served from it and only the corrupted pyramid is computed per sample. Since the cache
+#                  was built from center crops, the random crop offset of get_square_image() is not applied.
 class MultiScaleDataset(data.Dataset):
     def __init__(self, opt):
         super(MultiScaleDataset, self).__init__()
@@ -40,42 +152,57 @@ class MultiScaleDataset(data.Dataset):
         self.num_scales = self.opt['num_scales']
         self.hq_size_cap = self.tile_size * 2 ** self.num_scales
         self.scale = self.opt['scale']
-        self.paths_hq, self.sizes_hq = util.get_image_paths(self.data_type, opt['paths'], [1 for _ in opt['paths']])
         self.corruptor = ImageCorruptor(opt)
-
+        self.pyramid_cache = opt['pyramid_cache'] if 'pyramid_cache' in opt.keys() else None
+        if self.pyramid_cache is not None:
+            with open(osp.join(self.pyramid_cache, PYRAMID_META_NAME), 'r') as f:
+                meta = json.load(f)
+            assert meta['hq_tile_size'] == self.tile_size and meta['num_scales'] == self.num_scales, \
+                "Pyramid cache %s was built for different hq_tile_size/num_scales." % (self.pyramid_cache,)
+            self.paths_hq = meta['paths']
+            tree = quadtree_paths(self.num_scales)
+            self.tile_permutations = [quadtree_permutation(tree, m) for m in
+                                      [HFLIP_QUADRANTS, VFLIP_QUADRANTS, TRANSPOSE_QUADRANTS]]
+            # Opened lazily, so that every DataLoader worker maps the files itself.
+            self.cached_full, self.cached_tiles = None, None
+        else:
+            self.paths_hq, self.sizes_hq = util.get_image_paths(self.data_type, opt['paths'], [1 for _ in opt['paths']])
 
     def recursively_extract_patches(self, input_img, result_list, depth):
-        if depth >= self.num_scales:
-            return
-        patch_size = self.hq_size_cap // (2 ** depth)
-        # First pull the four sub-patches. Important: if this is changed, be sure to edit build_multiscale_patch_index_map() below.
-        patches = [input_img[:patch_size, :patch_size],
-                   input_img[:patch_size, patch_size:],
-                   input_img[patch_size:, :patch_size],
-                   input_img[patch_size:, patch_size:]]
-        result_list.extend([cv2.resize(p, (self.tile_size, self.tile_size), interpolation=cv2.INTER_AREA) for p in patches])
-        for p in patches:
-            self.recursively_extract_patches(p, result_list, depth+1)
+        recursively_extract_patches(input_img, result_list, depth, self.tile_size, self.num_scales)
+
+    # Returns the full image and its clean pyramid from the cache, with the same random flips util.augment() applies.
+    # Flipping the image permutes the tiles of its pyramid and flips each of them.
+    def load_cached_pyramid(self, index):
+        if self.cached_full is None:
+            self.cached_full = np.load(osp.join(self.pyramid_cache, PYRAMID_FULL_NAME), mmap_mode='r')
+            self.cached_tiles = np.load(osp.join(self.pyramid_cache, PYRAMID_TILES_NAME), mmap_mode='r')
+        img_full = self.cached_full[index].astype(np.float32) / 255.
+        tiles = self.cached_tiles[index].astype(np.float32) / 255.
+        hflip = random.random() < 0.5
+        vflip = random.random() < 0.5
+        rot90 = random.random() < 0.5
+        if hflip:
+            img_full = img_full[:, ::-1]
+            tiles = tiles[self.tile_permutations[0]][:, :, ::-1]
+        if vflip:
+            img_full = img_full[::-1]
+            tiles = tiles[self.tile_permutations[1]][:, ::-1]
+        if rot90:
+            img_full = img_full.transpose(1, 0, 2)
+            tiles = tiles[self.tile_permutations[2]].transpose(0, 2, 1, 3)
+        return np.ascontiguousarray(img_full), list(np.ascontiguousarray(tiles))
 
     def __getitem__(self, index):
         # get full size image
         full_path = self.paths_hq[index % len(self.paths_hq)]
-        loaded_img = util.read_img(None, full_path, None)
-        img_full1 = util.channel_convert(loaded_img.shape[2], 'RGB', [loaded_img])[0]
-        img_full2 = util.augment([img_full1], True, True)[0]
-        img_full3 = get_square_image(img_full2)
-        # This error crops up from time to time. I suspect an issue with util.read_img.
-        if img_full3.shape[0] == 0 or img_full3.shape[1] == 0:
-            print("Error with image: %s. Loaded image shape: %s" % (full_path,str(loaded_img.shape)), str(img_full1.shape), str(img_full2.shape), str(img_full3.shape))
-            # Attempt to recover by just using a fixed array of zeros, which the downstream networks should be fine training against, within reason.
-            img_full3 = np.zeros((1024,1024,3), dtype=np.int)
-        img_full = cv2.resize(img_full3, (self.hq_size_cap, self.hq_size_cap), interpolation=cv2.INTER_AREA)
-        patches_hq = [cv2.resize(img_full, (self.tile_size, self.tile_size), interpolation=cv2.INTER_AREA)]
-        self.recursively_extract_patches(img_full, patches_hq, 1)
+        if self.pyramid_cache is not None:
+            img_full, patches_hq = self.load_cached_pyramid(index % len(self.paths_hq))
+        else:
+            img_full, patches_hq = self.build_clean_pyramid(full_path)
         # Image corruption is applied against the full size image for this dataset.
         img_corrupted = self.corruptor.corrupt_images([img_full])[0]
-        patches_hq_corrupted = [cv2.resize(img_corrupted, (self.tile_size, self.tile_size), interpolation=cv2.INTER_AREA)]
-        self.recursively_extract_patches(img_corrupted, patches_hq_corrupted, 1)
+        patches_hq_corrupted = extract_pyramid(img_corrupted, self.tile_size, self.num_scales)
 
         # BGR to RGB, HWC to CHW, numpy to tensor
         if patches_hq[0].shape[2] == 3:
@@ -90,6 +217,19 @@ class MultiScaleDataset(data.Dataset):
         d = {'lq': patches_lq, 'hq': patches_hq, 'GT_path': full_path}
         return d
 
+    def build_clean_pyramid(self, full_path):
+        loaded_img = util.read_img(None, full_path, None)
+        img_full1 = util.channel_convert(loaded_img.shape[2], 'RGB', [loaded_img])[0]
+        img_full2 = util.augment([img_full1], True, True)[0]
+        img_full3 = get_square_image(img_full2)
+        # This error crops up from time to time. I suspect an issue with util.read_img.
+        if img_full3.shape[0] == 0 or img_full3.shape[1] == 0:
+            print("Error with image: %s. Loaded image shape: %s" % (full_path,str(loaded_img.shape)), str(img_full1.shape), str(img_full2.shape), str(img_full3.shape))
+            # Attempt to recover by just using a fixed array of zeros, which the downstream networks should be fine training against, within reason.
+            img_full3 = np.zeros((1024,1024,3), dtype=np.int)
+        img_full = cv2.resize(img_full3, (self.hq_size_cap, self.hq_size_cap), interpolation=cv2.INTER_AREA)
+        return img_full, extract_pyramid(img_full, self.tile_size, self.num_scales)
+
     def __len__(self):
         return len(self.paths_hq)
 
@@ -0,0 +1,194 @@
+import os
+import os.path as osp
+from bisect import bisect_right
+import numpy as np
+import torch.distributed as dist
+
+# A compact, memory-mapped replacement for the pickled path lists the datasets used to keep in cache.pth.
+#
+# Paths are grouped by the directory that was scanned to find them. Every path (relative to the dataset root) is stored
+# utf-8 encoded in one contiguous byte table with an offset array pointing into it, and is only decoded to a str when it
+# is accessed. Since the arrays are memory-mapped, DataLoader workers share the same pages rather than each holding its
+# own copy of millions of python strings. The mtime of every group directory is recorded so that a refresh only needs
+# to rescan the directories that changed.
+PATH_INDEX_DIR = 'path_index'
+
+
+def _pack_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class PathIndexView:
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, end, step = item.indices(len(self))
+            assert step == 1
+            return PathIndexView(self.index, self.start + start, self.start + max(start, end))
+        item = int(item)
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError(item)
+        return self.index.path(self.start + item)
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.index.path(i)
+
+
+class PathIndex:
+    def __init__(self, root):
+        self._load(root)
+
+    def _load(self, root):
+        self.root = root
+        folder = osp.join(root, PATH_INDEX_DIR)
+        self.strings = np.load(osp.join(folder, 'strings.npy'), mmap_mode='r')
+        self.offsets = np.load(osp.join(folder, 'offsets.npy'), mmap_mode='r')
+        self.group_strings = np.load(osp.join(folder, 'group_strings.npy'), mmap_mode='r')
+        self.group_offsets = np.load(osp.join(folder, 'group_offsets.npy'), mmap_mode='r')
+        self.group_starts = np.load(osp.join(folder, 'group_starts.npy'), mmap_mode='r')
+        self.group_mtimes = np.load(osp.join(folder, 'group_mtimes.npy'), mmap_mode='r')
+
+    # Re-open the memory maps when unpickled (e.g. in spawned DataLoader workers) rather than copying the arrays.
+    def __getstate__(self):
+        return {'root': self.root}
+
+    def __setstate__(self, state):
+        self._load(state['root'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def num_groups(self):
+        return len(self.group_mtimes)
+
+    def relative_path(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def path(self, i):
+        return osp.join(self.root, self.relative_path(i))
+
+    def group_name(self, g):
+        return self.group_strings[self.group_offsets[g]:self.group_offsets[g+1]].tobytes().decode('utf-8')
+
+    def group(self, g):
+        return PathIndexView(self, int(self.group_starts[g]), int(self.group_starts[g+1]))
+
+    def all_paths(self):
+        return PathIndexView(self, 0, len(self))
+
+
+def _write_path_index(root, groups):
+    folder = osp.join(root, PATH_INDEX_DIR)
+    paths = [p for _, _, entries in groups for p in entries]
+    strings, offsets = _pack_strings(paths)
+    group_strings, group_offsets = _pack_strings([name for name, _, _ in groups])
+    group_starts = np.zeros(len(groups) + 1, dtype=np.int64)
+    if groups:
+        group_starts[1:] = np.cumsum([len(entries) for _, _, entries in groups])
+    arrays = [('strings', strings), ('offsets', offsets), ('group_strings', group_strings),
+              ('group_offsets', group_offsets), ('group_starts', group_starts),
+              ('group_mtimes', np.asarray([m for _, m, _ in groups], dtype=np.int64))]
+    # Files are swapped in place inside the index folder (rather than replacing the folder) so that the modification
+    # time of the dataset root is not touched. group_mtimes goes last since its presence marks a complete index.
+    # Temporary files are named per process, so concurrent writers can't replace each other's partial files.
+    tmp_name = lambda name: osp.join(folder, '%s.%d.tmp.npy' % (name, os.getpid()))
+    for name, array in arrays:
+        np.save(tmp_name(name), array)
+    for name, _ in arrays:
+        os.replace(tmp_name(name), osp.join(folder, name + '.npy'))
+
+
+# Loads the path index for root, building or refreshing it first if needed.
+#   list_groups(root) returns a list of (group_name, mtime_ns) for every directory that should be indexed.
+#   scan_group(root, group_name) returns the paths (relative to root) found in that directory.
+# When refresh=False, an existing index is trusted as-is without touching the file system.
+# Under distributed training, rank 0 builds or refreshes the index while the other ranks wait, then load it as-is.
+def load_path_index(root, list_groups, scan_group, refresh=True):
+    if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+        return _load_path_index(root, list_groups, scan_group, refresh)
+    if dist.get_rank() == 0:
+        index = _load_path_index(root, list_groups, scan_group, refresh)
+        dist.barrier()
+        return index
+    dist.barrier()
+    return PathIndex(root)
+
+
+def _load_path_index(root, list_groups, scan_group, refresh):
+    existing = None
+    if osp.exists(osp.join(root, PATH_INDEX_DIR, 'group_mtimes.npy')):
+        existing = PathIndex(root)
+        if not refresh:
+            return existing
+
+    # Create the index folder before listing, since doing so modifies the root directory.
+    os.makedirs(osp.join(root, PATH_INDEX_DIR), exist_ok=True)
+    current = list_groups(root)
+    known = {}
+    if existing is not None:
+        for g in range(existing.num_groups()):
+            known[existing.group_name(g)] = (int(existing.group_mtimes[g]), g)
+        if len(known) == len(current) and \
+                all(name in known.keys() and known[name][0] == mtime for name, mtime in current):
+            return existing
+        print("Refreshing path index, only modified directories will be rescanned..")
+    else:
+        print("Building path index, this can take some time for large datasets..")
+
+    groups = []
+    for name, mtime in current:
+        if name in known.keys() and known[name][0] == mtime:
+            view = existing.group(known[name][1])
+            entries = [existing.relative_path(i) for i in range(view.start, view.end)]
+        else:
+            entries = scan_group(root, name)
+        groups.append((name, mtime, entries))
+    existing = view = None  # Release the memory maps before the files underneath them are replaced.
+    _write_path_index(root, groups)
+    return PathIndex(root)
+
+
+# Sequence that behaves like the concatenation of each of seqs repeated weights[i] times, without copying anything.
+class RepeatedConcat:
+    def __init__(self, seqs, weights):
+        self.seqs = []
+        self.starts = []
+        start = 0
+        for seq, weight in zip(seqs, weights):
+            if len(seq) == 0 or weight == 0:
+                continue
+            self.seqs.append(seq)
+            self.starts.append(start)
+            start += len(seq) * weight
+        self.len = start
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, item):
+        item = int(item)
+        if item < 0:
+            item += self.len
+        if item < 0 or item >= self.len:
+            raise IndexError(item)
+        s = bisect_right(self.starts, item) - 1
+        seq = self.seqs[s]
+        return seq[(item - self.starts[s]) % len(seq)]
+
+    def __iter__(self):
+        for i in range(self.len):
+            yield self[i]
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.linalg
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -11,20 +12,76 @@ class InvertibleConv1x1(nn.Module):
         super().__init__()
         w_shape = [num_channels, num_channels]
         w_init = np.linalg.qr(np.random.randn(*w_shape))[0].astype(np.float32)
-        self.register_parameter("weight", nn.Parameter(torch.Tensor(w_init)))
         self.w_shape = w_shape
         self.LU = LU_decomposed
+        if not LU_decomposed:
+            self.register_parameter("weight", nn.Parameter(torch.Tensor(w_init)))
+        else:
+            # W = P @ L @ (U + diag(sign_s * exp(log_s))), with L unit lower triangular and U strictly upper triangular.
+            # log|det W| is then just sum(log_s). P and sign_s stay fixed.
+            p, lower, upper, sign_s, log_s = self.lu_decompose(w_init)
+            self.register_buffer("p", p)
+            self.register_buffer("sign_s", sign_s)
+            self.register_parameter("lower", nn.Parameter(lower))
+            self.register_parameter("upper", nn.Parameter(upper))
+            self.register_parameter("log_s", nn.Parameter(log_s))
+        # (weight, log-det per pixel) for each direction, keyed by the state of the parameters. See get_weight().
+        self.inference_cache = {}
+
+    @staticmethod
+    def lu_decompose(w):
+        np_p, np_l, np_u = scipy.linalg.lu(w)
+        np_s = np.diag(np_u)
+        tensor = lambda a: torch.tensor(a.astype(np.float32))
+        return tensor(np_p), tensor(np.tril(np_l, -1)), tensor(np.triu(np_u, 1)), tensor(np.sign(np_s)), \
+               tensor(np.log(np.abs(np_s)))
 
+    # Lets LU-decomposed modules load state dicts saved from the plain parameterization.
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.LU and prefix + 'weight' in state_dict.keys() and prefix + 'lower' not in state_dict.keys():
+            weight = state_dict.pop(prefix + 'weight')
+            p, lower, upper, sign_s, log_s = self.lu_decompose(weight.cpu().double().numpy())
+            state_dict.update({prefix + 'p': p, prefix + 'lower': lower, prefix + 'upper': upper,
+                               prefix + 'sign_s': sign_s, prefix + 'log_s': log_s})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # Returns the (reverse) weight and its log-det per pixel.
+    def compute_weight(self, reverse):
+        if not self.LU:
+            logdet = torch.slogdet(self.weight)[1]
+            if not reverse:
+                weight = self.weight
+            else:
+                weight = torch.inverse(self.weight.double()).float()
+        else:
+            eye = torch.eye(self.w_shape[0], device=self.log_s.device)
+            l = torch.tril(self.lower, -1) + eye
+            u = torch.triu(self.upper, 1) + torch.diag(self.sign_s * torch.exp(self.log_s))
+            logdet = thops.sum(self.log_s)
+            if not reverse:
+                weight = torch.matmul(self.p, torch.matmul(l, u))
+            else:
+                # P is a permutation, so its inverse is its transpose.
+                l = torch.inverse(l.double()).float()
+                u = torch.inverse(u.double()).float()
+                weight = torch.matmul(u, torch.matmul(l, self.p.t()))
+        return weight.view(self.w_shape[0], self.w_shape[1], 1, 1), logdet
+
+    # Outside of autograd (evaluation, reverse sampling), the weight and log-det are cached per direction until any
+    # parameter or buffer changes: optimizer steps and load_state_dict() bump the tensors' version counters, moving the
+    # module changes their storage. This saves the inverse and slogdet of every flow step on repeated passes, e.g. when
+    # sampling at several temperatures.
     def get_weight(self, input, reverse):
-        w_shape = self.w_shape
         pixels = thops.pixels(input)
-        dlogdet = torch.slogdet(self.weight)[1] * pixels
-        if not reverse:
-            weight = self.weight.view(w_shape[0], w_shape[1], 1, 1)
+        if torch.is_grad_enabled():
+            weight, logdet = self.compute_weight(reverse)
         else:
-            weight = torch.inverse(self.weight.double()).float() \
-                .view(w_shape[0], w_shape[1], 1, 1)
-        return weight, dlogdet
+            key = tuple((t.data_ptr(), t._version) for t in list(self.parameters()) + list(self.buffers()))
+            if reverse not in self.inference_cache.keys() or self.inference_cache[reverse][0] != key:
+                self.inference_cache[reverse] = (key,) + self.compute_weight(reverse)
+            _, weight, logdet = self.inference_cache[reverse]
+        return weight, logdet * pixels
+
     def forward(self, input, logdet=None, reverse=False):
         """
         log-det = log|abs(|W|)| * pixels
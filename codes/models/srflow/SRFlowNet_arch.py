@@ -33,7 +33,9 @@ class SRFlowNet(nn.Module):
         self.patch_sz = opt_get(self.opt, ['networks', 'generator', 'flow', 'patch_size'], 160)
         self.flowUpsamplerNet = \
             FlowUpsamplerNet((self.patch_sz, self.patch_sz, 3), hidden_channels, K,
-                             flow_coupling=opt['networks']['generator']['flow']['coupling'], opt=opt)
+                             flow_coupling=opt['networks']['generator']['flow']['coupling'],
+                             LU_decomposed=opt_get(self.opt, ['networks', 'generator', 'flow', 'LU_decomposed'], False),
+                             opt=opt)
         self.i = 0
         self.dbg_logp = 0
         self.dbg_logdet = 0
@@ -2,7 +2,9 @@ import argparse
 import logging
 import os
 import os.path as osp
+import queue
 import subprocess
+import threading
 import time
 
 import torch
@@ -13,10 +15,112 @@ from tqdm import tqdm
 
 from trainer.ExtensibleTrainer import ExtensibleTrainer
 from utils import options as option
+from utils.self_ensemble import SelfEnsemble
+from utils.tiled_inference import TiledInference
 import utils.util as util
 from data import create_dataloader
 
 
+def build_video_sample(img_LQ, force_multiple, vertical_splits):
+    mask = torch.ones(1, img_LQ.shape[1], img_LQ.shape[2])
+    ref = torch.cat([img_LQ, mask], dim=0)
+
+    if force_multiple > 1:
+        assert vertical_splits <= 1   # This is not compatible with vertical splits for now.
+        c, h, w = img_LQ.shape
+        h_, w_ = h, w
+        height_removed = h % force_multiple
+        width_removed = w % force_multiple
+        if height_removed != 0:
+            h_ = force_multiple * ((h // force_multiple) + 1)
+        if width_removed != 0:
+            w_ = force_multiple * ((w // force_multiple) + 1)
+        lq_template = torch.zeros(c,h_,w_)
+        lq_template[:,:h,:w] = img_LQ
+        ref_template = torch.zeros(c,h_,w_)
+        ref_template[:,:h,:w] = img_LQ
+        img_LQ = lq_template
+        ref = ref_template
+
+    return {'lq': img_LQ, 'lq_fullsize_ref': ref,
+            'lq_center': torch.tensor([img_LQ.shape[1] // 2, img_LQ.shape[2] // 2], dtype=torch.long) }
+
+
+def get_video_size(video):
+    probe_args = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height',
+                  '-of', 'csv=p=0:s=x', video]
+    w, h = subprocess.check_output(probe_args).decode('utf-8').strip().split('x')[:2]
+    return int(w), int(h)
+
+
+class FfmpegStreamingVideoReader:
+    '''Decodes a video with a single long-lived FFMPEG process that pipes raw RGB frames into a reusable buffer and
+    yields collated batches, rather than spawning FFMPEG and round-tripping a PNG through the disk for every frame.
+    Takes the same options as FfmpegBackedVideoDataset.'''
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.video = self.opt['video_file']
+        self.frame_rate = self.opt['frame_rate']
+        self.start_at = self.opt['start_at_seconds']
+        self.end_at = self.opt['end_at_seconds']
+        self.force_multiple = self.opt['force_multiple']
+        self.frame_count = (self.end_at - self.start_at) * self.frame_rate
+        self.batch_size = self.opt['batch_size'] or 1
+        self.vertical_splits = self.opt['vertical_splits'] if 'vertical_splits' in opt.keys() else 1
+        self.width, self.height = get_video_size(self.video)
+        self.frame_buffer = torch.empty((self.height, self.width, 3), dtype=torch.uint8)
+        if torch.cuda.is_available():
+            self.frame_buffer = self.frame_buffer.pin_memory()
+
+    def __len__(self):
+        images = self.frame_count * max(self.vertical_splits, 1)
+        return (images + self.batch_size - 1) // self.batch_size
+
+    # Fills the frame buffer with the next frame from the pipe. Returns False once the stream is exhausted.
+    def read_frame(self, pipe):
+        view = memoryview(self.frame_buffer.numpy()).cast('B')
+        read = 0
+        while read < len(view):
+            n = pipe.readinto(view[read:])
+            if not n:
+                return False
+            read += n
+        return True
+
+    def frames(self):
+        # The seek is only performed once, for the whole stream.
+        ffmpeg_args = ['ffmpeg', '-ss', str(self.start_at), '-i', self.video, '-t', str(self.end_at - self.start_at),
+                       '-r', str(self.frame_rate), '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+        process = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   bufsize=self.width * self.height * 3)
+        try:
+            for _ in range(self.frame_count):
+                if not self.read_frame(process.stdout):
+                    break
+                yield self.frame_buffer.permute(2, 0, 1).float() / 255
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+    def __iter__(self):
+        batch = []
+        for frame in self.frames():
+            if self.vertical_splits > 0:
+                w_per_split = int(self.width / self.vertical_splits)
+                images = [frame[:, :, w_per_split * i:w_per_split * (i + 1)] for i in range(self.vertical_splits)]
+            else:
+                images = [frame]
+            for img_LQ in images:
+                batch.append(build_video_sample(img_LQ, self.force_multiple, self.vertical_splits))
+                if len(batch) == self.batch_size:
+                    yield data.dataloader.default_collate(batch)
+                    batch = []
+        if batch:
+            yield data.dataloader.default_collate(batch)
+
+
 class FfmpegBackedVideoDataset(data.Dataset):
     '''Pulls frames from a video one at a time using FFMPEG.'''
 
@@ -67,51 +171,103 @@ class FfmpegBackedVideoDataset(data.Dataset):
             left = w_per_split * split_index
             img_LQ = F.crop(img_LQ, 0, left, h, w_per_split)
         img_LQ = F.to_tensor(img_LQ)
-
-        mask = torch.ones(1, img_LQ.shape[1], img_LQ.shape[2])
-        ref = torch.cat([img_LQ, mask], dim=0)
-
-        if self.force_multiple > 1:
-            assert self.vertical_splits <= 1   # This is not compatible with vertical splits for now.
-            c, h, w = img_LQ.shape
-            h_, w_ = h, w
-            height_removed = h % self.force_multiple
-            width_removed = w % self.force_multiple
-            if height_removed != 0:
-                h_ = self.force_multiple * ((h // self.force_multiple) + 1)
-            if width_removed != 0:
-                w_ = self.force_multiple * ((w // self.force_multiple) + 1)
-            lq_template = torch.zeros(c,h_,w_)
-            lq_template[:,:h,:w] = img_LQ
-            ref_template = torch.zeros(c,h_,w_)
-            ref_template[:,:h,:w] = img_LQ
-            img_LQ = lq_template
-            ref = ref_template
-
-        return {'lq': img_LQ, 'lq_fullsize_ref': ref,
-                'lq_center': torch.tensor([img_LQ.shape[1] // 2, img_LQ.shape[2] // 2], dtype=torch.long) }
+        return build_video_sample(img_LQ, self.force_multiple, self.vertical_splits)
 
     def __len__(self):
         return self.frame_count * self.vertical_splits
 
-def merge_images(files, output_path):
-    """Merges several image files together across the vertical axis
-    """
-    images = [Image.open(f) for f in files]
-    w, h = images[0].size
-
-    result_width = w * len(images)
-    result_height = h
+class FfmpegStreamingVideoWriter:
+    '''Encodes generated frames into a series of mini videos by streaming raw RGB frames into the stdin of a persistent
+    FFMPEG process. Frames are converted to uint8 on the device and copied to the host asynchronously, then handed to a
+    background thread through a bounded queue, so inference on the next batch overlaps with the copy and the encode.
+    Images belonging to the same frame (vertical_splits) are stitched together in memory.'''
+
+    def __init__(self, output_folder, frame_rate, crf, frames_per_vid, vid_counter=0, vertical_splits=1, queue_size=8):
+        self.output_folder = output_folder
+        self.frame_rate = frame_rate
+        self.crf = crf
+        self.vertical_splits = max(vertical_splits, 1)
+        # frames_per_vid counts images, like the rest of process_video.py. Stitched frames per video is smaller.
+        self.frames_per_vid = frames_per_vid // self.vertical_splits
+        self.vid_counter = vid_counter
+        self.process = None
+        self.frames_in_vid = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.encode_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, visuals):
+        if self.error is not None:
+            raise self.error
+        frames = (visuals.detach().float().clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+        if frames.is_cuda:
+            host = torch.empty(frames.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(frames, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            host, copied = frames, None
+        self.queue.put((host, copied))
+
+    def start_video(self, h, w):
+        print("Encoding minivid %d.." % (self.vid_counter,))
+        cmd = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (w, h),
+               '-framerate', str(self.frame_rate), '-i', 'pipe:0', '-c:v', 'libx265', '-crf', str(self.crf),
+               '-preset', 'slow', '-pix_fmt', 'yuv444p', osp.join(self.output_folder, "mini_%06d.mkv" % (self.vid_counter,))]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def finish_video(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        self.process.wait()
+        self.process = None
+        self.frames_in_vid = 0
+        self.vid_counter += 1
+
+    def write_frame(self, frame):
+        if self.process is None:
+            self.start_video(frame.shape[0], frame.shape[1])
+        self.process.stdin.write(frame.numpy().data)
+        self.frames_in_vid += 1
+        if self.frames_in_vid == self.frames_per_vid:
+            self.finish_video()
+
+    def encode_loop(self):
+        splits = []
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                host, copied = item
+                if copied is not None:
+                    copied.synchronize()
+                for img in host:
+                    splits.append(img)
+                    if len(splits) == self.vertical_splits:
+                        self.write_frame(torch.cat(splits, dim=1) if len(splits) > 1 else splits[0])
+                        splits = []
+            # Whatever is left over goes into a final, shorter mini video.
+            self.finish_video()
+        except Exception as e:
+            self.error = e
+            # Keep consuming so submit() and close() never block on a full queue.
+            while self.queue.get() is not None:
+                pass
+
+    # Flushes all outstanding frames and waits for the final encode to complete.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
-    result = Image.new('RGB', (result_width, result_height))
-    for i in range(len(images)):
-        result.paste(im=images[i], box=(i * w, 0))
-    result.save(output_path)
 
 if __name__ == "__main__":
     #### options
     torch.backends.cudnn.benchmark = True
-    want_just_images = True
     parser = argparse.ArgumentParser()
     parser.add_argument('-opt', type=str, help='Path to options YMAL file.', default='../options/use_video_upsample.yml')
     opt = option.parse(parser.parse_args().opt, is_train=False)
@@ -129,34 +285,46 @@ if __name__ == "__main__":
     #### Create test dataset and dataloader
     test_loaders = []
 
-    test_set = FfmpegBackedVideoDataset(opt['dataset'], opt['path']['results_root'])
-    test_loader = create_dataloader(test_set, opt['dataset'])
-    logger.info('Number of test images in [{:s}]: {:d}'.format(opt['dataset']['name'], len(test_set)))
+    # 'stream' decodes the whole video with one FFMPEG process, 'frame' extracts each frame with its own process.
+    decoder = opt['dataset']['decoder'] or 'stream'
+    if decoder == 'stream':
+        test_loader = FfmpegStreamingVideoReader(opt['dataset'])
+    else:
+        test_set = FfmpegBackedVideoDataset(opt['dataset'], opt['path']['results_root'])
+        test_loader = create_dataloader(test_set, opt['dataset'])
+        logger.info('Number of test images in [{:s}]: {:d}'.format(opt['dataset']['name'], len(test_set)))
     test_loaders.append(test_loader)
 
     model = ExtensibleTrainer(opt)
-    test_set_name = test_loader.dataset.opt['name']
+    test_set_name = opt['dataset']['name']
     logger.info('\nTesting [{:s}]...'.format(test_set_name))
     test_start_time = time.time()
     dataset_dir = osp.join(opt['path']['results_root'], test_set_name)
     util.mkdir(dataset_dir)
 
-    frame_counter = 0
     frames_per_vid = opt['frames_per_mini_vid']
     minivid_crf = opt['minivid_crf']
     vid_output = opt['mini_vid_output_folder'] if 'mini_vid_output_folder' in opt.keys() else dataset_dir
     vid_counter = opt['minivid_start_no'] if 'minivid_start_no' in opt.keys() else 0
+    num_splits = opt['dataset']['vertical_splits'] if 'vertical_splits' in opt['dataset'].keys() else 1
+    video_writer = FfmpegStreamingVideoWriter(vid_output, opt['dataset']['frame_rate'], minivid_crf, frames_per_vid,
+                                              vid_counter, num_splits, opt['encode_queue_size'] or 8)
     img_index = opt['generator_img_index']
     recurrent_mode = opt['recurrent_mode']
     if recurrent_mode:
         assert opt['dataset']['batch_size'] == 1   # Can only do 1 frame at a time in recurrent mode, by definition.
     scale = opt['scale']
     first_frame = True
-    ffmpeg_proc = None
+    # Tiled inference and self-ensembling run the generator directly and do not feed recurrent state.
+    ensemble = SelfEnsemble.from_opt(opt['self_ensemble'], model) if opt['self_ensemble'] else None
+    inference = ensemble
+    if opt['tiled_inference']:
+        inference = TiledInference.from_opt(opt['tiled_inference'], model, scale, opt['fp16'], generator=ensemble)
+    assert inference is None or not recurrent_mode
 
     tq = tqdm(test_loader)
     for data in tq:
-        need_GT = False if test_loader.dataset.opt['dataroot_GT'] is None else True
+        need_GT = False if opt['dataset']['dataroot_GT'] is None else True
 
         if recurrent_mode and first_frame:
             b, c, h, w = data['lq'].shape
@@ -170,48 +338,18 @@ if __name__ == "__main__":
         if recurrent_mode:
             data['recurrent'] = recurrent_entry
 
-        model.feed_data(data, need_GT=need_GT)
-        model.test()
-        visuals = model.get_current_visuals()['rlt']
+        if inference is not None:
+            visuals = inference(data['lq'].to(model.env['device']))
+        else:
+            model.feed_data(data, need_GT=need_GT)
+            model.test()
+            visuals = model.get_current_visuals()['rlt']
 
         if recurrent_mode:
             recurrent_entry = visuals
-        visuals = visuals.cpu().float()
-        for i in range(visuals.shape[0]):
-            sr_img = util.tensor2img(visuals[i])  # uint8
-
-            # save images
-            save_img_path = osp.join(dataset_dir, '%08d.png' % (frame_counter,))
-            util.save_img(sr_img, save_img_path)
-            frame_counter += 1
-
-            if frame_counter % frames_per_vid == 0:
-                if ffmpeg_proc is not None:
-                    print("Waiting for last encode..")
-                    ffmpeg_proc.wait()
-                print("Encoding minivid %d.." % (vid_counter,))
-                # Perform stitching.
-                num_splits = opt['dataset']['vertical_splits'] if 'vertical_splits' in opt['dataset'].keys() else 1
-                if num_splits > 1:
-                    procs = []
-                    src_imgs_path = osp.join(dataset_dir, "joined")
-                    os.makedirs(src_imgs_path, exist_ok=True)
-                    for i in range(int(frames_per_vid / num_splits)):
-                        to_join = [osp.join(dataset_dir, "%08d.png" % (j,)) for j in range(i * num_splits, i * num_splits + num_splits)]
-                        merge_images(to_join, osp.join(src_imgs_path, "%08d.png" % (i,)))
-                else:
-                    src_imgs_path = dataset_dir
-
-                # Encoding command line:
-                # ffmpeg -framerate 30 -i %08d.png -c:v libx265 -crf 12 -preset slow -pix_fmt yuv444p test.mkv
-                cmd = ['ffmpeg', '-y', '-framerate', str(opt['dataset']['frame_rate']), '-f', 'image2', '-i', osp.join(src_imgs_path, "%08d.png"),
-                       '-c:v', 'libx265', '-crf', str(minivid_crf), '-preset', 'slow', '-pix_fmt', 'yuv444p', osp.join(vid_output, "mini_%06d.mkv" % (vid_counter,))]
-                print(ffmpeg_proc)
-                ffmpeg_proc = subprocess.Popen(cmd)#, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-                vid_counter += 1
-                frame_counter = 0
-                print("Done.")
-
-
-            if want_just_images:
-                continue
\ No newline at end of file
+        # Hands the frames off to the encoder thread; this returns as soon as the device->host copy is queued.
+        video_writer.submit(visuals)
+
+    video_writer.close()
+    if ensemble is not None:
+        print(ensemble.latency_report())
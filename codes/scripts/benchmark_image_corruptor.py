@@ -0,0 +1,61 @@
+"""Compares the throughput of ImageCorruptor (per image, numpy/cv2, as run in the DataLoader workers) against
+BatchImageCorruptor (whole batches on the GPU, as run by the image_corruption injector), and reports how closely the two
+agree for every corruption. Run from the codes/ directory."""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from data.image_corruptor import ImageCorruptor, BatchImageCorruptor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fixed_corruptions', type=str, nargs='*', default=['jpeg-broad'])
+    parser.add_argument('-random_corruptions', type=str, nargs='*',
+                        default=['gaussian_blur', 'motion_blur', 'smooth_blur', 'lq_resampling', 'color_quantization',
+                                 'saturation', 'noise-5', 'none'])
+    parser.add_argument('-num_corrupts_per_image', type=int, default=2)
+    parser.add_argument('-corruption_blur_scale', type=int, default=1)
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-image_size', type=int, default=128)
+    parser.add_argument('-batches', type=int, default=10)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    opt = {'fixed_corruptions': args.fixed_corruptions, 'random_corruptions': args.random_corruptions,
+           'num_corrupts_per_image': args.num_corrupts_per_image, 'corruption_blur_scale': args.corruption_blur_scale}
+    cpu_corruptor, batch_corruptor = ImageCorruptor(opt), BatchImageCorruptor(opt)
+    imgs = torch.rand(args.batch_size, 3, args.image_size, args.image_size)
+    imgs = torch.nn.functional.interpolate(torch.nn.functional.avg_pool2d(imgs, 4), scale_factor=4, mode='bilinear')
+    np_imgs = [np.ascontiguousarray(i.permute(1, 2, 0).numpy()) for i in imgs]
+
+    start = time.time()
+    for _ in range(args.batches):
+        for img in np_imgs:
+            cpu_corruptor.corrupt_images([img.copy()])
+    elapsed = time.time() - start
+    print("ImageCorruptor: %.1f images/sec" % (args.batches * args.batch_size / elapsed,))
+
+    dev_imgs = imgs.to(args.device)
+    batch_corruptor.corrupt_batch(dev_imgs)  # Warm up.
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.batches):
+        batch_corruptor.corrupt_batch(dev_imgs)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    print("BatchImageCorruptor (%s): %.1f images/sec" % (args.device, args.batches * args.batch_size / elapsed))
+
+    # Parity of every individual corruption, using the same source of entropy for both implementations.
+    print("Mean absolute difference between implementations:")
+    for aug in sorted(set(args.fixed_corruptions + args.random_corruptions)):
+        diffs = []
+        for i, img in enumerate(np_imgs[:8]):
+            rand_int = 1 + i * 7919
+            a = cpu_corruptor.apply_corruption(img.copy(), aug, rand_int, [aug])
+            b = batch_corruptor.apply_corruption(dev_imgs[i:i+1], aug, torch.tensor([rand_int]), [[aug]])
+            diffs.append(np.abs(a - b[0].permute(1, 2, 0).cpu().numpy()).mean())
+        print("  %s: %.6f" % (aug, float(np.mean(diffs))))
@@ -0,0 +1,49 @@
+"""Compares the throughput of MultiScaleDataset building every pyramid from the source images against serving the
+clean pyramids from a pyramid cache (see scripts/create_multiscale_pyramids.py), which is built first if it doesn't
+exist. Run from the codes/ directory."""
+import argparse
+import os.path as osp
+import time
+
+import torch
+
+import data.util as util
+from data.multiscale_dataset import MultiScaleDataset, PYRAMID_META_NAME, build_pyramid_cache
+
+
+def samples_per_second(dataset, samples, n_workers):
+    sampler = torch.utils.data.RandomSampler(dataset, replacement=True, num_samples=samples + 1)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=1, sampler=sampler, num_workers=n_workers)
+    it = iter(loader)
+    next(it)  # Warm up, including worker startup.
+    start = time.time()
+    for _ in range(samples):
+        next(it)
+    return samples / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-paths', type=str, nargs='+')
+    parser.add_argument('-pyramid_cache', type=str)
+    parser.add_argument('-hq_tile_size', type=int, default=128)
+    parser.add_argument('-num_scales', type=int, default=4)
+    parser.add_argument('-scale', type=int, default=2)
+    parser.add_argument('-fixed_corruptions', type=str, nargs='*', default=['jpeg'])
+    parser.add_argument('-random_corruptions', type=str, nargs='*', default=['gaussian_blur', 'motion_blur', 'noise-5'])
+    parser.add_argument('-samples', type=int, default=100)
+    parser.add_argument('-n_workers', type=int, default=0)
+    args = parser.parse_args()
+    opt = {'paths': args.paths, 'hq_tile_size': args.hq_tile_size, 'num_scales': args.num_scales, 'scale': args.scale,
+           'fixed_corruptions': args.fixed_corruptions, 'random_corruptions': args.random_corruptions,
+           'num_corrupts_per_image': 1, 'corruption_blur_scale': 1}
+
+    if not osp.exists(osp.join(args.pyramid_cache, PYRAMID_META_NAME)):
+        paths, _ = util.get_image_paths('img', args.paths, [1 for _ in args.paths])
+        start = time.time()
+        build_pyramid_cache(paths, args.pyramid_cache, args.hq_tile_size, args.num_scales, max(args.n_workers, 1))
+        print("Built the pyramid cache in %.1fs." % (time.time() - start,))
+
+    print("From source images: %.2f samples/sec" % (samples_per_second(MultiScaleDataset(opt), args.samples, args.n_workers),))
+    opt['pyramid_cache'] = args.pyramid_cache
+    print("From pyramid cache: %.2f samples/sec" % (samples_per_second(MultiScaleDataset(opt), args.samples, args.n_workers),))
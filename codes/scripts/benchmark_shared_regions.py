@@ -0,0 +1,77 @@
+"""Compares the batched data.byol_attachment.reconstructed_shared_regions against the per-sample loop it replaced, at a
+few batch sizes, and checks that both return identical tensors and gradients. Recompute packages are drawn from
+RandomSharedRegionCrop like the structured BYOL dataset does. Run from the codes/ directory."""
+import argparse
+import time
+
+import kornia
+import torch
+import torch.nn.functional as F
+
+from data.byol_attachment import RandomSharedRegionCrop, pad_to, reconstructed_shared_regions
+
+
+# The original implementation, for reference.
+def reconstructed_shared_regions_loop(fea1, fea2, recompute_package):
+    package = recompute_package.cpu()
+    res1 = []
+    res2 = []
+    pad_dim = torch.max(package[:, -2:]).item()
+    for b in range(package.shape[0]):
+        expected_dim, f1_h, f1_w, f1s_t, f1s_l, f2_h, f2_w, f2s_t, f2s_l, should_flip, s_h, s_w = tuple(package[b].tolist())
+        assert expected_dim == fea1.shape[2] and expected_dim == fea2.shape[2]
+        f2 = fea2[b]
+        if should_flip == 1:
+            f2 = kornia.geometry.transform.hflip(f2)
+        f1s = F.interpolate(fea1[b].unsqueeze(0), (f1_h, f1_w), mode="nearest")
+        f2s = F.interpolate(f2.unsqueeze(0), (f2_h, f2_w), mode="nearest")
+        res1.append(pad_to(f1s[:, :, f1s_t:f1s_t+s_h, f1s_l:f1s_l+s_w], pad_dim))
+        res2.append(pad_to(f2s[:, :, f2s_t:f2s_t+s_h, f2s_l:f2s_l+s_w], pad_dim))
+    return torch.cat(res1, dim=0), torch.cat(res2, dim=0)
+
+
+def sync(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, args, iterations, device):
+    fn(*args)  # Warm up.
+    sync(device)
+    start = time.time()
+    for _ in range(iterations):
+        fn(*args)
+    sync(device)
+    return (time.time() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('-image_size', type=int, default=256)
+    parser.add_argument('-latent_multiple', type=int, default=16)
+    parser.add_argument('-channels', type=int, default=256)
+    parser.add_argument('-iterations', type=int, default=20)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    rrc = RandomSharedRegionCrop(args.latent_multiple)
+    img = torch.rand(3, args.image_size, args.image_size)
+    d = args.image_size // args.latent_multiple
+
+    for b in args.batch_sizes:
+        package = torch.stack([rrc(img, img)[2] for _ in range(b)]).to(args.device)
+        fea1 = torch.randn(b, args.channels, d, d, device=args.device, requires_grad=True)
+        fea2 = torch.randn(b, args.channels, d, d, device=args.device, requires_grad=True)
+
+        results = []
+        for fn in [reconstructed_shared_regions_loop, reconstructed_shared_regions]:
+            r1, r2 = fn(fea1, fea2, package)
+            grads = torch.autograd.grad((r1 * torch.arange(r1.numel(), device=r1.device).view(r1.shape)).sum() +
+                                        r2.sum(), [fea1, fea2])
+            results.append([r1, r2] + list(grads))
+        identical = all(torch.equal(a, b) for a, b in zip(*results))
+
+        loop_time = time_fn(reconstructed_shared_regions_loop, (fea1, fea2, package), args.iterations, args.device)
+        batched_time = time_fn(reconstructed_shared_regions, (fea1, fea2, package), args.iterations, args.device)
+        print("batch %i: loop %.2fms, batched %.2fms (%.1fx), identical: %s" %
+              (b, loop_time * 1000, batched_time * 1000, loop_time / batched_time, identical))
@@ -0,0 +1,34 @@
+"""Compares the frames/sec of the per-frame FFMPEG extraction used by FfmpegBackedVideoDataset against the streaming
+decoder in FfmpegStreamingVideoReader. Run from the codes/ directory."""
+import argparse
+import tempfile
+import time
+
+import torch.utils.data as data
+
+from process_video import FfmpegBackedVideoDataset, FfmpegStreamingVideoReader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-video', type=str, help='Path to a video file.')
+    parser.add_argument('-frame_rate', type=int, default=30)
+    parser.add_argument('-start', type=int, default=0, help='Offset into the video, in seconds.')
+    parser.add_argument('-seconds', type=int, default=10, help='Number of seconds of video to decode.')
+    parser.add_argument('-batch_size', type=int, default=4)
+    args = parser.parse_args()
+    opt = {'video_file': args.video, 'frame_rate': args.frame_rate, 'start_at_seconds': args.start,
+           'end_at_seconds': args.start + args.seconds, 'force_multiple': 1, 'batch_size': args.batch_size,
+           'vertical_splits': 1, 'data_type': 'img'}
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        loader = data.DataLoader(FfmpegBackedVideoDataset(opt, working_dir), batch_size=args.batch_size)
+        start = time.time()
+        frames = sum(b['lq'].shape[0] for b in loader)
+        elapsed = time.time() - start
+        print("Per-frame extraction: %i frames in %.2fs (%.2f frames/sec)" % (frames, elapsed, frames / elapsed))
+
+    start = time.time()
+    frames = sum(b['lq'].shape[0] for b in FfmpegStreamingVideoReader(opt))
+    elapsed = time.time() - start
+    print("Streaming decoder: %i frames in %.2fs (%.2f frames/sec)" % (frames, elapsed, frames / elapsed))
@@ -0,0 +1,42 @@
+"""Converts a 'chunked' dataset (as produced by extract_subimages_with_ref.py) into the packed shard format read by
+data/chunk_shard.py. BaseUnsupervisedImageDataset automatically uses the shard format when it finds a shards.npz in
+one of its `paths`."""
+import argparse
+import os
+import os.path as osp
+import torch
+from tqdm import tqdm
+
+import data.util as data_util
+from data.chunk_shard import ChunkShardWriter
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Conversion is incremental: chunks already in the output's index are skipped and new ones are appended.
+def convert(input_folder, output_folder, max_shard_size):
+    writer = ChunkShardWriter(output_folder, max_shard_size)
+    converted = set(writer.chunk_names)
+    chunk_dirs = [d for d in sorted(os.scandir(input_folder), key=lambda e: e.name) if d.is_dir() and d.name not in converted]
+    for d in tqdm(chunk_dirs):
+        tiles, _ = data_util.get_image_paths('img', d.path)
+        if not tiles:
+            continue
+        ref_path = osp.join(d.path, "ref.jpg")
+        centers_path = osp.join(d.path, "centers.pt")
+        ref = read_bytes(ref_path) if osp.exists(ref_path) else None
+        centers = torch.load(centers_path) if osp.exists(centers_path) else None
+        writer.write_chunk(d.name, ref, [(osp.relpath(t, d.path), read_bytes(t)) for t in tiles], centers)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input', type=str, help='Path to the root of a chunked dataset.')
+    parser.add_argument('-output', type=str, help='Folder where shards and the shard index will be written.')
+    parser.add_argument('-shard_size_gb', type=float, default=4, help='Approximate size of each shard file.')
+    args = parser.parse_args()
+    convert(args.input, args.output, int(args.shard_size_gb * 1024 * 1024 * 1024))
@@ -4,6 +4,7 @@ import sys
 import os.path as osp
 import glob
 import pickle
+from collections import deque
 from multiprocessing import Pool
 import numpy as np
 import lmdb
@@ -12,10 +13,13 @@ import cv2
 sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
 import data.util as data_util  # noqa: E402
 import utils.util as util  # noqa: E402
+from data.base_unsupervised_image_dataset import list_chunk_dirs, scan_chunk_dir  # noqa: E402
+from data.image_folder_dataset import list_image_folder, scan_image_folder  # noqa: E402
+from data.path_index import load_path_index  # noqa: E402
 
 
 def main():
-    dataset = 'DIV2K_demo'  # vimeo90K | REDS | general (e.g., DIV2K, 291) | DIV2K_demo |test
+    dataset = 'DIV2K_demo'  # vimeo90K | REDS | general (e.g., DIV2K, 291) | DIV2K_demo | encoded | test
     mode = 'hq'  # used for vimeo90k and REDS datasets
     # vimeo90k: GT | LR | flow
     # REDS: train_sharp, train_sharp_bicubic, train_blur_bicubic, train_blur, train_blur_comp
@@ -42,6 +46,17 @@ def main():
         opt['lmdb_save_path'] = '../../datasets/DIV2K/DIV2K800_sub_bicLRx4.lmdb'
         opt['name'] = 'DIV2K800_sub_bicLRx4'
         general_image_folder(opt)
+    elif dataset == 'encoded':
+        # Builds an LMDB that ImageFolderDataset (layout='folder') or the chunked datasets (layout='chunked') can read
+        # directly; point the dataset `paths` at lmdb_save_path.
+        opt = {}
+        opt['img_folder'] = '../../datasets/DIV2K/DIV2K800_sub'
+        opt['lmdb_save_path'] = '../../datasets/DIV2K/DIV2K800_sub.lmdb'
+        opt['layout'] = 'folder'  # folder | chunked
+        opt['reencode'] = None  # None stores the file bytes as-is. 'jpg' or 'png' re-encodes every image.
+        opt['jpeg_quality'] = 95
+        opt['n_workers'] = 16
+        encoded_image_folder(opt)
     elif dataset == 'test':
         test_lmdb('../../datasets/REDS/train_sharp_wval.lmdb', 'REDS')
 
@@ -51,6 +66,93 @@ def read_image_worker(path, key):
     return (key, img)
 
 
+def encode_file_worker(path, reencode, jpeg_quality):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if reencode is None or not data_util.is_image_file(path):
+        return data
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if reencode == 'jpg' else []
+    return cv2.imencode('.' + reencode, img, params)[1].tobytes()
+
+
+def _commit_records(env, records):
+    while True:
+        try:
+            with env.begin(write=True) as txn:
+                for key, data in records:
+                    txn.put(key, data)
+            return
+        except lmdb.MapFullError:
+            env.set_mapsize(env.info()['map_size'] * 2)
+
+
+def encoded_image_folder(opt):
+    """Create an lmdb that stores the encoded bytes of every image in a folder (or a chunked dataset), keyed by path
+    relative to the folder, plus a path index listing them. See data/lmdb_image_store.py.
+    Files are read (and optionally re-encoded) by a process pool. At most max_pending files are in flight and at most
+    commit_bytes of records are buffered before being committed, so memory use does not grow with the dataset.
+    """
+    img_folder = opt['img_folder']
+    lmdb_save_path = opt['lmdb_save_path']
+    layout = opt['layout'] if 'layout' in opt.keys() else 'folder'
+    reencode = opt['reencode'] if 'reencode' in opt.keys() else None
+    jpeg_quality = opt['jpeg_quality'] if 'jpeg_quality' in opt.keys() else 95
+    n_workers = opt['n_workers'] if 'n_workers' in opt.keys() else 16
+    max_pending = opt['max_pending'] if 'max_pending' in opt.keys() else n_workers * 16
+    commit_bytes = opt['commit_bytes'] if 'commit_bytes' in opt.keys() else 256 * 1024 * 1024
+    if osp.exists(lmdb_save_path):
+        print('Folder [{:s}] already exists. Exit...'.format(lmdb_save_path))
+        sys.exit(1)
+
+    #### list the images, grouped the same way the datasets' path indexes group them
+    print('Reading image path list ...')
+    if layout == 'chunked':
+        groups = [name for name, _ in list_chunk_dirs(img_folder)]
+        entries = {name: scan_chunk_dir(img_folder, name) for name in groups}
+        extras = [osp.join(name, f) for name in groups for f in ['ref.jpg', 'centers.pt']
+                  if osp.exists(osp.join(img_folder, name, f))]
+    else:
+        groups = [name for name, _ in list_image_folder(img_folder)]
+        entries = {name: scan_image_folder(img_folder, name) for name in groups}
+        extras = []
+    files = [f for name in groups for f in entries[name]] + extras
+
+    #### encode in a pool of processes and stream the results into the lmdb in order
+    # The map is sized from the source files; it is grown if re-encoding makes the data larger.
+    data_size = sum(osp.getsize(osp.join(img_folder, f)) for f in files)
+    env = lmdb.open(lmdb_save_path, map_size=int(data_size * 1.5) + 64 * 1024 * 1024)
+    pbar = util.ProgressBar(len(files))
+    records, records_bytes = [], 0
+    pending = deque()
+
+    def write_oldest():
+        nonlocal records, records_bytes
+        key, result = pending.popleft()
+        data = result.get()
+        records.append((key.encode('utf-8'), data))
+        records_bytes += len(data)
+        pbar.update('Write {}'.format(key))
+        if records_bytes >= commit_bytes:
+            _commit_records(env, records)
+            records, records_bytes = [], 0
+
+    with Pool(n_workers) as pool:
+        for f in files:
+            pending.append((f, pool.apply_async(encode_file_worker, args=(osp.join(img_folder, f), reencode, jpeg_quality))))
+            if len(pending) >= max_pending:
+                write_oldest()
+        while pending:
+            write_oldest()
+    _commit_records(env, records)
+    env.close()
+    print('Finish writing lmdb.')
+
+    #### the path index is what the datasets list the images from
+    load_path_index(lmdb_save_path, lambda root: [(name, 0) for name in groups], lambda root, name: entries[name])
+    print('Finish creating the path index.')
+
+
 def general_image_folder(opt):
     """Create lmdb for general image folders
     Users should define the keys, such as: '0321_s035' for DIV2K sub-images
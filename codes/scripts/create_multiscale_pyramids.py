@@ -0,0 +1,18 @@
+"""Builds the pyramid cache MultiScaleDataset reads when `pyramid_cache` is set: every image center-cropped and resized
+to hq_size_cap, plus its clean quadtree of tiles, in memory-mapped uint8 arrays. Run from the codes/ directory."""
+import argparse
+
+import data.util as util
+from data.multiscale_dataset import build_pyramid_cache
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-paths', type=str, nargs='+', help='Folders of full-quality images, as in the dataset opt.')
+    parser.add_argument('-output', type=str, help='Folder to write the cache to.')
+    parser.add_argument('-hq_tile_size', type=int, default=128)
+    parser.add_argument('-num_scales', type=int, default=4)
+    parser.add_argument('-n_workers', type=int, default=8)
+    args = parser.parse_args()
+    paths, _ = util.get_image_paths('img', args.paths, [1 for _ in args.paths])
+    build_pyramid_cache(paths, args.output, args.hq_tile_size, args.num_scales, args.n_workers)
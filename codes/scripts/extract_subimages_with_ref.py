@@ -1,10 +1,17 @@
 """A multi-thread tool to crop large images to sub-images for faster IO."""
+import functools
+import json
 import os
 import os.path as osp
+import shutil
+from multiprocessing import Pool
 import numpy as np
 import cv2
 from PIL import Image
 import data.util as data_util  # noqa: E402
+from data.base_unsupervised_image_dataset import EXTRACTION_PROGRESS_DIR, list_chunk_dirs, scan_chunk_dir
+from data.chunk_shard import ChunkShardWriter, is_shard_dataset, merge_shard_datasets
+from data.path_index import load_path_index
 import torch.utils.data as data
 from tqdm import tqdm
 import torch
@@ -18,7 +25,9 @@ def main():
     # CV_IMWRITE_PNG_COMPRESSION from 0 to 9. A higher value means a smaller size and longer
     # compression time. If read raw images during training, use 0 for faster IO speed.
 
-    opt['dest'] = 'file'
+    opt['dest'] = 'file'  # file | shards (the packed format in data/chunk_shard.py) | lmdb
+    opt['n_shards'] = 7  # file and shards: the number of processes that extract and write images in parallel.
+    opt['images_per_segment'] = 1000  # shards only: how many source images each process packs before closing a segment.
     opt['input_folder'] = 'F:\\4k6k\\datasets\\images\youtube\\images_cook'
     opt['save_folder'] = 'F:\\4k6k\\datasets\\images\\youtube_massive_cook'
     opt['crop_sz'] = [512, 1024, 2048]  # the size of each sub-image
@@ -38,11 +47,9 @@ def main():
         print('mkdir [{:s}] ...'.format(save_folder))
 
     if opt['dest'] == 'lmdb':
-        writer = LmdbWriter(save_folder)
+        extract_single(opt, LmdbWriter(save_folder))
     else:
-        writer = FileWriter(save_folder)
-
-    extract_single(opt, writer)
+        extract_parallel(opt)
 
 
 class LmdbWriter:
@@ -90,16 +97,49 @@ class LmdbWriter:
         self.db.close()
 
 
+# Appends a line to a per-process log for every source image whose tiles have been completely written, along with the
+# state its writer needs to carry on from there. Restarted runs skip every image found in the logs.
+class ExtractionProgress:
+    def __init__(self, folder, shard):
+        os.makedirs(folder, exist_ok=True)
+        path = osp.join(folder, 'shard_%03i.log' % (shard,))
+        self.done = set()
+        self.state = None
+        if osp.exists(path):
+            with open(path, 'rb+') as f:
+                # Drop a line that was cut off by an interruption.
+                content = f.read()
+                f.truncate(content.rfind(b'\n') + 1)
+            with open(path, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.done.add(record['source'])
+                    self.state = record['state']
+        self.file = open(path, 'a')
+
+    def record(self, sources, state):
+        for source in sources:
+            self.file.write(json.dumps({'source': source, 'state': state}) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
 class FileWriter:
-    def __init__(self, folder):
+    # Parallel writers use interleaved tile IDs (first_id, first_id+id_stride, ..) so that they never collide.
+    def __init__(self, folder, first_id=0, id_stride=1, progress=None):
         self.folder = folder
-        self.next_unique_id = 0
+        self.next_unique_id = first_id
+        self.id_stride = id_stride
+        self.progress = progress
         self.ref_center_points = {}   # Maps ref_img basename to a dict of image IDs:center points
         self.ref_ids_to_names = {}
 
     def get_next_unique_id(self):
         id = self.next_unique_id
-        self.next_unique_id += 1
+        self.next_unique_id += self.id_stride
         return id
 
     def save_image(self, ref_path, img_name, img):
@@ -133,9 +173,78 @@ class FileWriter:
             torch.save(cps, osp.join(self.folder, ref_name, "centers.pt"))
         self.ref_center_points = {}
 
+    # Called once every tile of a source image has been written. Since the next tile ID is logged along with it, an image
+    # that gets interrupted is redone with the same tile IDs and simply overwrites its partial output.
+    def finish_source(self, source):
+        self.flush()
+        if self.progress is not None:
+            self.progress.record([source], self.next_unique_id)
+
     def close(self):
         self.flush()
 
+
+# Packs chunks into the shard format of data/chunk_shard.py. Every images_per_segment source images, the current
+# segment (a small sharded dataset of its own) is closed and its source images are logged as done; segments that were
+# not closed before an interruption are discarded on restart. merge_shard_datasets() combines the segments at the end.
+class SegmentedShardWriter:
+    def __init__(self, folder, shard, progress, images_per_segment=1000):
+        self.folder = folder
+        self.shard = shard
+        self.progress = progress
+        self.images_per_segment = images_per_segment
+        self.segment = progress.state if progress.state is not None else 0
+        for name in os.listdir(folder):
+            if name.startswith(self.segment_prefix()) and int(name[len(self.segment_prefix()):]) >= self.segment:
+                shutil.rmtree(osp.join(folder, name))
+        self.writer = None
+        self.sources = []
+        self.chunk = None
+
+    def segment_prefix(self):
+        return 'part_%03i_' % (self.shard,)
+
+    def write_reference_image(self, ref_img, path):
+        img_name = osp.basename(path).replace(".jpg", "").replace(".png", "")
+        self.chunk = (img_name, ref_img[0].tobytes(), [], {})
+        return img_name
+
+    def write_tile_image(self, ref_id, tile_image):
+        _, _, tiles, centers = self.chunk
+        img, center, tile_sz = tile_image
+        id = len(tiles)
+        tiles.append(("%08i.jpg" % (id,), img.tobytes()))
+        centers[id] = center, tile_sz
+        return id
+
+    def flush(self):
+        if self.chunk is None:
+            return
+        if self.writer is None:
+            self.writer = ChunkShardWriter(osp.join(self.folder, self.segment_prefix() + '%05i' % (self.segment,)))
+        self.writer.write_chunk(*self.chunk)
+        self.chunk = None
+
+    def _close_segment(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.segment += 1
+        self.progress.record(self.sources, self.segment)
+        self.sources = []
+
+    def finish_source(self, source):
+        self.flush()
+        self.sources.append(source)
+        if len(self.sources) >= self.images_per_segment:
+            self._close_segment()
+
+    def close(self):
+        self.flush()
+        if self.sources or self.writer is not None:
+            self._close_segment()
+
+
 class TiledDataset(data.Dataset):
     def __init__(self, opt):
         self.split_mode = opt['vertical_split']
@@ -258,6 +367,21 @@ class TiledDataset(data.Dataset):
 def identity(x):
     return x
 
+# Writes the reference image and tiles extracted from a single source image (both halves of it in split mode).
+def write_source_image(writer, spl_imgs):
+    for imgs, lbl in zip(list(spl_imgs), ['left', 'right']):
+        if imgs is None:
+            continue
+        imgs, path = imgs
+        if imgs is None or len(imgs) <= 1:
+            continue
+        path = path + "_" + lbl
+        ref_id = writer.write_reference_image(imgs[0], path)
+        for tile in imgs[1:]:
+            writer.write_tile_image(ref_id, tile)
+        writer.flush()
+
+
 def extract_single(opt, writer):
     dataset = TiledDataset(opt)
     dataloader = data.DataLoader(dataset, num_workers=opt['n_thread'], collate_fn=identity)
@@ -265,19 +389,46 @@ def extract_single(opt, writer):
     for spl_imgs in tq:
         if spl_imgs is None:
             continue
-        spl_imgs = spl_imgs[0]
-        for imgs, lbl in zip(list(spl_imgs), ['left', 'right']):
-            if imgs is None:
-                continue
-            imgs, path = imgs
-            if imgs is None or len(imgs) <= 1:
-                continue
-            path = path + "_" + lbl
-            ref_id = writer.write_reference_image(imgs[0], path)
-            for tile in imgs[1:]:
-                writer.write_tile_image(ref_id, tile)
-            writer.flush()
+        write_source_image(writer, spl_imgs[0])
+    writer.close()
+
+
+# Extracts and writes every n_shards'th source image, starting at the given one, skipping images that a previous run
+# already finished.
+def extract_shard(opt, shard):
+    n_shards = opt['n_shards']
+    save_folder = opt['save_folder']
+    dataset = TiledDataset(opt)
+    progress = ExtractionProgress(osp.join(save_folder, EXTRACTION_PROGRESS_DIR), shard)
+    if opt['dest'] == 'shards':
+        writer = SegmentedShardWriter(save_folder, shard, progress, opt['images_per_segment'])
+    else:
+        writer = FileWriter(save_folder, progress.state if progress.state is not None else shard, n_shards, progress)
+    todo = [i for i in range(shard, len(dataset), n_shards) if dataset.images[i] not in progress.done]
+    for i in tqdm(todo, position=shard, desc='shard %i' % (shard,)):
+        write_source_image(writer, dataset[i])
+        writer.finish_source(dataset.images[i])
     writer.close()
+    progress.close()
+
+
+# Runs n_shards extraction processes, each of which decodes, tiles and writes its share of the source images
+# independently, then builds the index over everything they wrote: a merged shards.npz for dest='shards', or the path
+# index the chunked datasets read for dest='file'. Interrupted runs can simply be restarted.
+def extract_parallel(opt):
+    n_shards = opt['n_shards'] if 'n_shards' in opt.keys() else opt['n_thread']
+    opt = dict(opt, n_shards=n_shards,
+               images_per_segment=opt['images_per_segment'] if 'images_per_segment' in opt.keys() else 1000)
+    with Pool(n_shards) as pool:
+        pool.map(functools.partial(extract_shard, opt), range(n_shards))
+
+    save_folder = opt['save_folder']
+    if opt['dest'] == 'shards':
+        segments = sorted(d.path for d in os.scandir(save_folder)
+                          if d.is_dir() and d.name.startswith('part_') and is_shard_dataset(d.path))
+        merge_shard_datasets(save_folder, segments)
+    else:
+        load_path_index(save_folder, list_chunk_dirs, scan_chunk_dir)
 
 
 if __name__ == '__main__':
@@ -8,16 +8,20 @@ import utils
 import utils.options as option
 import utils.util as util
 from trainer.ExtensibleTrainer import ExtensibleTrainer
+from utils.self_ensemble import SelfEnsemble
+from utils.tiled_inference import TiledInference
 from data import create_dataset, create_dataloader
 from tqdm import tqdm
 import torch
 
 
-def forward_pass(model, output_dir, alteration_suffix=''):
-    model.feed_data(data, 0, need_GT=need_GT)
-    model.test()
-
-    visuals = model.get_current_visuals(need_GT)['rlt'].cpu()
+def forward_pass(model, output_dir, alteration_suffix='', inference=None):
+    if inference is not None:
+        visuals = inference(data['lq'].to(model.env['device'])).cpu()
+    else:
+        model.feed_data(data, 0, need_GT=need_GT)
+        model.test()
+        visuals = model.get_current_visuals(need_GT)['rlt'].cpu()
     fea_loss = 0
     psnr_loss = 0
     for i in range(visuals.shape[0]):
@@ -70,6 +74,11 @@ if __name__ == "__main__":
         test_loaders.append(test_loader)
 
     model = ExtensibleTrainer(opt)
+    # Tiled inference and self-ensembling run the generator directly rather than through model.test().
+    ensemble = SelfEnsemble.from_opt(opt['self_ensemble'], model) if opt['self_ensemble'] else None
+    inference = ensemble
+    if opt['tiled_inference']:
+        inference = TiledInference.from_opt(opt['tiled_inference'], model, opt['scale'], opt['fp16'], generator=ensemble)
     fea_loss = 0
     psnr_loss = 0
     for test_loader in test_loaders:
@@ -90,9 +99,11 @@ if __name__ == "__main__":
             need_GT = False if test_loader.dataset.opt['dataroot_GT'] is None else True
             need_GT = need_GT and want_metrics
 
-            fea_loss, psnr_loss = forward_pass(model, dataset_dir, opt['name'])
+            fea_loss, psnr_loss = forward_pass(model, dataset_dir, opt['name'], inference)
             fea_loss += fea_loss
             psnr_loss += psnr_loss
 
         # log
         logger.info('# Validation # Fea: {:.4e}, PSNR: {:.4e}'.format(fea_loss / len(test_loader), psnr_loss / len(test_loader)))
+        if ensemble is not None:
+            logger.info(ensemble.latency_report())
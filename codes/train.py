@@ -11,7 +11,9 @@ from trainer.eval import create_evaluator
 
 from utils import util, options as option
 from data import create_dataloader, create_dataset
+from data.device_prefetcher import DevicePrefetcher
 from trainer.ExtensibleTrainer import ExtensibleTrainer
+from trainer.validator import BatchedValidator
 from time import time
 
 def init_dist(backend, **kwargs):
@@ -31,8 +33,8 @@ class Trainer:
 
     def init(self, opt, launcher, all_networks={}):
         self._profile = False
-        self.val_compute_psnr = opt['eval']['compute_psnr'] if 'compute_psnr' in opt['eval'].keys() else True
-        self.val_compute_fea = opt['eval']['compute_fea'] if 'compute_fea' in opt['eval'].keys() else True
+        self.last_step_start = None
+        self.iteration_time, self.data_wait_time, self.timed_iterations = 0, 0, 0
 
         #### loading resume state if exists
         if opt['path'].get('resume_state', None):
@@ -112,6 +114,9 @@ class Trainer:
                 else:
                     self.train_sampler = None
                 self.train_loader = create_dataloader(self.train_set, dataset_opt, opt, self.train_sampler)
+                if opt['train']['prefetch_to_device']:
+                    # Copies the next batch to the GPU on a side stream while the current step is running.
+                    self.train_loader = DevicePrefetcher(self.train_loader, 'cuda' if opt['gpu_ids'] is not None else 'cpu')
                 if self.rank <= 0:
                     self.logger.info('Number of train images: {:,d}, iters: {:,d}'.format(
                         len(self.train_set), train_size))
@@ -119,7 +124,11 @@ class Trainer:
                         self.total_epochs, total_iters))
             elif phase == 'val':
                 self.val_set = create_dataset(dataset_opt)
-                self.val_loader = create_dataloader(self.val_set, dataset_opt, opt, None)
+                val_set = self.val_set
+                if opt['dist']:
+                    # Every rank validates a disjoint shard of the validation set; metrics are all-reduced afterwards.
+                    val_set = BatchedValidator.shard_dataset(self.val_set, self.rank, self.world_size)
+                self.val_loader = create_dataloader(val_set, dataset_opt, opt, None)
                 if self.rank <= 0:
                     self.logger.info('Number of val images in [{:s}]: {:d}'.format(
                         dataset_opt['name'], len(self.val_set)))
@@ -129,6 +138,7 @@ class Trainer:
 
         #### create model
         self.model = ExtensibleTrainer(opt, cached_networks=all_networks)
+        self.validator = BatchedValidator(opt)
 
         ### Evaluators
         self.evaluators = []
@@ -151,7 +161,15 @@ class Trainer:
         if 'force_start_step' in opt.keys():
             self.current_step = opt['force_start_step']
 
-    def do_step(self, train_data):
+    def do_step(self, train_data, data_wait_time=0):
+        step_start = time()
+        if self.last_step_start is not None:
+            self.iteration_time += step_start - self.last_step_start
+            self.timed_iterations += 1
+        self.last_step_start = step_start
+        self.data_wait_time += data_wait_time
+        self.model.profiler.add('data_wait', data_wait_time)
+
         if self._profile:
             print("Data fetch: %f" % (time() - _t))
             _t = time()
@@ -178,6 +196,11 @@ class Trainer:
             for v in self.model.get_current_learning_rate():
                 message += '{:.3e},'.format(v)
             message += ')] '
+            if self.timed_iterations > 0:
+                # Wall-clock time per iteration and how much of it was spent waiting on the data loader.
+                logs['iteration_time'] = self.iteration_time / self.timed_iterations
+                logs['data_wait_time'] = self.data_wait_time / self.timed_iterations
+                self.iteration_time, self.data_wait_time, self.timed_iterations = 0, 0, 0
             for k, v in logs.items():
                 if 'histogram' in k:
                     self.tb_logger.add_histogram(k, v, self.current_step)
@@ -199,62 +222,27 @@ class Trainer:
                 self.logger.info('Saving models and training states.')
                 self.model.save(self.current_step)
                 self.model.save_training_state(self.epoch, self.current_step)
-            if 'alt_path' in opt['path'].keys():
-                import shutil
-                print("Synchronizing tb_logger to alt_path..")
-                alt_tblogger = os.path.join(opt['path']['alt_path'], "tb_logger")
-                shutil.rmtree(alt_tblogger, ignore_errors=True)
-                shutil.copytree(self.tb_logger_path, alt_tblogger)
+                if 'alt_path' in opt['path'].keys() and opt['use_tb_logger'] and 'debug' not in opt['name']:
+                    # Only the event bytes written since the last sync are copied.
+                    self.tb_logger.flush()
+                    alt_tblogger = os.path.join(opt['path']['alt_path'], "tb_logger")
+                    self.model.checkpoint_writer.sync_directory(self.tb_logger_path, alt_tblogger)
 
         #### validation
         if opt['datasets'].get('val', None) and self.current_step % opt['train']['val_freq'] == 0:
-            if opt['model'] in ['sr', 'srgan', 'corruptgan', 'spsrgan',
-                                'extensibletrainer'] and self.rank <= 0:  # image restoration validation
-                avg_psnr = 0.
-                avg_fea_loss = 0.
-                idx = 0
-                val_tqdm = tqdm(self.val_loader)
-                for val_data in val_tqdm:
-                    idx += 1
-                    for b in range(len(val_data['HQ_path'])):
-                        img_name = os.path.splitext(os.path.basename(val_data['HQ_path'][b]))[0]
-                        img_dir = os.path.join(opt['path']['val_images'], img_name)
-
-                        util.mkdir(img_dir)
-
-                        self.model.feed_data(val_data, self.current_step)
-                        self.model.test()
-
-                        visuals = self.model.get_current_visuals()
-                        if visuals is None:
-                            continue
-
-                        sr_img = util.tensor2img(visuals['rlt'][b])  # uint8
-                        # calculate PSNR
-                        if self.val_compute_psnr:
-                            gt_img = util.tensor2img(visuals['hq'][b])  # uint8
-                            sr_img, gt_img = util.crop_border([sr_img, gt_img], opt['scale'])
-                            avg_psnr += util.calculate_psnr(sr_img, gt_img)
-
-                        # calculate fea loss
-                        if self.val_compute_fea:
-                            avg_fea_loss += self.model.compute_fea_loss(visuals['rlt'][b], visuals['hq'][b])
-
-                        # Save SR images for reference
-                        img_base_name = '{:s}_{:d}.png'.format(img_name, self.current_step)
-                        save_img_path = os.path.join(img_dir, img_base_name)
-                        util.save_img(sr_img, save_img_path)
-
-                avg_psnr = avg_psnr / idx
-                avg_fea_loss = avg_fea_loss / idx
+            if opt['model'] in ['sr', 'srgan', 'corruptgan', 'spsrgan', 'extensibletrainer']:  # image restoration validation
+                # All ranks take part; each validates its own shard of the validation set.
+                val_results = self.validator.validate(self.model, tqdm(self.val_loader, disable=self.rank > 0),
+                                                      self.current_step)
 
                 # log
-                self.logger.info('# Validation # PSNR: {:.4e} Fea: {:.4e}'.format(avg_psnr, avg_fea_loss))
+                if self.rank <= 0:
+                    self.logger.info('# Validation # ' + ' '.join('{:s}: {:.4e}'.format(k, v) for k, v in val_results.items()))
 
                 # tensorboard logger
                 if opt['use_tb_logger'] and 'debug' not in opt['name'] and self.rank <= 0:
-                    self.tb_logger.add_scalar('val_psnr', avg_psnr, self.current_step)
-                    self.tb_logger.add_scalar('val_fea', avg_fea_loss, self.current_step)
+                    for k, v in val_results.items():
+                        self.tb_logger.add_scalar(k, v, self.current_step)
 
         if len(self.evaluators) != 0 and self.current_step % opt['train']['val_freq'] == 0 and self.rank <= 0:
             eval_dict = {}
@@ -275,7 +263,10 @@ class Trainer:
 
             _t = time()
             for train_data in tq_ldr:
-                self.do_step(train_data)
+                self.do_step(train_data, time() - _t)
+                _t = time()
+        # Wait for any checkpoints that are still being written.
+        self.model.checkpoint_writer.close()
 
     def create_training_generator(self, index):
         self.logger.info('Start training from epoch: {:d}, iter: {:d}'.format(self.start_epoch, self.current_step))
@@ -287,8 +278,10 @@ class Trainer:
 
             _t = time()
             for train_data in tq_ldr:
+                data_wait_time = time() - _t
                 yield self.model
-                self.do_step(train_data)
+                self.do_step(train_data, data_wait_time)
+                _t = time()
 
 
 if __name__ == '__main__':
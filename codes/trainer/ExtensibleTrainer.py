@@ -11,6 +11,7 @@ from trainer.base_model import BaseModel
 from trainer.injectors import create_injector
 from trainer.steps import ConfigurableStep
 from trainer.experiments.experiments import get_experiment_for_name
+from utils.step_profiler import StepProfiler
 import torchvision.utils as utils
 
 logger = logging.getLogger('base')
@@ -35,6 +36,11 @@ class ExtensibleTrainer(BaseModel):
         if opt['path']['models'] is not None:
                self.env['base_path'] = os.path.join(opt['path']['models'])
 
+        # Per-phase timings of each iteration, reported through get_current_log(). Steps find it in the env.
+        profile = train_opt['profile'] if train_opt is not None and train_opt['profile'] else False
+        self.profiler = StepProfiler(enabled=profile, use_cuda_events=train_opt is None or train_opt['profile_cuda_events'] != False)
+        self.env['profiler'] = self.profiler
+
         self.mega_batch_factor = 1
         if self.is_train:
             self.mega_batch_factor = train_opt['mega_batch_factor']
@@ -45,7 +51,9 @@ class ExtensibleTrainer(BaseModel):
         self.netsG = {}
         self.netsD = {}
         # Note that this is on the chopping block. It should be integrated into an injection point.
-        self.netF = networks.define_F().to(self.device)  # Used to compute feature loss.
+        # Used to compute feature loss. Shared with any feature losses that use the same network.
+        self.netF = networks.get_shared_feature_extractor(self.device,
+                                                          data_parallel_ids=None if opt['dist'] else opt['gpu_ids'])
         for name, net in opt['networks'].items():
             # Trainable is a required parameter, but the default is simply true. Set it here.
             if 'trainable' not in net.keys():
@@ -76,7 +84,7 @@ class ExtensibleTrainer(BaseModel):
         self.step_names = []
         self.steps = []
         for step_name, step in opt['steps'].items():
-            step = ConfigurableStep(step, self.env)
+            step = ConfigurableStep(step, self.env, step_name)
             self.step_names.append(step_name)  # This could be an OrderedDict, but it's a PITA to integrate with AMP below.
             self.steps.append(step)
 
@@ -116,9 +124,6 @@ class ExtensibleTrainer(BaseModel):
             else:
                 dnet.eval()
             dnets.append(dnet)
-        if not opt['dist']:
-            self.netF = DataParallel(self.netF, device_ids=opt['gpu_ids'])
-
         # Backpush the wrapped networks into the network dicts..
         self.networks = {}
         found = 0
@@ -137,6 +142,7 @@ class ExtensibleTrainer(BaseModel):
 
         self.print_network()  # print network
         self.load()  # load G and D if needed
+        self.build_param_groups()
 
         # Load experiments
         self.experiments = []
@@ -146,6 +152,21 @@ class ExtensibleTrainer(BaseModel):
         # Setting this to false triggers SRGAN to call the models update_model() function on the first iteration.
         self.updated = True
 
+    # Splits the parameters of every network into the ones that can be trained and the ones that are always frozen, so
+    # that optimize_parameters() does not need to re-inspect every parameter on every step.
+    def build_param_groups(self):
+        self.trainable_params = {}
+        for name, net in self.networks.items():
+            trainable = []
+            for p in net.parameters():
+                if p.dtype != torch.int64 and p.dtype != torch.bool and not hasattr(p, "DO_NOT_TRAIN"):
+                    trainable.append(p)
+                else:
+                    p.requires_grad = False
+            self.trainable_params[name] = trainable
+        # The requires_grad value last applied to the trainable parameters of each network. None=unknown.
+        self.requires_grad_state = {name: None for name in self.networks.keys()}
+
     def feed_data(self, data, step, need_GT=True):
         self.env['step'] = step
         self.batch_factor = self.mega_batch_factor
@@ -160,11 +181,15 @@ class ExtensibleTrainer(BaseModel):
         self.eval_state = {}
         for o in self.optimizers:
             o.zero_grad()
-        torch.cuda.empty_cache()
+        # Flushing the CUDA cache every step is expensive; it is only done when explicitly requested.
+        if self.opt['train'] and self.opt['train']['empty_cache_every_step']:
+            torch.cuda.empty_cache()
 
         self.dstate = {}
         for k, v in data.items():
             if isinstance(v, torch.Tensor):
+                # When the batch was already staged on the device (see data/device_prefetcher.py), the chunks are
+                # views and .to() is a no-op.
                 self.dstate[k] = [t.to(self.device) for t in torch.chunk(v, chunks=self.batch_factor, dim=0)]
 
     def optimize_parameters(self, step):
@@ -196,20 +221,25 @@ class ExtensibleTrainer(BaseModel):
             if train_step:
                 # Only set requires_grad=True for the network being trained.
                 nets_to_train = s.get_networks_trained()
-                enabled = 0
-                for name, net in self.networks.items():
-                    net_enabled = name in nets_to_train
-                    if net_enabled:
-                        enabled += 1
-                    # Networks can opt out of training before a certain iteration by declaring 'after' in their definition.
-                    if 'after' in self.opt['networks'][name].keys() and step < self.opt['networks'][name]['after']:
-                        net_enabled = False
-                    for p in net.parameters():
-                        if p.dtype != torch.int64 and p.dtype != torch.bool and not hasattr(p, "DO_NOT_TRAIN"):
-                            p.requires_grad = net_enabled
+                with self.profiler.time('requires_grad'):
+                    enabled = 0
+                    skipped_params = 0
+                    for name in self.networks.keys():
+                        net_enabled = name in nets_to_train
+                        if net_enabled:
+                            enabled += 1
+                        # Networks can opt out of training before a certain iteration by declaring 'after' in their definition.
+                        if 'after' in self.opt['networks'][name].keys() and step < self.opt['networks'][name]['after']:
+                            net_enabled = False
+                        # Only touch the parameters of networks whose state differs from what the last step left.
+                        if self.requires_grad_state[name] != net_enabled:
+                            for p in self.trainable_params[name]:
+                                p.requires_grad = net_enabled
+                            self.requires_grad_state[name] = net_enabled
                         else:
-                            p.requires_grad = False
-                assert enabled == len(nets_to_train)
+                            skipped_params += len(self.trainable_params[name])
+                    assert enabled == len(nets_to_train)
+                self.profiler.count('requires_grad_skipped_params', skipped_params)
 
                 # Update experiments
                 [e.before_step(self.opt, self.step_names[step_num], self.env, nets_to_train, state) for e in self.experiments]
@@ -219,13 +249,14 @@ class ExtensibleTrainer(BaseModel):
 
             # Now do a forward and backward pass for each gradient accumulation step.
             new_states = {}
-            for m in range(self.batch_factor):
-                ns = s.do_forward_backward(state, m, step_num, train=train_step)
-                for k, v in ns.items():
-                    if k not in new_states.keys():
-                        new_states[k] = [v]
-                    else:
-                        new_states[k].append(v)
+            with self.profiler.time('%s_forward_backward' % (self.step_names[step_num],)):
+                for m in range(self.batch_factor):
+                    ns = s.do_forward_backward(state, m, step_num, train=train_step)
+                    for k, v in ns.items():
+                        if k not in new_states.keys():
+                            new_states[k] = [v]
+                        else:
+                            new_states[k].append(v)
 
             # Push the detached new state tensors into the state map for use with the next step.
             for k, v in new_states.items():
@@ -236,7 +267,8 @@ class ExtensibleTrainer(BaseModel):
             if train_step:
                 # And finally perform optimization.
                 [e.before_optimize(state) for e in self.experiments]
-                s.do_step(step)
+                with self.profiler.time('%s_optimizer' % (self.step_names[step_num],)):
+                    s.do_step(step)
                 [e.after_optimize(state) for e in self.experiments]
 
         # Record visual outputs for usage in debugging and testing.
@@ -265,13 +297,18 @@ class ExtensibleTrainer(BaseModel):
                     os.makedirs(model_vdbg_dir, exist_ok=True)
                     net.module.visual_dbg(step, model_vdbg_dir)
 
-    def compute_fea_loss(self, real, fake):
+    def compute_fea_loss(self, real, fake, per_sample=False):
         with torch.no_grad():
             logits_real = self.netF(real.to(self.device))
             logits_fake = self.netF(fake.to(self.device))
+        if per_sample:
+            # The L1 loss of every batch element, rather than the mean over the whole batch.
+            return (logits_fake - logits_real).abs().flatten(1).mean(dim=1)
         return nn.L1Loss().to(self.device)(logits_fake, logits_real)
 
-    def test(self):
+    # Runs the model in eval mode and stores the results in self.eval_state. When to_cpu=False, the results are left on
+    # the device so callers can compute metrics on them without a round trip to the host.
+    def test(self, to_cpu=True):
         for net in self.netsG.values():
             net.eval()
 
@@ -295,11 +332,12 @@ class ExtensibleTrainer(BaseModel):
                         state[k] = [v]
 
             self.eval_state = {}
+            move = (lambda t: t.detach().cpu()) if to_cpu else (lambda t: t.detach())
             for k, v in state.items():
                 if isinstance(v, list):
-                    self.eval_state[k] = [s.detach().cpu() if isinstance(s, torch.Tensor) else s for s in v]
+                    self.eval_state[k] = [move(s) if isinstance(s, torch.Tensor) else s for s in v]
                 else:
-                    self.eval_state[k] = [v.detach().cpu() if isinstance(v, torch.Tensor) else v]
+                    self.eval_state[k] = [move(v) if isinstance(v, torch.Tensor) else v]
 
         for net in self.netsG.values():
             net.train()
@@ -318,16 +356,19 @@ class ExtensibleTrainer(BaseModel):
             if hasattr(net.module, "get_debug_values"):
                 log.update(net.module.get_debug_values(step, net_name))
 
+        log.update(self.profiler.get_log())
+
         # Log learning rate (from first param group) too.
         for o in self.optimizers:
             log['learning_rate_%s' % (o._config['network'],)] = o.param_groups[0]['lr']
         return log
 
-    def get_current_visuals(self, need_GT=True):
+    def get_current_visuals(self, need_GT=True, on_device=False):
         # Conforms to an archaic format from MMSR.
-        return {'lq': self.eval_state['lq'][0].float().cpu(),
-                'hq': self.eval_state['hq'][0].float().cpu(),
-                'rlt': self.eval_state[self.opt['eval']['output_state']][0].float().cpu()}
+        move = (lambda t: t.float()) if on_device else (lambda t: t.float().cpu())
+        return {'lq': move(self.eval_state['lq'][0]),
+                'hq': move(self.eval_state['hq'][0]),
+                'rlt': move(self.eval_state[self.opt['eval']['output_state']][0])}
 
     def print_network(self):
         for name, net in self.networks.items():
@@ -5,6 +5,7 @@ import torch.nn as nn
 from torch.nn.parallel.distributed import DistributedDataParallel
 
 import utils.util
+from utils.checkpoint_writer import CheckpointWriter
 
 
 class BaseModel():
@@ -20,6 +21,10 @@ class BaseModel():
         self.schedulers = []
         self.optimizers = []
         self.disc_optimizers = []
+        # Checkpoints are written on a background thread when logger.async_checkpoint is set.
+        self.checkpoint_writer = CheckpointWriter(
+            asynchronous=utils.util.opt_get(opt, ['logger', 'async_checkpoint'], False),
+            keep_last=utils.util.opt_get(opt, ['logger', 'keep_last_checkpoints'], None))
 
     def feed_data(self, data):
         pass
@@ -85,15 +90,18 @@ class BaseModel():
         if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
             network = network.module
         state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
-        torch.save(state_dict, save_path)
+        if not self.checkpoint_writer.asynchronous:
+            for key, param in state_dict.items():
+                state_dict[key] = param.cpu()
+        paths = [save_path]
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
         if 'alt_path' in self.opt['path'].keys():
-            torch.save(state_dict, os.path.join(self.opt['path']['alt_path'], save_filename))
+            paths.append(os.path.join(self.opt['path']['alt_path'], save_filename))
+        on_written = None
         if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
+            on_written = lambda: utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                                                 save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
+        self.checkpoint_writer.save(state_dict, paths, group=network_label, on_written=on_written)
         return save_path
 
     def load_network(self, load_path, network, strict=True):
@@ -125,13 +133,15 @@ class BaseModel():
             state['amp'] = amp.state_dict()
         save_filename = '{}.state'.format(iter_step)
         save_path = os.path.join(self.opt['path']['training_state'], save_filename)
-        torch.save(state, save_path)
+        paths = [save_path]
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
         if 'alt_path' in self.opt['path'].keys():
-            torch.save(state, os.path.join(self.opt['path']['alt_path'], 'latest.state'))
+            paths.append(os.path.join(self.opt['path']['alt_path'], 'latest.state'))
+        on_written = None
         if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
+            on_written = lambda: utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                                                 save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
+        self.checkpoint_writer.save(state, paths, group='training_state', on_written=on_written)
 
     def resume_training(self, resume_state, load_amp=True):
         """Resume the optimizers and schedulers for training"""
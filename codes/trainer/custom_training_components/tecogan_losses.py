@@ -6,10 +6,14 @@ from models.flownet2.networks import Resample2d
 from trainer.injectors import Injector
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
+import logging
 import os
 import os.path as osp
 import torchvision
 
+logger = logging.getLogger('base')
+
 
 def create_teco_loss(opt, env):
     type = opt['type']
@@ -180,12 +184,59 @@ class FlowAdjustment(Injector):
             return {self.output: self.resample(state[self.flowed], flowfield)}
 
 
-def create_teco_discriminator_sextuplet(input_list, lr_imgs, scale, index, flow_gen, resampler, margin):
+# Flow fields of real image sequences, kept for the duration of a single training iteration. The real sequence is the
+# same tensor in every step of an iteration (e.g. for both the generator's and the discriminator's TecoGanLoss) and its
+# flows don't depend on any generator, so they only need to be computed once. Entries are keyed by the flow network,
+# the identity of the sequence tensor and the (from, to) frame indices; the entry keeps the sequence alive so its id
+# can't be reused by another tensor. Nothing is cached while the flow network itself is being trained.
+#
+# Note that the flows computed by RecurrentImageGeneratorSequenceInjector and FlowAdjustment always involve a generated
+# frame, so they can't be shared and don't go through this cache.
+class FlowCache:
+    def __init__(self, step):
+        self.step = step
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the flows between sequence[:, i] and sequence[:, j] for every (i, j) in pairs, concatenated along the
+    # batch dimension.
+    def flows(self, flow_gen, sequence, pairs):
+        sequence_float = sequence.float()
+        compute = lambda ps: flow_gen(torch.cat([torch.stack([sequence_float[:, i], sequence_float[:, j]], dim=2)
+                                                 for i, j in ps], dim=0))
+        if torch.is_grad_enabled() and any(p.requires_grad for p in flow_gen.parameters()):
+            return compute(pairs)
+        missing = [p for p in pairs if (id(flow_gen), id(sequence), p) not in self.entries.keys()]
+        self.hits += len(pairs) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            with torch.no_grad():
+                computed = compute(missing)
+            b = sequence.shape[0]
+            for n, p in enumerate(missing):
+                self.entries[(id(flow_gen), id(sequence), p)] = (sequence, computed[b*n:b*(n+1)])
+        return torch.cat([self.entries[(id(flow_gen), id(sequence), p)][1] for p in pairs], dim=0)
+
+
+# Returns the FlowCache of the current training iteration.
+def get_flow_cache(env):
+    if 'flow_cache' not in env.keys() or env['flow_cache'].step != env['step']:
+        env['flow_cache'] = FlowCache(env['step'])
+    return env['flow_cache']
+
+
+def create_teco_discriminator_sextuplet(input_list, lr_imgs, scale, index, flow_gen, resampler, margin, flow_cache=None):
     # Flow is interpreted from the LR images so that the generator cannot learn to manipulate it.
     with autocast(enabled=False):
         triplet = input_list[:, index:index+3].float()
-        first_flow = flow_gen(torch.stack([triplet[:,1], triplet[:,0]], dim=2))
-        last_flow = flow_gen(torch.stack([triplet[:,1], triplet[:,2]], dim=2))
+        if flow_cache is not None:
+            b = triplet.shape[0]
+            flows = flow_cache.flows(flow_gen, input_list, [(index+1, index), (index+1, index+2)])
+            first_flow, last_flow = flows[:b], flows[b:]
+        else:
+            first_flow = flow_gen(torch.stack([triplet[:,1], triplet[:,0]], dim=2))
+            last_flow = flow_gen(torch.stack([triplet[:,1], triplet[:,2]], dim=2))
         flow_triplet = [resampler(triplet[:,0], first_flow),
                         triplet[:,1],
                         resampler(triplet[:,2], last_flow)]
@@ -197,15 +248,20 @@ def create_teco_discriminator_sextuplet(input_list, lr_imgs, scale, index, flow_
     return combined[:, :, margin:-margin, margin:-margin]
 
 
-def create_all_discriminator_sextuplets(input_list, lr_imgs, scale, total, flow_gen, resampler, margin):
+def create_all_discriminator_sextuplets(input_list, lr_imgs, scale, total, flow_gen, resampler, margin, flow_cache=None):
     with autocast(enabled=False):
+        sequence = input_list
         input_list = input_list.float()        
         # Combine everything and feed it into the flow network at once for better efficiency.
         batch_sz = input_list.shape[0]
-        flux_doubles_forward = [torch.stack([input_list[:,i], input_list[:,i+1]], dim=2) for i in range(1, total+1)]
-        flux_doubles_backward = [torch.stack([input_list[:,i], input_list[:,i-1]], dim=2) for i in range(1, total+1)]
-        flows_forward = flow_gen(torch.cat(flux_doubles_forward, dim=0))
-        flows_backward = flow_gen(torch.cat(flux_doubles_backward, dim=0))
+        if flow_cache is not None:
+            flows_forward = flow_cache.flows(flow_gen, sequence, [(i, i+1) for i in range(1, total+1)])
+            flows_backward = flow_cache.flows(flow_gen, sequence, [(i, i-1) for i in range(1, total+1)])
+        else:
+            flux_doubles_forward = [torch.stack([input_list[:,i], input_list[:,i+1]], dim=2) for i in range(1, total+1)]
+            flux_doubles_backward = [torch.stack([input_list[:,i], input_list[:,i-1]], dim=2) for i in range(1, total+1)]
+            flows_forward = flow_gen(torch.cat(flux_doubles_forward, dim=0))
+            flows_backward = flow_gen(torch.cat(flux_doubles_backward, dim=0))
         sexts = []
         for i in range(total):
             flow_forward = flows_forward[batch_sz*i:batch_sz*(i+1)]
@@ -251,17 +307,29 @@ class TecoGanLoss(ConfigurableLoss):
         self.ff = opt['fast_forward'] if 'fast_forward' in opt.keys() else False
         self.noise = opt['noise'] if 'noise' in opt.keys() else 0
         self.gradient_penalty = opt['gradient_penalty'] if 'gradient_penalty' in opt.keys() else False
+        self.cache_real_flows = opt['cache_real_flows'] if 'cache_real_flows' in opt.keys() else True
+        # Discriminator micro-batching, see micro_batch_forward(). Either a number of sextuplets or 'auto'.
+        self.micro_batch_size = opt['micro_batch_size'] if 'micro_batch_size' in opt.keys() else None
+        self.micro_batch_memory = opt['micro_batch_memory_mb'] * 1024 * 1024 if 'micro_batch_memory_mb' in opt.keys() else None
+        self.probed_micro_batch_size = None
 
     def forward(self, _, state):
-        if self.ff:
-            return self.fast_forward(state)
+        flow_cache = get_flow_cache(self.env) if self.cache_real_flows else None
+        hits = flow_cache.hits if flow_cache is not None else 0
+        if self.micro_batch_size is not None:
+            loss = self.micro_batch_forward(state, flow_cache)
+        elif self.ff:
+            loss = self.fast_forward(state, flow_cache)
         else:
-            return self.lowmem_forward(state)
+            loss = self.lowmem_forward(state, flow_cache)
+        if flow_cache is not None:
+            self.metrics.append(("flow_cache_hits", flow_cache.hits - hits))
+        return loss
 
 
     # Computes the discriminator loss one recursive step at a time, which has a lower memory overhead but is
     # slower.
-    def lowmem_forward(self, state):
+    def lowmem_forward(self, state, flow_cache=None):
         flow_gen = self.env['generators'][self.image_flow_generator]
         real = state[self.opt['real']]
         fake = state[self.opt['fake']]
@@ -271,7 +339,8 @@ class TecoGanLoss(ConfigurableLoss):
 
         # Create a list of all the discriminator inputs, which will be reduced into the batch dim for efficient computation.
         for i in range(sequence_len - 2):
-            real_sext = create_teco_discriminator_sextuplet(real, lr, self.scale, i, flow_gen, self.resampler, self.margin)
+            real_sext = create_teco_discriminator_sextuplet(real, lr, self.scale, i, flow_gen, self.resampler, self.margin,
+                                                            flow_cache)
             if self.gradient_penalty:
                 real_sext.requires_grad_()
             fake_sext = create_teco_discriminator_sextuplet(fake, lr, self.scale, i, flow_gen, self.resampler, self.margin)
@@ -286,7 +355,7 @@ class TecoGanLoss(ConfigurableLoss):
 
     # Computes the discriminator loss by dogpiling all of the sextuplets into the batch dimension and doing one massive
     # forward() on the discriminators. High memory but faster.
-    def fast_forward(self, state):
+    def fast_forward(self, state, flow_cache=None):
         flow_gen = self.env['generators'][self.image_flow_generator]
         real = state[self.opt['real']]
         fake = state[self.opt['fake']]
@@ -295,7 +364,7 @@ class TecoGanLoss(ConfigurableLoss):
 
         # Create a list of all the discriminator inputs, which will be reduced into the batch dim for efficient computation.
         combined_real_sext = create_all_discriminator_sextuplets(real, lr, self.scale, sequence_len - 2, flow_gen,
-                                                                 self.resampler, self.margin)
+                                                                 self.resampler, self.margin, flow_cache)
         if self.gradient_penalty:
             combined_real_sext.requires_grad_()
         combined_fake_sext = create_all_discriminator_sextuplets(fake, lr, self.scale, sequence_len - 2, flow_gen,
@@ -308,15 +377,98 @@ class TecoGanLoss(ConfigurableLoss):
             l_total = l_total + gp
         return l_total
 
-    def compute_loss(self, real_sext, fake_sext):
+    # Builds the same combined sextuplets as fast_forward(), but feeds them through the discriminator in micro-batches
+    # of at most micro_batch_size sextuplets. Each micro-batch is checkpointed, so only one micro-batch worth of
+    # discriminator activations is alive at a time, in the forward pass and when it is recomputed during backward. The
+    # price is that recomputation: backward costs roughly one extra discriminator forward pass over all sextuplets. The
+    # discriminator outputs are concatenated before the loss is computed, so the loss (including the batch means that
+    # ragan takes) is identical to fast_forward()'s, as long as the discriminator doesn't mix samples across the batch
+    # (e.g. through train-mode batch norm).
+    #
+    # With micro_batch_size='auto', the size is derived from micro_batch_memory_mb (or from half of the free device
+    # memory if that isn't given) and the memory a single sextuplet was measured to need on the first call.
+    def micro_batch_forward(self, state, flow_cache=None):
+        net = self.env['discriminators'][self.opt['discriminator']]
+        flow_gen = self.env['generators'][self.image_flow_generator]
+        real = state[self.opt['real']]
+        fake = state[self.opt['fake']]
+        sequence_len = real.shape[1]
+        lr = state[self.opt['lr_inputs']]
+
+        combined_real_sext = create_all_discriminator_sextuplets(real, lr, self.scale, sequence_len - 2, flow_gen,
+                                                                 self.resampler, self.margin, flow_cache)
+        if self.gradient_penalty:
+            combined_real_sext.requires_grad_()
+        combined_fake_sext = create_all_discriminator_sextuplets(fake, lr, self.scale, sequence_len - 2, flow_gen,
+                                                                 self.resampler, self.margin)
+        micro_batch = self.get_micro_batch_size(net, combined_fake_sext)
+        self.metrics.append(("micro_batch_size", micro_batch))
+        l_total, d_real = self.compute_loss(combined_real_sext, combined_fake_sext, micro_batch)
+        if l_total < self.min_loss:
+            l_total = 0
+        elif self.gradient_penalty:
+            gp = gradient_penalty(combined_real_sext, d_real)
+            l_total = l_total + gp
+        return l_total
+
+    def get_micro_batch_size(self, net, sext):
+        if self.micro_batch_size != 'auto':
+            return self.micro_batch_size
+        if self.probed_micro_batch_size is None:
+            if sext.device.type != 'cuda':
+                # Nothing to measure against; fall back to a single batch.
+                self.probed_micro_batch_size = sext.shape[0]
+            else:
+                budget = self.micro_batch_memory
+                if budget is None:
+                    budget = torch.cuda.mem_get_info(sext.device)[0] / 2
+                per_sext = self.probe_sextuplet_memory(net, sext)
+                self.probed_micro_batch_size = max(1, int(budget // per_sext))
+            logger.info("TecoGanLoss %s: discriminating %i sextuplets per micro-batch." %
+                        (self.opt['discriminator'], self.probed_micro_batch_size))
+        return self.probed_micro_batch_size
+
+    # Measures the peak memory a forward and backward pass of the discriminator needs for a single sextuplet. The pass
+    # runs in the discriminator's current mode so the measurement matches the real one, but leaves no trace: only the
+    # gradient w.r.t. the input is taken (so .grad is untouched), buffers such as batch norm running stats are restored
+    # afterwards and the RNG state is forked.
+    def probe_sextuplet_memory(self, net, sext):
+        device = sext.device
+        buffers = [(b, b.clone()) for b in net.buffers()]
+        with torch.random.fork_rng(devices=[device]):
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            probe = sext[:1].detach().requires_grad_()
+            with autocast(enabled=self.env['opt']['fp16']):
+                d = net(probe)
+            torch.autograd.grad(d.float().sum(), probe)
+            torch.cuda.synchronize(device)
+            peak = torch.cuda.max_memory_allocated(device) - base
+        with torch.no_grad():
+            for b, saved in buffers:
+                b.copy_(saved)
+        return max(1, peak)
+
+    def discriminate(self, net, sext, micro_batch=None):
         fp16 = self.env['opt']['fp16']
+
+        def run(x):
+            with autocast(enabled=fp16):
+                return net(x)
+
+        if micro_batch is None or micro_batch >= sext.shape[0]:
+            return run(sext)
+        return torch.cat([torch.utils.checkpoint.checkpoint(run, chunk, use_reentrant=False)
+                          for chunk in torch.split(sext, micro_batch)], dim=0)
+
+    def compute_loss(self, real_sext, fake_sext, micro_batch=None):
         net = self.env['discriminators'][self.opt['discriminator']]
         if self.noise != 0:
             real_sext = real_sext + torch.rand_like(real_sext) * self.noise
             fake_sext = fake_sext + torch.rand_like(fake_sext) * self.noise
-        with autocast(enabled=fp16):
-            d_fake = net(fake_sext)
-            d_real = net(real_sext)
+        d_fake = self.discriminate(net, fake_sext, micro_batch)
+        d_real = self.discriminate(net, real_sext, micro_batch)
 
         self.metrics.append(("d_fake", torch.mean(d_fake)))
         self.metrics.append(("d_real", torch.mean(d_real)))
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+from pytorch_fid.fid_score import calculate_frechet_distance
+from pytorch_fid.inception import InceptionV3
+
+# In-memory FID computation for the evaluators. Rather than writing samples to disk and handing directories to
+# pytorch_fid, batches are pushed straight through the Inception network and only running sums of the activations are
+# kept, from which the mean and covariance are derived at the end.
+
+IMAGE_EXTENSIONS = {'bmp', 'jpg', 'jpeg', 'pgm', 'png', 'ppm', 'tif', 'tiff', 'webp'}
+
+# One Inception network per (device, dims), shared by every evaluator in the process.
+_inception_models = {}
+
+
+def get_inception(device, dims=2048):
+    key = (str(device), dims)
+    if key not in _inception_models.keys():
+        model = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[dims]]).to(device)
+        model.eval()
+        _inception_models[key] = model
+    return _inception_models[key]
+
+
+# Rounds images in [0,1] to the values they would have after a round trip through an 8-bit PNG, the way
+# torchvision.utils.save_image() writes them, so that scores are comparable with the file-based computation.
+def quantize_like_png(img):
+    return torch.floor(img * 255 + .5).clamp(0, 255) / 255
+
+
+# Accumulates the sum and the sum of outer products of Inception activations in float64 on the device.
+class FidStatistics:
+    def __init__(self, device, dims=2048):
+        self.device = device
+        self.dims = dims
+        self.model = get_inception(device, dims)
+        self.n = 0
+        self.sum = torch.zeros(dims, dtype=torch.float64, device=device)
+        self.sum_outer = torch.zeros(dims, dims, dtype=torch.float64, device=device)
+
+    # images are (b,3,h,w) in [0,1].
+    def update(self, images):
+        with torch.no_grad():
+            acts = self.model(quantize_like_png(images.float().to(self.device)))[0]
+        acts = acts.reshape(acts.shape[0], -1).double()
+        self.n += acts.shape[0]
+        self.sum += acts.sum(dim=0)
+        self.sum_outer += acts.t() @ acts
+
+    # Returns (mu, sigma) as numpy arrays, matching np.mean / np.cov(rowvar=False) over all of the activations.
+    def mean_and_covariance(self):
+        mu = self.sum / self.n
+        sigma = (self.sum_outer - self.n * (mu[:, None] * mu[None, :])) / (self.n - 1)
+        return mu.cpu().numpy(), sigma.cpu().numpy()
+
+
+def list_images(path):
+    return sorted(osp.join(path, f) for f in os.listdir(path) if f.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS)
+
+
+# Computes FID statistics of a directory of images, streaming them through Inception batch_size at a time. Images of
+# different sizes are fine; consecutive images are only batched together when their sizes match.
+def compute_statistics_of_path(path, device, batch_size=32, dims=2048):
+    stats = FidStatistics(device, dims)
+    batch = []
+    for f in list_images(path):
+        img = torchvision.transforms.functional.to_tensor(Image.open(f).convert('RGB'))
+        if len(batch) > 0 and (len(batch) == batch_size or batch[0].shape != img.shape):
+            stats.update(torch.stack(batch, dim=0))
+            batch = []
+        batch.append(img)
+    if len(batch) > 0:
+        stats.update(torch.stack(batch, dim=0))
+    return stats.mean_and_covariance()
+
+
+# Caches real-set statistics in memory and, optionally, in .npz files under cache_dir so that they are computed once
+# rather than on every evaluation. Entries are keyed by the dataset path plus a caller-provided description of its size
+# (e.g. the number of images and the resolution they are evaluated at), so changing the dataset invalidates them.
+class RealStatisticsCache:
+    memory = {}
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+    def _file(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return osp.join(self.cache_dir, 'fid_stats_%s.npz' % (digest,))
+
+    def get(self, key):
+        if key in self.memory.keys():
+            return self.memory[key]
+        if self.cache_dir is not None and osp.exists(self._file(key)):
+            cached = np.load(self._file(key))
+            self.memory[key] = (cached['mu'], cached['sigma'])
+            return self.memory[key]
+        return None
+
+    def put(self, key, mu, sigma):
+        self.memory[key] = (mu, sigma)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._file(key) + '.tmp.npz'
+            np.savez(tmp, mu=mu, sigma=sigma)
+            os.replace(tmp, self._file(key))
+
+    # Returns the statistics of a directory of real images (or of a pytorch_fid-style .npz of precomputed statistics).
+    def for_path(self, path, device, batch_size=32, dims=2048):
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                return f['mu'][:], f['sigma'][:]
+        files = list_images(path)
+        key = (osp.abspath(path), len(files), sum(osp.getsize(f) for f in files), dims)
+        stats = self.get(key)
+        if stats is None:
+            stats = compute_statistics_of_path(path, device, batch_size, dims)
+            self.put(key, *stats)
+        return stats
+
+
+def frechet_distance(real_stats, fake_stats):
+    return calculate_frechet_distance(real_stats[0], real_stats[1], fake_stats[0], fake_stats[1])
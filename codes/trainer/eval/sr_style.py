@@ -6,11 +6,12 @@ import torchvision
 from torch.utils.data import BatchSampler
 
 import trainer.eval.evaluator as evaluator
-from pytorch_fid import fid_score
+from trainer.eval.fid import FidStatistics, RealStatisticsCache, frechet_distance
 
 
 # Evaluate that feeds a LR structure into the input, then calculates a FID score on the results added to
-# the interpolated LR structure.
+# the interpolated LR structure. Like StyleTransferEvaluator, samples are only written to disk when 'dump_samples' is
+# set, and the statistics of the real images are computed on the first evaluation and cached afterwards.
 from data.stylegan2_dataset import Stylegan2Dataset
 
 
@@ -29,29 +30,43 @@ class SrStyleTransferEvaluator(evaluator.Evaluator):
                                          'aug_prob': 0,
                                          'transparent': False})
         self.sampler = BatchSampler(self.dataset, self.batch_sz, False)
+        self.dump_samples = opt_eval['dump_samples'] if 'dump_samples' in opt_eval.keys() else False
+        self.real_stats_cache = RealStatisticsCache(opt_eval['fid_cache_dir'] if 'fid_cache_dir' in opt_eval.keys() else None)
+        self.real_stats_key = (osp.abspath(self.fid_real_samples), len(self.dataset), self.im_sz, self.batch_sz)
 
     def perform_eval(self):
         embedding_generator = self.env['generators'][self.embedding_generator]
         fid_fake_path = osp.join(self.env['base_path'], "../../models", "fid_fake", str(self.env["step"]))
-        os.makedirs(fid_fake_path, exist_ok=True)
         fid_real_path = osp.join(self.env['base_path'], "../../models", "fid_real", str(self.env["step"]))
-        os.makedirs(fid_real_path, exist_ok=True)
+        if self.dump_samples:
+            os.makedirs(fid_fake_path, exist_ok=True)
+            os.makedirs(fid_real_path, exist_ok=True)
+        real_stats = self.real_stats_cache.get(self.real_stats_key)
+        real_accumulator = FidStatistics(self.env['device']) if real_stats is None else None
+        fake_stats = FidStatistics(self.env['device'])
         counter = 0
-        for batch in self.sampler:
-            noise = torch.FloatTensor(self.batch_sz, 3, self.im_sz, self.im_sz).uniform_(0., 1.).to(self.env['device'])
-            batch_hq = [e['hq'] for e in batch]
-            batch_hq = torch.stack(batch_hq, dim=0).to(self.env['device'])
-            resized_batch = torch.nn.functional.interpolate(batch_hq, scale_factor=1/self.scale, mode="area")
-            embedding = embedding_generator(resized_batch)
-            gen = self.model(noise, embedding)
-            if not isinstance(gen, list) and not isinstance(gen, tuple):
-                gen = [gen]
-            gen = gen[self.gen_output_index]
-            out = gen + torch.nn.functional.interpolate(resized_batch, scale_factor=self.scale, mode='bilinear')
-            for b in range(self.batch_sz):
-                torchvision.utils.save_image(out[b], osp.join(fid_fake_path, "%i_.png" % (counter)))
-                torchvision.utils.save_image(batch_hq[b], osp.join(fid_real_path, "%i_.png" % (counter)))
-                counter += 1
-
-        return {"fid": fid_score.calculate_fid_given_paths([fid_real_path, fid_fake_path], self.batch_sz, True,
-                                                           2048)}
+        with torch.no_grad():
+            for batch in self.sampler:
+                noise = torch.FloatTensor(self.batch_sz, 3, self.im_sz, self.im_sz).uniform_(0., 1.).to(self.env['device'])
+                batch_hq = [e['hq'] for e in batch]
+                batch_hq = torch.stack(batch_hq, dim=0).to(self.env['device'])
+                resized_batch = torch.nn.functional.interpolate(batch_hq, scale_factor=1/self.scale, mode="area")
+                embedding = embedding_generator(resized_batch)
+                gen = self.model(noise, embedding)
+                if not isinstance(gen, list) and not isinstance(gen, tuple):
+                    gen = [gen]
+                gen = gen[self.gen_output_index]
+                out = gen + torch.nn.functional.interpolate(resized_batch, scale_factor=self.scale, mode='bilinear')
+                fake_stats.update(out.clamp(0, 1))
+                if real_accumulator is not None:
+                    real_accumulator.update(batch_hq.clamp(0, 1))
+                if self.dump_samples:
+                    for b in range(self.batch_sz):
+                        torchvision.utils.save_image(out[b], osp.join(fid_fake_path, "%i_.png" % (counter)))
+                        torchvision.utils.save_image(batch_hq[b], osp.join(fid_real_path, "%i_.png" % (counter)))
+                        counter += 1
+
+        if real_stats is None:
+            real_stats = real_accumulator.mean_and_covariance()
+            self.real_stats_cache.put(self.real_stats_key, *real_stats)
+        return {"fid": frechet_distance(real_stats, fake_stats.mean_and_covariance())}
@@ -4,10 +4,12 @@ import torch
 import os.path as osp
 import torchvision
 import trainer.eval.evaluator as evaluator
-from pytorch_fid import fid_score
+from trainer.eval.fid import FidStatistics, RealStatisticsCache, frechet_distance
 
 
 # Evaluate that generates uniform noise to feed into a generator, then calculates a FID score on the results.
+# Generated batches are fed straight into Inception; they are only written to disk when 'dump_samples' is set. The
+# statistics of the real set are computed once and cached (in 'fid_cache_dir', if given).
 class StyleTransferEvaluator(evaluator.Evaluator):
     def __init__(self, model, opt_eval, env):
         super().__init__(model, opt_eval, env)
@@ -16,20 +18,27 @@ class StyleTransferEvaluator(evaluator.Evaluator):
         self.im_sz = opt_eval['image_size']
         self.fid_real_samples = opt_eval['real_fid_path']
         self.gen_output_index = opt_eval['gen_index'] if 'gen_index' in opt_eval.keys() else 0
+        self.dump_samples = opt_eval['dump_samples'] if 'dump_samples' in opt_eval.keys() else False
+        self.real_stats_cache = RealStatisticsCache(opt_eval['fid_cache_dir'] if 'fid_cache_dir' in opt_eval.keys() else None)
 
     def perform_eval(self):
         fid_fake_path = osp.join(self.env['base_path'], "../../models", "fid", str(self.env["step"]))
-        os.makedirs(fid_fake_path, exist_ok=True)
+        if self.dump_samples:
+            os.makedirs(fid_fake_path, exist_ok=True)
+        fake_stats = FidStatistics(self.env['device'])
         counter = 0
-        for i in range(self.batches_per_eval):
-            batch = torch.FloatTensor(self.batch_sz, 3, self.im_sz, self.im_sz).uniform_(0., 1.).to(self.env['device'])
-            gen = self.model(batch)
-            if not isinstance(gen, list) and not isinstance(gen, tuple):
-                gen = [gen]
-            gen = gen[self.gen_output_index]
-            for b in range(self.batch_sz):
-                torchvision.utils.save_image(gen[b], osp.join(fid_fake_path, "%i_.png" % (counter)))
-                counter += 1
+        with torch.no_grad():
+            for i in range(self.batches_per_eval):
+                batch = torch.FloatTensor(self.batch_sz, 3, self.im_sz, self.im_sz).uniform_(0., 1.).to(self.env['device'])
+                gen = self.model(batch)
+                if not isinstance(gen, list) and not isinstance(gen, tuple):
+                    gen = [gen]
+                gen = gen[self.gen_output_index]
+                fake_stats.update(gen.clamp(0, 1))
+                if self.dump_samples:
+                    for b in range(self.batch_sz):
+                        torchvision.utils.save_image(gen[b], osp.join(fid_fake_path, "%i_.png" % (counter)))
+                        counter += 1
 
-        return {"fid": fid_score.calculate_fid_given_paths([self.fid_real_samples, fid_fake_path], self.batch_sz, True,
-                                                           2048)}
+        real_stats = self.real_stats_cache.for_path(self.fid_real_samples, self.env['device'], self.batch_sz)
+        return {"fid": frechet_distance(real_stats, fake_stats.mean_and_covariance())}
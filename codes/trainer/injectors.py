@@ -1,6 +1,8 @@
 import os
 import random
 
+import logging
+
 import torch.nn
 import torchvision
 from torch.cuda.amp import autocast
@@ -8,6 +10,8 @@ from torch.cuda.amp import autocast
 from utils.weight_scheduler import get_scheduler_for_opt
 from trainer.losses import extract_params_from_state
 
+logger = logging.getLogger('base')
+
 # Injectors are a way to sythesize data within a step that can then be used (and reused) by loss functions.
 def create_injector(opt_inject, env):
     type = opt_inject['type']
@@ -59,6 +63,8 @@ def create_injector(opt_inject, env):
         return MixAndLabelInjector(opt_inject, env)
     elif type == 'save_images':
         return SaveImages(opt_inject, env)
+    elif type == 'image_corruption':
+        return ImageCorruptionInjector(opt_inject, env)
     else:
         raise NotImplementedError
 
@@ -82,19 +88,77 @@ class ImageGeneratorInjector(Injector):
     def __init__(self, opt, env):
         super(ImageGeneratorInjector, self).__init__(opt, env)
         self.grad = opt['grad'] if 'grad' in opt.keys() else True
+        # Whether losses may batch their generator passes into this injector's, see forward_fused().
+        self.fuse_aux = opt['fuse_aux'] if 'fuse_aux' in opt.keys() else False
+        self.logged_batch_norm = False
 
-    def forward(self, state):
+    def _params(self, state):
+        if isinstance(self.input, list):
+            return extract_params_from_state(self.input, state)
+        return [state[self.input]]
+
+    def _generate(self, params):
         gen = self.env['generators'][self.opt['generator']]
         with autocast(enabled=self.env['opt']['fp16']):
-            if isinstance(self.input, list):
-                params = extract_params_from_state(self.input, state)
-            else:
-                params = [state[self.input]]
             if self.grad:
-                results = gen(*params)
-            else:
-                with torch.no_grad():
-                    results = gen(*params)
+                return gen(*params)
+            with torch.no_grad():
+                return gen(*params)
+
+    def forward(self, state):
+        return self._to_state(self._generate(self._params(state)))
+
+    # Runs the generator once over the regular inputs concatenated along the batch dimension with aux_inputs, a list of
+    # argument lists for other passes through the same generator (e.g. from losses, see
+    # ConfigurableLoss.auxiliary_generator_inputs()). Returns the regular new state along with the generator outputs
+    # belonging to each of aux_inputs, sliced back out of the batch. Entries that are None or that can't be batched with
+    # the regular inputs get None back.
+    # Generators with batch norm layers in training mode would normalize the regular inputs over the auxiliary ones too
+    # (and fold them into the running stats), which changes the regular outputs, so nothing is fused for them.
+    def forward_fused(self, state, aux_inputs):
+        gen = self.env['generators'][self.opt['generator']]
+        if any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.training for m in gen.modules()):
+            if not self.logged_batch_norm:
+                logger.warning("Generator %s has batch norm layers in training mode; auxiliary passes are not fused "
+                               "into injector output %s." % (self.opt['generator'], self.output))
+                self.logged_batch_norm = True
+            return self.forward(state), [None] * len(aux_inputs)
+        params = self._params(state)
+
+        def compatible(aux):
+            if aux is None or len(aux) != len(params):
+                return False
+            for a, p in zip(aux, params):
+                if isinstance(p, torch.Tensor):
+                    if not isinstance(a, torch.Tensor) or a.shape[1:] != p.shape[1:] or a.dtype != p.dtype:
+                        return False
+                elif a is not p:
+                    return False
+            return True
+        fused = [i for i, aux in enumerate(aux_inputs) if compatible(aux)]
+        if not fused:
+            return self.forward(state), [None] * len(aux_inputs)
+
+        sizes = [params[0].shape[0]] + [aux_inputs[i][0].shape[0] for i in fused]
+        fused_params = [torch.cat([p] + [aux_inputs[i][j] for i in fused], dim=0) if isinstance(p, torch.Tensor) else p
+                        for j, p in enumerate(params)]
+        results = self._generate(fused_params)
+
+        def split(r):
+            if isinstance(r, torch.Tensor) and r.dim() > 0 and r.shape[0] == sum(sizes):
+                return torch.split(r, sizes, dim=0)
+            return [r] * len(sizes)
+        if isinstance(results, list) or isinstance(results, tuple):
+            parts = [split(r) for r in results]
+            per_pass = [[p[n] for p in parts] for n in range(len(sizes))]
+        else:
+            per_pass = split(results)
+        aux_outputs = [None] * len(aux_inputs)
+        for n, i in enumerate(fused):
+            aux_outputs[i] = per_pass[n + 1]
+        return self._to_state(per_pass[0]), aux_outputs
+
+    def _to_state(self, results):
         new_state = {}
         if isinstance(self.output, list):
             # Only dereference tuples or lists, not tensors.
@@ -459,4 +523,25 @@ class SaveImages(Injector):
             if logits[b][self.target] > self.thresh:
                 torchvision.utils.save_image(images[b], os.path.join(self.savedir, f'{self.run_id}_{self.index}.jpg'))
                 self.index += 1
-        return {}
\ No newline at end of file
+        return {}
+
+# Applies the corruptions of data/image_corruptor.py to the whole batch in [in] on the GPU and injects the result into
+# [out]. Takes the same options as the datasets (fixed_corruptions, random_corruptions, num_corrupts_per_image,
+# corruption_blur_scale), which means corruption can be moved out of the DataLoader workers by moving those options
+# here. [in] must be an RGB image batch in [0,1]. When 'seed' is specified, corruptions are a deterministic function
+# of the seed and the current step.
+class ImageCorruptionInjector(Injector):
+    def __init__(self, opt, env):
+        super(ImageCorruptionInjector, self).__init__(opt, env)
+        from data.image_corruptor import BatchImageCorruptor
+        self.corruptor = BatchImageCorruptor(opt)
+        self.seed = opt['seed'] if 'seed' in opt.keys() else None
+
+    def forward(self, state):
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed * 1000003 + self.env['step'])
+        with torch.no_grad():
+            corrupted = self.corruptor.corrupt_batch(state[self.input], generator)
+        return {self.output: corrupted}
@@ -61,17 +61,52 @@ def extract_params_from_state(params: object, state: object, root: object = True
     return p
 
 
+# Tracks a rolling mean of a loss to decide whether it has dropped below a minimum, without a blocking device->host read
+# on every call: the mean is copied to the host asynchronously and consulted on the following call, so the decision
+# made for a given step is based on the losses up to the previous one.
+class MinLossGate:
+    def __init__(self, min_loss, device, buffer_sz=10):
+        self.min_loss = min_loss
+        self.loss_rotating_buffer = torch.zeros(buffer_sz, requires_grad=False, device=device)
+        self.rb_ptr = 0
+        self.pinned = torch.cuda.is_available() and torch.device(device).type == 'cuda'
+        self.host_mean = torch.zeros(1, pin_memory=self.pinned)
+        self.event = None
+
+    # Records loss and returns True if the rolling mean of the previously recorded losses is below min_loss.
+    def should_skip(self, loss):
+        if self.event is not None:
+            self.event.synchronize()
+        below = self.host_mean.item() < self.min_loss
+        self.loss_rotating_buffer[self.rb_ptr] = loss.detach()
+        self.rb_ptr = (self.rb_ptr + 1) % self.loss_rotating_buffer.shape[0]
+        self.host_mean.copy_(torch.mean(self.loss_rotating_buffer, dim=0, keepdim=True), non_blocking=self.pinned)
+        if self.pinned:
+            self.event = torch.cuda.Event()
+            self.event.record()
+        return below
+
+
 class ConfigurableLoss(nn.Module):
     def __init__(self, opt, env):
         super(ConfigurableLoss, self).__init__()
         self.opt = opt
         self.env = env
         self.metrics = []
+        self.fused_output = None
 
     # net is either a scalar network being trained or a list of networks being trained, depending on the configuration.
     def forward(self, net, state):
         raise NotImplementedError
 
+    # Losses that run a generator on inputs of their own can have that pass fused into the forward pass of an
+    # ImageGeneratorInjector in the same step, named by the loss' 'fuse_with_injector' option. Before the injector runs,
+    # the step asks the loss for the generator arguments of its pass; grad tells whether the fused pass will be
+    # differentiable. Returning None makes the loss run the pass itself as usual. Otherwise, the outputs are handed to
+    # forward() through self.fused_output.
+    def auxiliary_generator_inputs(self, state, grad):
+        return None
+
     def extra_metrics(self):
         return self.metrics
 
@@ -153,15 +188,14 @@ class FeatureLoss(ConfigurableLoss):
         self.opt = opt
         self.criterion = get_basic_criterion_for_name(opt['criterion'], env['device'])
         import trainer.networks
-        self.netF = trainer.networks.define_F(which_model=opt['which_model_F'],
-                                              load_path=opt['load_path'] if 'load_path' in opt.keys() else None).to(self.env['device'])
-        if not env['opt']['dist']:
-            self.netF = torch.nn.parallel.DataParallel(self.netF, device_ids=env['opt']['gpu_ids'])
+        # Feature networks are shared with every other loss using the same one, as are the features of the real images.
+        self.netF = trainer.networks.get_shared_feature_extractor(env['device'], which_model=opt['which_model_F'],
+                                              load_path=opt['load_path'] if 'load_path' in opt.keys() else None,
+                                              data_parallel_ids=None if env['opt']['dist'] else env['opt']['gpu_ids'])
 
     def forward(self, _, state):
         with autocast(enabled=self.env['opt']['fp16']):
-            with torch.no_grad():
-                logits_real = self.netF(state[self.opt['real']])
+            logits_real = self.netF.real_features(state[self.opt['real']])
             logits_fake = self.netF(state[self.opt['fake']])
         if self.opt['criterion'] == 'cosine':
             return self.criterion(logits_fake.float(), logits_real.float(), torch.ones(1, device=logits_fake.device))
@@ -179,14 +213,15 @@ class InterpretedFeatureLoss(ConfigurableLoss):
         self.opt = opt
         self.criterion = get_basic_criterion_for_name(opt['criterion'], env['device'])
         import trainer.networks
-        self.netF_real = trainer.networks.define_F(which_model=opt['which_model_F']).to(self.env['device'])
-        self.netF_gen = trainer.networks.define_F(which_model=opt['which_model_F'], load_path=opt['load_path']).to(self.env['device'])
-        if not env['opt']['dist']:
-            self.netF_real = torch.nn.parallel.DataParallel(self.netF_real)
-            self.netF_gen = torch.nn.parallel.DataParallel(self.netF_gen)
+        data_parallel_ids = None if env['opt']['dist'] else env['opt']['gpu_ids']
+        self.netF_real = trainer.networks.get_shared_feature_extractor(env['device'], which_model=opt['which_model_F'],
+                                                                       data_parallel_ids=data_parallel_ids)
+        self.netF_gen = trainer.networks.get_shared_feature_extractor(env['device'], which_model=opt['which_model_F'],
+                                                                      load_path=opt['load_path'],
+                                                                      data_parallel_ids=data_parallel_ids)
 
     def forward(self, _, state):
-        logits_real = self.netF_real(state[self.opt['real']])
+        logits_real = self.netF_real.real_features(state[self.opt['real']])
         logits_fake = self.netF_gen(state[self.opt['fake']])
         return self.criterion(logits_fake.float(), logits_real.float())
 
@@ -202,8 +237,7 @@ class GeneratorGanLoss(ConfigurableLoss):
         # generators and discriminators by essentially having them skip steps while their counterparts "catch up".
         self.min_loss = opt['min_loss'] if 'min_loss' in opt.keys() else 0
         if self.min_loss != 0:
-            self.loss_rotating_buffer = torch.zeros(10, requires_grad=False)
-            self.rb_ptr = 0
+            self.min_loss_gate = MinLossGate(self.min_loss, env['device'])
             self.losses_computed = 0
 
     def forward(self, _, state):
@@ -239,9 +273,7 @@ class GeneratorGanLoss(ConfigurableLoss):
             else:
                 raise NotImplementedError
         if self.min_loss != 0:
-            self.loss_rotating_buffer[self.rb_ptr] = loss.item()
-            self.rb_ptr = (self.rb_ptr + 1) % self.loss_rotating_buffer.shape[0]
-            if torch.mean(self.loss_rotating_buffer) < self.min_loss:
+            if self.min_loss_gate.should_skip(loss):
                 return 0
             self.losses_computed += 1
             self.metrics.append(("loss_counter", self.losses_computed))
@@ -260,8 +292,7 @@ class DiscriminatorGanLoss(ConfigurableLoss):
         self.gradient_penalty = opt['gradient_penalty'] if 'gradient_penalty' in opt.keys() else False
         if self.min_loss != 0:
             assert not self.env['dist']  # distributed training does not support 'min_loss' - it can result in backward() desync by design.
-            self.loss_rotating_buffer = torch.zeros(10, requires_grad=False)
-            self.rb_ptr = 0
+            self.min_loss_gate = MinLossGate(self.min_loss, env['device'])
             self.losses_computed = 0
 
     def forward(self, net, state):
@@ -302,10 +333,8 @@ class DiscriminatorGanLoss(ConfigurableLoss):
         else:
             raise NotImplementedError
         if self.min_loss != 0:
-            self.loss_rotating_buffer[self.rb_ptr] = loss.item()
-            self.rb_ptr = (self.rb_ptr + 1) % self.loss_rotating_buffer.shape[0]
             self.metrics.append(("loss_counter", self.losses_computed))
-            if torch.mean(self.loss_rotating_buffer) < self.min_loss:
+            if self.min_loss_gate.should_skip(loss):
                 return 0
             self.losses_computed += 1
 
@@ -343,9 +372,7 @@ class GeometricSimilarityGeneratorLoss(ConfigurableLoss):
                               (functools.partial(torch.rot90, k=2, dims=[2,3]), functools.partial(torch.rot90, k=2, dims=[2,3])),
                               (functools.partial(torch.rot90, k=3, dims=[2,3]), functools.partial(torch.rot90, k=1, dims=[2,3]))])
 
-    def forward(self, net, state):
-        net = self.env['generators'][self.generator]  # Get the network from an explicit parameter.
-                                                    # The <net> parameter is not reliable for generator losses since often they are combined with many networks.
+    def alter_inputs(self, state):
         fake = extract_params_from_state(self.opt['fake'], state)
         alteration, undo_fn = self.random_alteration()
         altered = []
@@ -354,16 +381,33 @@ class GeometricSimilarityGeneratorLoss(ConfigurableLoss):
                 altered.append(alteration(t))
             else:
                 altered.append(t)
+        return altered, undo_fn
 
-        with autocast(enabled=self.env['opt']['fp16']):
-            if self.detach_fake:
-                with torch.no_grad():
+    def auxiliary_generator_inputs(self, state, grad):
+        if not grad and not self.detach_fake:
+            return None
+        altered, self.fused_undo_fn = self.alter_inputs(state)
+        return altered
+
+    def forward(self, net, state):
+        if self.fused_output is not None:
+            upsampled_altered, undo_fn = self.fused_output, self.fused_undo_fn
+            self.fused_output = None
+        else:
+            net = self.env['generators'][self.generator]  # Get the network from an explicit parameter.
+                                                        # The <net> parameter is not reliable for generator losses since often they are combined with many networks.
+            altered, undo_fn = self.alter_inputs(state)
+            with autocast(enabled=self.env['opt']['fp16']):
+                if self.detach_fake:
+                    with torch.no_grad():
+                        upsampled_altered = net(*altered)
+                else:
                     upsampled_altered = net(*altered)
-            else:
-                upsampled_altered = net(*altered)
 
         if self.gen_output_to_use is not None:
             upsampled_altered = upsampled_altered[self.gen_output_to_use]
+        if self.detach_fake:
+            upsampled_altered = upsampled_altered.detach()
 
         # Undo alteration on HR image
         upsampled_altered = undo_fn(upsampled_altered)
@@ -391,10 +435,7 @@ class TranslationInvarianceLoss(ConfigurableLoss):
         self.detach_fake = opt['detach_fake']
         assert(self.patch_size > self.overlap)
 
-    def forward(self, net, state):
-        net = self.env['generators'][self.generator]  # Get the network from an explicit parameter.
-        # The <net> parameter is not reliable for generator losses since often they are combined with many networks.
-
+    def translate_inputs(self, state):
         border_sz = self.patch_size - self.overlap
         translation = random.choice([("top_right", border_sz, border_sz+self.overlap, 0, self.overlap),
                                  ("bottom_left", 0, self.overlap, border_sz, border_sz+self.overlap),
@@ -403,14 +444,30 @@ class TranslationInvarianceLoss(ConfigurableLoss):
         # Change the "fake" input name that we are translating to one that specifies the random translation.
         fake = self.opt['fake'].copy()
         fake[self.gen_input_for_alteration] = "%s_%s" % (fake[self.gen_input_for_alteration], trans_name)
-        input = extract_params_from_state(fake, state)
+        return extract_params_from_state(fake, state), translation
 
-        with autocast(enabled=self.env['opt']['fp16']):
-            if self.detach_fake:
-                with torch.no_grad():
+    def auxiliary_generator_inputs(self, state, grad):
+        if not grad and not self.detach_fake:
+            return None
+        input, self.fused_translation = self.translate_inputs(state)
+        return input
+
+    def forward(self, net, state):
+        border_sz = self.patch_size - self.overlap
+        if self.fused_output is not None:
+            trans_output, translation = self.fused_output, self.fused_translation
+            self.fused_output = None
+        else:
+            net = self.env['generators'][self.generator]  # Get the network from an explicit parameter.
+            # The <net> parameter is not reliable for generator losses since often they are combined with many networks.
+            input, translation = self.translate_inputs(state)
+            with autocast(enabled=self.env['opt']['fp16']):
+                if self.detach_fake:
+                    with torch.no_grad():
+                        trans_output = net(*input)
+                else:
                     trans_output = net(*input)
-            else:
-                trans_output = net(*input)
+        trans_name, hl, hh, wl, wh = translation
         if not isinstance(trans_output, list) and not isinstance(trans_output, tuple):
             trans_output = [trans_output]
 
@@ -418,6 +475,8 @@ class TranslationInvarianceLoss(ConfigurableLoss):
             fake_shared_output = trans_output[self.gen_output_to_use][:, :, hl:hh, wl:wh]
         else:
             fake_shared_output = trans_output[:, :, hl:hh, wl:wh]
+        if self.detach_fake:
+            fake_shared_output = fake_shared_output.detach()
 
         # The "real" input is assumed to always come from the top left tile.
         gen_output = state[self.opt['real']]
@@ -430,7 +489,8 @@ class TranslationInvarianceLoss(ConfigurableLoss):
 
 
 # Computes a loss repeatedly feeding the generator downsampled inputs created from its outputs. The expectation is
-# that the generator's outputs do not change on repeated forward passes.
+# that the generator's outputs do not change on repeated forward passes. Since every pass depends on the output of the
+# previous one, these passes can't be fused into the injector's (fuse_with_injector has no effect).
 # The "real" parameter to this loss is the actual output of the generator.
 # The "fake" parameter is the expected inputs that should be fed into the generator. 'input_alteration_index' is changed
 #   so that it feeds the recursive input.
@@ -1,6 +1,9 @@
+import ast
 import functools
 import importlib
+import json
 import logging
+import os
 import pkgutil
 import sys
 from collections import OrderedDict
@@ -39,23 +42,114 @@ def register_model(func):
     return func
 
 
-def find_registered_model_fns(base_path='models'):
-    found_fns = {}
-    module_iter = pkgutil.walk_packages([base_path])
-    for mod in module_iter:
+# Packages under models/ that are never scanned for registered models.
+MODEL_SCAN_EXCLUSION_LIST = ['flownet2']
+
+
+def _iter_model_modules(base_path):
+    for mod in pkgutil.walk_packages([base_path]):
         if mod.ispkg:
-            EXCLUSION_LIST = ['flownet2']
-            if mod.name not in EXCLUSION_LIST:
-                found_fns.update(find_registered_model_fns(f'{base_path}/{mod.name}'))
+            if mod.name not in MODEL_SCAN_EXCLUSION_LIST:
+                yield from _iter_model_modules(f'{base_path}/{mod.name}')
         else:
-            mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
+            yield f'{base_path}/{mod.name}'.replace('/', '.'), os.path.join(base_path, mod.name + '.py')
+
+
+# Imports every module under base_path and returns all of the functions registered with @register_model. This is slow
+# and pulls in the dependencies of every architecture; create_model() uses the registry index instead. Modules that fail
+# to import (e.g. because of a missing optional dependency) are skipped.
+def find_registered_model_fns(base_path='models'):
+    found_fns = {}
+    for mod_name, _ in _iter_model_modules(base_path):
+        try:
             importlib.import_module(mod_name)
-            for mod_fn in getmembers(sys.modules[mod_name], isfunction):
-                if hasattr(mod_fn[1], "_dlas_registered_model"):
-                    found_fns[mod_fn[1]._dlas_model_name] = mod_fn[1]
+        except ImportError as e:
+            logger.warning(f'Skipping {mod_name} while searching for registered models: {e}')
+            continue
+        for mod_fn in getmembers(sys.modules[mod_name], isfunction):
+            if hasattr(mod_fn[1], "_dlas_registered_model"):
+                found_fns[mod_fn[1]._dlas_model_name] = mod_fn[1]
     return found_fns
 
 
+# Returns the model names registered in a source file, found by parsing it for functions decorated with
+# @register_model rather than importing it.
+def _parse_registered_names(path):
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name.startswith('register_') and len(node.name) > 9:
+            for dec in node.decorator_list:
+                if (isinstance(dec, ast.Name) and dec.id == 'register_model') or \
+                        (isinstance(dec, ast.Attribute) and dec.attr == 'register_model'):
+                    names.append(node.name[9:])
+    return names
+
+
+# Builds (or loads) an index mapping registered model names to the module that defines them. The index is cached in
+# <base_path>/__pycache__/ along with the mtime of every scanned file; only files whose mtime changed are re-parsed.
+def build_model_registry_index(base_path='models'):
+    cache_path = os.path.join(base_path, '__pycache__', 'dlas_model_registry.json')
+    cached = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+        except ValueError:
+            cached = {}
+
+    files = {}
+    changed = False
+    for mod_name, path in _iter_model_modules(base_path):
+        mtime = os.stat(path).st_mtime_ns
+        entry = cached.get(path)
+        if entry is None or entry['mtime'] != mtime or entry['module'] != mod_name:
+            try:
+                names = _parse_registered_names(path)
+            except SyntaxError:
+                names = []
+            entry = {'mtime': mtime, 'module': mod_name, 'models': names}
+            changed = True
+        files[path] = entry
+    if changed or len(files) != len(cached):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # DDP ranks and dataloader workers may all refresh the index at once, so each writes its own tmp file.
+            tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(files, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # The index is just a cache; a read-only checkout only means re-parsing next time.
+
+    index = {}
+    for entry in files.values():
+        for name in entry['models']:
+            index[name] = entry['module']
+    return index
+
+
+# The registry index is resolved once per process.
+_model_registry_index = None
+
+
+def get_registered_model_fn(which_model, base_path='models'):
+    global _model_registry_index
+    if _model_registry_index is None:
+        _model_registry_index = build_model_registry_index(base_path)
+    if which_model in _model_registry_index.keys():
+        module = importlib.import_module(_model_registry_index[which_model])
+        fn = getattr(module, 'register_' + which_model, None)
+        if fn is not None and hasattr(fn, '_dlas_registered_model'):
+            return fn
+    # Not in the index (e.g. registered in some unusual way); fall back to importing everything.
+    registered_fns = find_registered_model_fns(base_path)
+    if which_model not in registered_fns.keys():
+        raise CreateModelError(which_model, sorted(set(_model_registry_index.keys()) | set(registered_fns.keys())))
+    return registered_fns[which_model]
+
+
 class CreateModelError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified model name: {name}. Tip: If your model is in a'
@@ -70,10 +164,7 @@ def create_model(opt, opt_net, scale=None):
         which_model = opt_net['which_model_G']
     if not which_model:
         which_model = opt_net['which_model_D']
-    registered_fns = find_registered_model_fns()
-    if which_model not in registered_fns.keys():
-        raise CreateModelError(which_model, list(registered_fns.keys()))
-    return registered_fns[which_model](opt_net, opt)
+    return get_registered_model_fn(which_model)(opt_net, opt)
 
 
 class GradDiscWrapper(torch.nn.Module):
@@ -204,3 +295,48 @@ def define_F(which_model='vgg', use_bn=False, for_training=False, load_path=None
             v.requires_grad = False
 
     return netF
+
+
+# A frozen feature extractor shared by everything in the process that asks for the same network on the same device
+# (see get_shared_feature_extractor()). Calling it computes features as usual. real_features() additionally memoizes
+# the features of the last input it was given, so that when several losses compare against the same real images, those
+# are only run through the network once per batch chunk. Inputs that require grad bypass the memo so that gradients
+# still flow through them.
+class SharedFeatureExtractor:
+    def __init__(self, net):
+        self.net = net
+        self.cached_input = None
+        self.cached_key = None
+        self.cached_features = None
+
+    def __call__(self, x):
+        return self.net(x)
+
+    def real_features(self, x):
+        if x.requires_grad:
+            return self.net(x)
+        # Holding on to the input guarantees that a new tensor can never be mistaken for it. The version counter catches
+        # in-place modifications, and features computed under autocast are kept apart from full precision ones.
+        key = (x._version, torch.is_autocast_enabled())
+        if x is self.cached_input and key == self.cached_key:
+            return self.cached_features
+        with torch.no_grad():
+            features = self.net(x)
+        self.cached_input, self.cached_key, self.cached_features = x, key, features
+        return features
+
+
+_shared_feature_extractors = {}
+
+
+# Returns the SharedFeatureExtractor for (which_model, feature_layers, load_path) on the given device, building it with
+# define_F() the first time. If data_parallel_ids is given, the network is wrapped in a DataParallel over those devices.
+def get_shared_feature_extractor(device, which_model='vgg', feature_layers=None, load_path=None, data_parallel_ids=None):
+    key = (which_model, tuple(feature_layers) if feature_layers is not None else None, load_path, str(device),
+           tuple(data_parallel_ids) if data_parallel_ids is not None else None)
+    if key not in _shared_feature_extractors.keys():
+        net = define_F(which_model=which_model, load_path=load_path, feature_layers=feature_layers).to(device)
+        if data_parallel_ids is not None:
+            net = torch.nn.parallel.DataParallel(net, device_ids=data_parallel_ids)
+        _shared_feature_extractors[key] = SharedFeatureExtractor(net)
+    return _shared_feature_extractors[key]
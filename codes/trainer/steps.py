@@ -8,6 +8,7 @@ import torch
 from collections import OrderedDict
 from trainer.injectors import create_injector
 from utils.util import recursively_detach
+from utils.step_profiler import StepProfiler
 
 logger = logging.getLogger('base')
 
@@ -15,10 +16,11 @@ logger = logging.getLogger('base')
 # Defines the expected API for a single training step
 class ConfigurableStep(Module):
 
-    def __init__(self, opt_step, env):
+    def __init__(self, opt_step, env, name=None):
         super(ConfigurableStep, self).__init__()
 
         self.step_opt = opt_step
+        self.name = name if name is not None else self.get_training_network_name()
         self.env = env
         self.opt = env['opt']
         self.gen_outputs = opt_step['generator_outputs']
@@ -26,14 +28,14 @@ class ConfigurableStep(Module):
         self.optimizers = None
         self.scaler = GradScaler(enabled=self.opt['fp16'])
         self.grads_generated = False
-        self.min_total_loss = opt_step['min_total_loss'] if 'min_total_loss' in opt_step.keys() else -999999999
+        self.min_total_loss = opt_step['min_total_loss'] if 'min_total_loss' in opt_step.keys() else None
 
         self.injectors = []
+        self.injector_names = []
         if 'injectors' in self.step_opt.keys():
-            injector_names = []
             for inj_name, injector in self.step_opt['injectors'].items():
-                assert inj_name not in injector_names  # Repeated names are always an error case.
-                injector_names.append(inj_name)
+                assert inj_name not in self.injector_names  # Repeated names are always an error case.
+                self.injector_names.append(inj_name)
                 self.injectors.append(create_injector(injector, env))
 
         losses = []
@@ -44,6 +46,13 @@ class ConfigurableStep(Module):
                 losses.append((loss_name, create_loss(loss, env)))
                 self.weights[loss_name] = loss['weight']
         self.losses = OrderedDict(losses)
+        for loss in self.losses.values():
+            if 'fuse_with_injector' in loss.opt.keys():
+                # The generator pass of this loss is batched into that of the given injector.
+                injector = self.injectors[self.injector_names.index(loss.opt['fuse_with_injector'])]
+                assert hasattr(injector, 'forward_fused') and injector.fuse_aux, \
+                    "Injector %s must be a generator injector with fuse_aux: true." % (loss.opt['fuse_with_injector'],)
+        self.logged_unfused_losses = set()
 
     def get_network_for_name(self, name):
         return self.env['generators'][name] if name in self.env['generators'].keys() \
@@ -119,6 +128,13 @@ class ConfigurableStep(Module):
         else:
             return self.step_opt['training']
 
+    # Some losses only activate after a set number of steps. For example, proto-discriminator losses can be very
+    # disruptive to a generator.
+    def loss_active(self, loss):
+        return not ('after' in loss.opt.keys() and loss.opt['after'] > self.env['step'] or
+                    'before' in loss.opt.keys() and self.env['step'] > loss.opt['before'] or
+                    'every' in loss.opt.keys() and self.env['step'] % loss.opt['every'] != 0)
+
     # Performs all forward and backward passes for this step given an input state. All input states are lists of
     # chunked tensors. Use grad_accum_step to dereference these steps. Should return a dict of tensors that later
     # steps might use. These tensors are automatically detached and accumulated into chunks.
@@ -137,8 +153,17 @@ class ConfigurableStep(Module):
         self.env['current_step_optimizers'] = self.optimizers
         self.env['training'] = train
 
+        profiler = self.env['profiler'] if 'profiler' in self.env.keys() else StepProfiler()
+
+        # Losses whose generator passes are fused into an injector's (see ConfigurableLoss.auxiliary_generator_inputs()).
+        fused_losses = {}
+        if train:
+            for loss_name, loss in self.losses.items():
+                if 'fuse_with_injector' in loss.opt.keys() and self.loss_active(loss):
+                    fused_losses.setdefault(loss.opt['fuse_with_injector'], []).append(loss_name)
+
         # Inject in any extra dependencies.
-        for inj in self.injectors:
+        for inj_name, inj in zip(self.injector_names, self.injectors):
             # Don't do injections tagged with eval unless we are not in train mode.
             if train and 'eval' in inj.opt.keys() and inj.opt['eval']:
                 continue
@@ -150,7 +175,19 @@ class ConfigurableStep(Module):
                'before' in inj.opt.keys() and self.env['step'] > inj.opt['before'] or \
                'every' in inj.opt.keys() and self.env['step'] % inj.opt['every'] != 0:
                 continue
-            injected = inj(local_state)
+            with profiler.time('%s_inj_%s' % (self.name, inj_name)):
+                if inj_name in fused_losses.keys():
+                    loss_names = fused_losses[inj_name]
+                    aux_inputs = [self.losses[l].auxiliary_generator_inputs(local_state, inj.grad) for l in loss_names]
+                    injected, aux_outputs = inj.forward_fused(local_state, aux_inputs)
+                    for l, aux_output in zip(loss_names, aux_outputs):
+                        self.losses[l].fused_output = aux_output
+                        if aux_output is None and l not in self.logged_unfused_losses:
+                            logger.info("Loss %s could not be fused into injector %s; it runs its own generator pass."
+                                        % (l, inj_name))
+                            self.logged_unfused_losses.add(l)
+                else:
+                    injected = inj(local_state)
             local_state.update(injected)
             new_state.update(injected)
 
@@ -158,13 +195,10 @@ class ConfigurableStep(Module):
             # Finally, compute the losses.
             total_loss = 0
             for loss_name, loss in self.losses.items():
-                # Some losses only activate after a set number of steps. For example, proto-discriminator losses can
-                # be very disruptive to a generator.
-                if 'after' in loss.opt.keys() and loss.opt['after'] > self.env['step'] or \
-                   'before' in loss.opt.keys() and self.env['step'] > loss.opt['before'] or \
-                   'every' in loss.opt.keys() and self.env['step'] % loss.opt['every'] != 0:
+                if not self.loss_active(loss):
                     continue
-                l = loss(self.get_network_for_name(self.step_opt['training']), local_state)
+                with profiler.time('%s_loss_%s' % (self.name, loss_name)):
+                    l = loss(self.get_network_for_name(self.step_opt['training']), local_state)
                 total_loss += l * self.weights[loss_name]
                 # Record metrics.
                 if isinstance(l, torch.Tensor):
@@ -176,13 +210,15 @@ class ConfigurableStep(Module):
             # In some cases, the loss could not be set (e.g. all losses have 'after')
             if isinstance(total_loss, torch.Tensor):
                 self.loss_accumulator.add_loss("%s_total" % (self.get_training_network_name(),), total_loss)
-                reset_required = total_loss < self.min_total_loss
+                # Comparing against min_total_loss requires a sync with the device, so only do it when it is configured.
+                reset_required = self.min_total_loss is not None and total_loss < self.min_total_loss
 
                 # Scale the loss down by the accumulation factor.
                 total_loss = total_loss / self.env['mega_batch_factor']
 
                 # Get dem grads!
-                self.scaler.scale(total_loss).backward()
+                with profiler.time('%s_backward' % (self.name,)):
+                    self.scaler.scale(total_loss).backward()
 
                 if reset_required:
                     # You might be scratching your head at this. Why would you zero grad as opposed to not doing a
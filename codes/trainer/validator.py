@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils import util
+
+
+# Converts a batch of images in [0,1] to the [0,255] grid that util.tensor2img() produces, without leaving the device.
+def quantize(img):
+    return (img.float().clamp(0, 1) * 255).round()
+
+
+def crop_border(img, border):
+    if not border:
+        return img
+    return img[:, :, border:-border, border:-border]
+
+
+# Batched equivalent of util.calculate_psnr() for [0,255] images. Returns one value per image.
+def batch_psnr(img1, img2):
+    mse = ((img1.double() - img2.double()) ** 2).mean(dim=[1, 2, 3])
+    return 20 * torch.log10(255.0 / torch.sqrt(mse))
+
+
+# Batched equivalent of util.calculate_ssim() for [0,255] images: an 11x11 gaussian window with sigma=1.5, applied to
+# every channel independently, with the 'valid' region of the SSIM map averaged. Returns one value per image.
+def batch_ssim(img1, img2):
+    C1 = (0.01 * 255)**2
+    C2 = (0.03 * 255)**2
+    img1, img2 = img1.double(), img2.double()
+    c = img1.shape[1]
+    coords = torch.arange(11, dtype=torch.float64, device=img1.device) - 5
+    kernel = torch.exp(-coords ** 2 / (2 * 1.5 ** 2))
+    kernel = kernel / kernel.sum()
+    window = (kernel[:, None] * kernel[None, :]).expand(c, 1, 11, 11).contiguous()
+    filt = lambda x: F.conv2d(x, window, groups=c)
+
+    mu1, mu2 = filt(img1), filt(img2)
+    mu1_sq, mu2_sq, mu1_mu2 = mu1 ** 2, mu2 ** 2, mu1 * mu2
+    sigma1_sq = filt(img1 * img1) - mu1_sq
+    sigma2_sq = filt(img2 * img2) - mu2_sq
+    sigma12 = filt(img1 * img2) - mu1_mu2
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.mean(dim=[1, 2, 3])
+
+
+def _write_images(images, paths):
+    for img, path in zip(images, paths):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # CHW RGB uint8 -> HWC BGR, which is what cv2 expects.
+        util.save_img(np.ascontiguousarray(img.permute(1, 2, 0).numpy()[:, :, ::-1]), path)
+
+
+# Runs the validation set through an ExtensibleTrainer a full batch at a time and computes the metrics for the entire
+# batch on the model's device. When training is distributed, every rank validates its own shard of the validation set
+# (see shard_dataset()) and the metric sums are all-reduced at the end, so every rank ends up with the same averages.
+#
+# Image dumps are optional (eval.save_images). When enabled, the quantized outputs are copied back to the host and
+# written to disk by a background thread, so the next batch can be processed while the PNGs are being encoded.
+class BatchedValidator:
+    def __init__(self, opt):
+        self.opt = opt
+        opt_eval = opt['eval'] or {}
+        self.compute_psnr = opt_eval['compute_psnr'] if 'compute_psnr' in opt_eval.keys() else True
+        self.compute_ssim = opt_eval['compute_ssim'] if 'compute_ssim' in opt_eval.keys() else False
+        self.compute_fea = opt_eval['compute_fea'] if 'compute_fea' in opt_eval.keys() else True
+        self.save_images = opt_eval['save_images'] if 'save_images' in opt_eval.keys() else True
+        self.crop = opt['scale'] or 0
+        self.image_writer = ThreadPoolExecutor(max_workers=1) if self.save_images else None
+        self.pending_writes = []
+
+    # Returns the subset of dataset that this rank should validate on.
+    @staticmethod
+    def shard_dataset(dataset, rank, world_size):
+        return torch.utils.data.Subset(dataset, list(range(rank, len(dataset), world_size)))
+
+    def _drain_writes(self):
+        for f in self.pending_writes:
+            f.result()
+        self.pending_writes = []
+
+    # Returns a dict of metric averages over the whole validation set (across all ranks).
+    def validate(self, model, loader, step):
+        # Don't let image dumps from a previous validation pile up.
+        self._drain_writes()
+        device = model.device
+        totals = torch.zeros(4, dtype=torch.float64, device=device)  # psnr, ssim, fea, count
+        for val_data in loader:
+            model.feed_data(val_data, step)
+            model.test(to_cpu=False)
+            visuals = model.get_current_visuals(on_device=True)
+            if visuals is None:
+                continue
+            rlt, hq = visuals['rlt'].to(device), visuals['hq'].to(device)
+            rlt_q = quantize(rlt)
+            totals[3] += rlt.shape[0]
+            if self.compute_psnr or self.compute_ssim:
+                sr, gt = crop_border(rlt_q, self.crop), crop_border(quantize(hq), self.crop)
+                if self.compute_psnr:
+                    totals[0] += batch_psnr(sr, gt).sum()
+                if self.compute_ssim:
+                    totals[1] += batch_ssim(sr, gt).sum()
+            if self.compute_fea:
+                totals[2] += model.compute_fea_loss(rlt, hq, per_sample=True).double().sum()
+
+            if self.save_images:
+                images = rlt_q.byte().cpu()
+                paths = []
+                for hq_path in val_data['HQ_path']:
+                    img_name = os.path.splitext(os.path.basename(hq_path))[0]
+                    paths.append(os.path.join(self.opt['path']['val_images'], img_name,
+                                              '{:s}_{:d}.png'.format(img_name, step)))
+                self.pending_writes.append(self.image_writer.submit(_write_images, images, paths))
+
+        if self.opt['dist']:
+            torch.distributed.all_reduce(totals)
+        totals = totals.cpu()
+        count = max(totals[3].item(), 1)
+        results = {}
+        if self.compute_psnr:
+            results['val_psnr'] = totals[0].item() / count
+        if self.compute_ssim:
+            results['val_ssim'] = totals[1].item() / count
+        if self.compute_fea:
+            results['val_fea'] = totals[2].item() / count
+        return results
@@ -0,0 +1,161 @@
+import atexit
+import copy
+import os
+import queue
+import threading
+
+import torch
+
+
+# Copies every tensor in a (possibly nested) state dict into CPU memory that belongs to the snapshot, so the training
+# loop can keep mutating the originals. GPU tensors are copied into pinned memory asynchronously on the current stream;
+# the returned event must be synchronized before the snapshot is read.
+def snapshot_state(state):
+    def _copy(v):
+        if isinstance(v, torch.Tensor):
+            v = v.detach()
+            if v.is_cuda:
+                buf = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+                buf.copy_(v, non_blocking=True)
+                return buf
+            return v.clone()
+        elif isinstance(v, dict):
+            return type(v)((k, _copy(e)) for k, e in v.items())
+        elif isinstance(v, list):
+            return [_copy(e) for e in v]
+        elif isinstance(v, tuple):
+            return tuple(_copy(e) for e in v)
+        return copy.deepcopy(v)
+
+    snapshot = _copy(state)
+    event = None
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        event = torch.cuda.Event()
+        event.record()
+    return snapshot, event
+
+
+# torch.save()s to a temporary file then renames it into place, so readers never see a partially written checkpoint.
+def atomic_save(state, path):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Brings dst up to date with src, assuming files only ever grow (like tensorboard event files): only the bytes past the
+# current length of each destination file are copied. Files that shrank are copied again from scratch.
+def sync_directory(src, dst):
+    for root, _, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for f in files:
+            src_file, dst_file = os.path.join(root, f), os.path.join(dst_root, f)
+            src_size = os.path.getsize(src_file)
+            dst_size = os.path.getsize(dst_file) if os.path.exists(dst_file) else 0
+            if dst_size > src_size:
+                dst_size = 0
+            if dst_size == src_size and os.path.exists(dst_file):
+                continue
+            with open(src_file, 'rb') as s, open(dst_file, 'r+b' if dst_size > 0 else 'wb') as d:
+                s.seek(dst_size)
+                d.seek(dst_size)
+                while True:
+                    data = s.read(16 * 1024 * 1024)
+                    if not data:
+                        break
+                    d.write(data)
+
+
+# Writes checkpoints on a background thread so that saving does not stall training.
+#
+# save() snapshots the given state into CPU memory (pinned, for GPU tensors) and returns immediately; the worker thread
+# then writes it to every requested path with atomic_save(). At most `max_pending` snapshots are kept in flight, beyond
+# which save() blocks until the worker catches up, which bounds the host memory used by the snapshots.
+#
+# When `keep_last` is set, only the last `keep_last` checkpoints written to each group (e.g. one group per network) are
+# kept on disk. Only files written by this writer are ever deleted.
+#
+# With asynchronous=False, all work happens inline in the calling thread, which is the legacy behavior.
+# Errors raised by the worker are re-raised from the next call to save(), sync_directory() or flush().
+# The worker is a daemon thread, so close() is also registered to run at interpreter exit: checkpoints still queued when
+# the training loop returns (or a generator-driven loop is abandoned) are written before the process ends.
+class CheckpointWriter:
+    def __init__(self, asynchronous=True, keep_last=None, max_pending=2):
+        self.asynchronous = asynchronous
+        self.keep_last = keep_last
+        self.written = {}
+        self.error = None
+        if asynchronous:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+            atexit.register(self.close)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _submit(self, job):
+        self._raise_pending_error()
+        if self.asynchronous:
+            self.queue.put(job)
+        else:
+            job()
+
+    # Saves state to every path in paths. `group` names the retention group of the checkpoint and `on_written` is an
+    # optional callable invoked (on the worker thread) once the files are in place, e.g. to upload them elsewhere.
+    def save(self, state, paths, group=None, on_written=None):
+        snapshot, event = snapshot_state(state) if self.asynchronous else (state, None)
+
+        def job():
+            if event is not None:
+                event.synchronize()
+            for path in paths:
+                atomic_save(snapshot, path)
+            if on_written is not None:
+                on_written()
+            if group is not None:
+                self._retain(group, paths)
+        self._submit(job)
+
+    def _retain(self, group, paths):
+        if self.keep_last is None:
+            return
+        history = self.written.setdefault(group, [])
+        history.append(list(paths))
+        while len(history) > self.keep_last:
+            evicted = history.pop(0)
+            # Paths that get overwritten on every save (e.g. 'latest.state') are still in use by a newer checkpoint.
+            in_use = set(p for kept in history for p in kept)
+            for path in evicted:
+                if path not in in_use and os.path.exists(path):
+                    os.remove(path)
+
+    def sync_directory(self, src, dst):
+        self._submit(lambda: sync_directory(src, dst))
+
+    # Blocks until every submitted checkpoint has been written.
+    def flush(self):
+        if self.asynchronous:
+            self.queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        if self.asynchronous and self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+            atexit.unregister(self.close)
+        self._raise_pending_error()
@@ -1,6 +1,10 @@
 import torch
 
 # Utility class that stores detached, named losses in a rotating buffer for smooth metric outputting.
+#
+# Buffers live on the device of the first value recorded under each name, so recording a GPU loss is just an async
+# device-side copy and never forces a sync with the host. Everything is read back in one packed transfer when as_dict()
+# is called.
 class LossAccumulator:
     def __init__(self, buffer_sz=50):
         self.buffer_sz = buffer_sz
@@ -9,17 +13,18 @@ class LossAccumulator:
 
     def add_loss(self, name, tensor):
         if name not in self.buffers.keys():
+            device = tensor.device if isinstance(tensor, torch.Tensor) else 'cpu'
             if "_histogram" in name:
-                tensor = torch.flatten(tensor.detach().cpu())
-                self.buffers[name] = (0, torch.zeros((self.buffer_sz, tensor.shape[0])), False)
+                tensor = torch.flatten(tensor.detach())
+                self.buffers[name] = (0, torch.zeros((self.buffer_sz, tensor.shape[0]), device=device), False)
             else:
-                self.buffers[name] = (0, torch.zeros(self.buffer_sz), False)
+                self.buffers[name] = (0, torch.zeros(self.buffer_sz, device=device), False)
         i, buf, filled = self.buffers[name]
         # Can take tensors or just plain python numbers.
         if '_histogram' in name:
-            buf[i] = torch.flatten(tensor.detach().cpu())
+            buf[i] = torch.flatten(tensor.detach()).to(buf.device)
         elif isinstance(tensor, torch.Tensor):
-            buf[i] = tensor.detach().cpu()
+            buf[i] = tensor.detach().to(buf.device)
         else:
             buf[i] = tensor
         filled = i+1 >= self.buffer_sz or filled
@@ -33,14 +38,16 @@ class LossAccumulator:
 
     def as_dict(self):
         result = {}
+        # Means are computed where the buffers live, then every device's means are stacked and moved in one transfer.
+        means = {}
         for k, v in self.buffers.items():
             i, buf, filled = v
-            if '_histogram' in k:
-                result["loss_" + k] = torch.flatten(buf)
-            if filled:
-                result["loss_" + k] = torch.mean(buf)
-            else:
-                result["loss_" + k] = torch.mean(buf[:i])
+            mean = torch.mean(buf) if filled else torch.mean(buf[:i])
+            means.setdefault(buf.device, []).append(("loss_" + k, mean))
+        for entries in means.values():
+            packed = torch.stack([m for _, m in entries]).cpu()
+            for (k, _), m in zip(entries, packed):
+                result[k] = m
         for k, v in self.counters.items():
             result[k] = v
-        return result
\ No newline at end of file
+        return result
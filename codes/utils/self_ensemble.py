@@ -0,0 +1,108 @@
+import time
+
+import torch
+
+
+# The eight symmetries of the square as (transform, inverse) pairs: every combination of a horizontal flip and a
+# rotation by a multiple of 90 degrees. The first four only flip, which is the classic x4 flip ensemble.
+def _transform(x, flip, k):
+    if flip:
+        x = torch.flip(x, (-1,))
+    return torch.rot90(x, k, (-2, -1)) if k else x
+
+
+def _inverse(x, flip, k):
+    if k:
+        x = torch.rot90(x, -k, (-2, -1))
+    return torch.flip(x, (-1,)) if flip else x
+
+
+FLIP_TRANSFORMS = [(False, 0), (True, 0), (True, 2), (False, 2)]  # identity, flip W, flip H, flip H and W
+GEOMETRIC_TRANSFORMS = FLIP_TRANSFORMS + [(False, 1), (True, 1), (False, 3), (True, 3)]
+
+
+# Geometric self-ensemble: feeds the flipped (mode=4) or flipped and rotated (mode=8) versions of a batch through a
+# model, maps every output back to the original orientation and averages them, all on the device.
+#
+# Variants that have the same shape are concatenated along the batch dimension and run in a single forward pass (for
+# non-square inputs, the 90/270 degree rotations have a transposed shape and need a second one). `max_batch` bounds
+# the number of images per forward pass to bound memory.
+#
+# Since self-ensembling trades throughput for quality, the latency it adds can be tracked: with measure_latency, the first
+# call also times a plain forward pass of the same batch, and latency_report() compares the two. This costs an extra
+# forward pass and device syncs, so it is off by default.
+class SelfEnsemble:
+    def __init__(self, model, mode=8, max_batch=None, output_index=0, measure_latency=False):
+        assert mode in [4, 8]
+        self.model = model
+        self.transforms = FLIP_TRANSFORMS if mode == 4 else GEOMETRIC_TRANSFORMS
+        self.max_batch = max_batch
+        self.output_index = output_index
+        self.measure_latency = measure_latency
+        self.baseline_time = None
+        self.ensemble_time = 0
+        self.calls = 0
+
+    @staticmethod
+    def from_opt(opt_ensemble, model):
+        get = lambda k, d: opt_ensemble[k] if k in opt_ensemble.keys() and opt_ensemble[k] is not None else d
+        return SelfEnsemble(model.env['generators'][get('generator', 'generator')], get('mode', 8),
+                            get('max_batch', None), get('output_index', 0), measure_latency=True)
+
+    def _forward(self, x):
+        with torch.no_grad():
+            out = self.model(x)
+        if isinstance(out, list) or isinstance(out, tuple):
+            out = out[self.output_index]
+        return out
+
+    def _forward_chunked(self, x):
+        if self.max_batch is None or x.shape[0] <= self.max_batch:
+            return self._forward(x)
+        return torch.cat([self._forward(c) for c in torch.split(x, self.max_batch)], dim=0)
+
+    @staticmethod
+    def _sync(x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+
+    def __call__(self, x):
+        if not self.measure_latency:
+            return self._ensemble(x)
+        if self.baseline_time is None:
+            self._sync(x)
+            start = time.time()
+            self._forward(x)
+            self._sync(x)
+            self.baseline_time = time.time() - start
+
+        self._sync(x)
+        start = time.time()
+        result = self._ensemble(x)
+        self._sync(x)
+        self.ensemble_time += time.time() - start
+        self.calls += 1
+        return result
+
+    def _ensemble(self, x):
+        b = x.shape[0]
+        groups = {}
+        for t in self.transforms:
+            variant = _transform(x, *t)
+            groups.setdefault(variant.shape, []).append((t, variant))
+        total = None
+        for variants in groups.values():
+            out = self._forward_chunked(torch.cat([v for _, v in variants], dim=0))
+            for i, (t, _) in enumerate(variants):
+                restored = _inverse(out[i * b:(i + 1) * b], *t).float()
+                total = restored if total is None else total + restored
+        return total / len(self.transforms)
+
+    def latency_report(self):
+        if not self.measure_latency:
+            return 'Self-ensemble latency was not measured.'
+        if self.calls == 0:
+            return 'Self-ensemble was not used.'
+        per_call = self.ensemble_time / self.calls
+        return 'Self-ensemble x%i: %.1fms per batch vs %.1fms for a single forward pass (+%.1fms).' % \
+               (len(self.transforms), per_call * 1000, self.baseline_time * 1000, (per_call - self.baseline_time) * 1000)
@@ -0,0 +1,86 @@
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+# Records how long the phases of a training iteration take (data loading, injectors, losses, backward, optimizer, ...)
+# and keeps a rolling buffer of the most recent timings of every phase for logging.
+#
+# Two timings are kept per phase:
+#  - wall: host-side time spent in the phase. Since CUDA kernels are launched asynchronously, this only tells you how
+#    long it took to dispatch work for GPU-heavy phases, but it is accurate for CPU-bound ones (data, python overhead).
+#  - cuda: time between CUDA events recorded on the current stream before and after the phase, i.e. how long the GPU
+#    spent on the work queued by the phase. Events are only resolved when the log is requested, so profiling does not
+#    force any synchronization during the step.
+# When disabled, time() returns a no-op context manager.
+class StepProfiler:
+    def __init__(self, enabled=False, use_cuda_events=True, buffer_sz=50):
+        self.enabled = enabled
+        self.use_cuda_events = use_cuda_events and torch.cuda.is_available()
+        self.buffer_sz = buffer_sz
+        self.buffers = {}
+        self.pending = []
+
+    def time(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._time(name)
+
+    @contextmanager
+    def _time(self, name):
+        start_event, end_event = None, None
+        if self.use_cuda_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+            if self.use_cuda_events:
+                end_event.record()
+                self.pending.append((name, start_event, end_event))
+                if len(self.pending) > 4 * self.buffer_sz:
+                    self._resolve(block=False)
+
+    def _record(self, name, kind, value):
+        key = (name, kind)
+        if key not in self.buffers.keys():
+            self.buffers[key] = deque(maxlen=self.buffer_sz)
+        self.buffers[key].append(value)
+
+    # Records a host-side duration (in seconds) that was measured elsewhere, e.g. dataloader wait time.
+    def add(self, name, seconds, kind='wall'):
+        if not self.enabled:
+            return
+        self._record(name, kind, seconds * 1000)
+
+    # Records a plain number alongside the timings, e.g. how much work an optimization allowed a phase to skip.
+    def count(self, name, value):
+        if not self.enabled:
+            return
+        self._record(name, 'count', value)
+
+    def _resolve(self, block):
+        remaining = []
+        for name, start_event, end_event in self.pending:
+            if block or end_event.query():
+                end_event.synchronize()
+                self.add(name, start_event.elapsed_time(end_event) / 1000, kind='cuda')
+            else:
+                remaining.append((name, start_event, end_event))
+        self.pending = remaining
+
+    # Returns the mean duration of every phase over the rolling buffer, in milliseconds.
+    def get_log(self):
+        if not self.enabled:
+            return {}
+        self._resolve(block=True)
+        log = {}
+        for (name, kind), buf in self.buffers.items():
+            key = 'profile_%s' % (name,) if kind == 'count' else 'profile_%s_%s_ms' % (name, kind)
+            log[key] = sum(buf) / len(buf)
+        return log
@@ -0,0 +1,145 @@
+import math
+
+import torch
+from torch.cuda.amp import autocast
+
+
+# Runs a generator over images of arbitrary size by splitting the input into overlapping tiles, feeding the tiles
+# through the generator in batches and blending the outputs back together with feathered (linearly ramped) weights
+# across the overlaps, which avoids visible seams.
+#
+# Tiles are sized and batched to fit a memory budget. Given `memory_budget_mb` (and CUDA), the activation memory the
+# generator needs per input pixel is probed once with a small tile, and the tile size and the number of tiles per batch
+# are derived from it. Otherwise `tile_size` (default 256) and `tiles_per_batch` are used as given. Tiles from all of
+# the images passed to a single call are batched together.
+#
+# Options (the 'tiled_inference' section of the test/video opt files):
+#   generator: Name of the generator to run. Default: 'generator'.
+#   tile_size: Edge length of the LQ tiles. Derived from memory_budget_mb if not given.
+#   overlap: How many LQ pixels adjacent tiles overlap by. Default: 16.
+#   memory_budget_mb: Upper bound on the memory used by one batch of tiles.
+#   tiles_per_batch: Maximum number of tiles per forward pass. Default: 16.
+#   tile_multiple: Tile sizes are rounded down to a multiple of this, for generators that need it. Default: 8.
+#   output_index: For generators returning a list or tuple, which element is the image. Default: 0.
+# from_opt() optionally takes a different callable to run on every batch of tiles, e.g. a SelfEnsemble.
+class TiledInference:
+    def __init__(self, generator, scale, device, tile_size=None, overlap=16, memory_budget_mb=None, tiles_per_batch=16,
+                 tile_multiple=8, output_index=0, fp16=False):
+        self.generator = generator
+        self.scale = scale
+        self.device = torch.device(device)
+        self.overlap = overlap
+        self.memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+        self.tiles_per_batch = tiles_per_batch
+        self.tile_multiple = tile_multiple
+        self.output_index = output_index
+        self.fp16 = fp16
+        self.tile_size = tile_size
+        self.bytes_per_pixel = None
+
+    @staticmethod
+    def from_opt(opt_tiled, model, scale, fp16=False, generator=None):
+        get = lambda k, d: opt_tiled[k] if k in opt_tiled.keys() and opt_tiled[k] is not None else d
+        if generator is None:
+            generator = model.env['generators'][get('generator', 'generator')]
+        return TiledInference(generator, scale, model.env['device'],
+                              tile_size=get('tile_size', None), overlap=get('overlap', 16),
+                              memory_budget_mb=get('memory_budget_mb', None), tiles_per_batch=get('tiles_per_batch', 16),
+                              tile_multiple=get('tile_multiple', 8), output_index=get('output_index', 0), fp16=fp16)
+
+    def _forward(self, x):
+        with torch.no_grad(), autocast(enabled=self.fp16):
+            out = self.generator(x)
+        if isinstance(out, list) or isinstance(out, tuple):
+            out = out[self.output_index]
+        return out.float()
+
+    # Measures the peak memory a forward pass needs per input pixel, using a single small tile.
+    def _probe_bytes_per_pixel(self, channels):
+        probe = max(self.tile_multiple, 64 // self.tile_multiple * self.tile_multiple)
+        torch.cuda.synchronize(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        base = torch.cuda.memory_allocated(self.device)
+        self._forward(torch.zeros(1, channels, probe, probe, device=self.device))
+        torch.cuda.synchronize(self.device)
+        return (torch.cuda.max_memory_allocated(self.device) - base) / (probe * probe)
+
+    def _plan(self, channels):
+        if self.memory_budget is None or self.device.type != 'cuda':
+            return self.tile_size or 256, self.tiles_per_batch
+        if self.bytes_per_pixel is None:
+            self.bytes_per_pixel = self._probe_bytes_per_pixel(channels)
+        max_pixels = self.memory_budget / self.bytes_per_pixel
+        tile_size = self.tile_size
+        if tile_size is None:
+            tile_size = int(math.sqrt(max_pixels)) // self.tile_multiple * self.tile_multiple
+            assert tile_size > self.overlap, "memory_budget_mb is too small to fit a single tile."
+        tiles_per_batch = max(1, min(self.tiles_per_batch, int(max_pixels // (tile_size * tile_size))))
+        return tile_size, tiles_per_batch
+
+    def _starts(self, length, tile):
+        if length <= tile:
+            return [0]
+        step = tile - self.overlap
+        starts = list(range(0, length - tile, step))
+        starts.append(length - tile)
+        return starts
+
+    # Weight for a tile of the given (output) length along one axis. On sides that face another tile, the outermost
+    # quarter of the overlap gets no weight at all (that is where the generator sees zero padding instead of real
+    # context) and the rest of the overlap ramps up linearly. Sides on the border of the image keep full weight.
+    def _ramp(self, length, start_is_border, end_is_border):
+        ramp = min(self.overlap * self.scale, length // 2)
+        margin = ramp // 4
+        w = torch.ones(length, device=self.device)
+        if ramp > 0:
+            r = torch.zeros(ramp, device=self.device)
+            r[margin:] = (torch.arange(ramp - margin, device=self.device, dtype=torch.float32) + 1) / (ramp - margin + 1)
+            if not start_is_border:
+                w[:ramp] = r
+            if not end_is_border:
+                w[-ramp:] = r.flip(0)
+        return w
+
+    # images is a (b,c,h,w) tensor or a list of (c,h,w) tensors, which can have different sizes. Returns the
+    # super-resolved images in the same form, on the device.
+    def __call__(self, images):
+        as_tensor = isinstance(images, torch.Tensor)
+        tile_size, tiles_per_batch = self._plan(images[0].shape[0])
+
+        outputs, weights, jobs = [], [], []
+        for i, img in enumerate(images):
+            c, h, w = img.shape
+            outputs.append(None)
+            weights.append(torch.zeros(1, h * self.scale, w * self.scale, device=self.device))
+            th, tw = min(h, tile_size), min(w, tile_size)
+            for y in self._starts(h, th):
+                for x in self._starts(w, tw):
+                    jobs.append((i, y, x, th, tw, (y == 0, y + th == h, x == 0, x + tw == w)))
+
+        # Tiles of the same shape (across all images) are batched together.
+        by_shape = {}
+        for job in jobs:
+            by_shape.setdefault(job[3:5], []).append(job)
+        windows = {}
+        for (th, tw), shape_jobs in by_shape.items():
+            for s in range(0, len(shape_jobs), tiles_per_batch):
+                batch_jobs = shape_jobs[s:s + tiles_per_batch]
+                batch = torch.stack([images[i][:, y:y + th, x:x + tw] for i, y, x, _, _, _ in batch_jobs]).to(self.device)
+                results = self._forward(batch)
+                for (i, y, x, _, _, borders), result in zip(batch_jobs, results):
+                    if (th, tw, borders) not in windows.keys():
+                        top, bottom, left, right = borders
+                        windows[(th, tw, borders)] = self._ramp(th * self.scale, top, bottom)[:, None] * \
+                                                     self._ramp(tw * self.scale, left, right)[None, :]
+                    window = windows[(th, tw, borders)]
+                    if outputs[i] is None:
+                        outputs[i] = torch.zeros(result.shape[0], images[i].shape[1] * self.scale,
+                                                 images[i].shape[2] * self.scale, device=self.device)
+                    oy, ox = y * self.scale, x * self.scale
+                    oh, ow = result.shape[1], result.shape[2]
+                    outputs[i][:, oy:oy + oh, ox:ox + ow] += result * window
+                    weights[i][:, oy:oy + oh, ox:ox + ow] += window
+
+        outputs = [o / w for o, w in zip(outputs, weights)]
+        return torch.stack(outputs) if as_tensor else outputs
@@ -246,20 +246,9 @@ def flipx4_forward(model, inp):
     Returns:
         output (Tensor): outputs of the model. float, in CPU
     """
-    # normal
-    output_f = single_forward(model, inp)
-
-    # flip W
-    output = single_forward(model, torch.flip(inp, (-1, )))
-    output_f = output_f + torch.flip(output, (-1, ))
-    # flip H
-    output = single_forward(model, torch.flip(inp, (-2, )))
-    output_f = output_f + torch.flip(output, (-2, ))
-    # flip both H and W
-    output = single_forward(model, torch.flip(inp, (-2, -1)))
-    output_f = output_f + torch.flip(output, (-2, -1))
-
-    return output_f / 4
+    # One variant per forward pass, which keeps the memory footprint of a single forward; see utils/self_ensemble.py.
+    from utils.self_ensemble import SelfEnsemble
+    return SelfEnsemble(model, mode=4, max_batch=inp.shape[0])(inp).cpu()
 
 
 ####################